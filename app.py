@@ -1,56 +1,1112 @@
-from flask import Flask, render_template, request, Response
+from flask import Flask, copy_current_request_context, g, has_request_context, render_template, request, Response
 from flask.json import jsonify
+import base64
+import click
+import collections
+import concurrent.futures
+import functools
+import heapq
+import itertools
 import json
-import sqlite3
+import math
 import time
 
+import partitions
+import rollups
+import series
+from cache import MetricCache
+from db import ConnectionManager, DeviceIds, SENSOR_TYPE_CODES, SENSOR_TYPE_NAMES, expire, reshard, write_readings
+from ingest import BufferFull, WriteBehindBuffer
+from stats import Summary
+from telemetry import Telemetry
+
 app = Flask(__name__)
+app.config.setdefault('DATABASE', 'database.db')
+app.config.setdefault('TEST_DATABASE', 'test_database.db')
+app.config.setdefault('SQLITE_SYNCHRONOUS', 'NORMAL')
+app.config.setdefault('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)
+app.config.setdefault('SQLITE_BUSY_TIMEOUT', 5000)
+app.config.setdefault('SHARDS', 1)
+app.config.setdefault('SHARD_WORKERS', 8)
+app.config.setdefault('PARTITION_DAYS', 1)
+app.config.setdefault('RETENTION_DAYS', 0)
+app.config.setdefault('READINGS_CHUNK_SIZE', 1000)
+app.config.setdefault('READINGS_MAX_LIMIT', 10000)
+app.config.setdefault('SERIES_MAX_POINTS', 10000)
+app.config.setdefault('PERCENTILE_INTERPOLATION', 'absolute')
+app.config.setdefault('CONDITIONAL_GETS', True)
+app.config.setdefault('INGEST_WRITE_BEHIND', False)
+app.config.setdefault('INGEST_QUEUE_SIZE', 100000)
+app.config.setdefault('INGEST_BATCH_SIZE', 1000)
+app.config.setdefault('INGEST_FLUSH_INTERVAL', 50)
+app.config.setdefault('METRIC_CACHE_SIZE', 10000)
+app.config.setdefault('METRIC_CACHE_TTL', 60)
+app.config.setdefault('SLOW_QUERY_THRESHOLD', 100)
+
+connections = ConnectionManager(app.config)
+device_ids = DeviceIds(connections)
+metric_cache = MetricCache(app.config)
+telemetry = Telemetry(app.config)
+
+telemetry.describe('http_request_duration_seconds', 'Time spent in the route handlers, streamed responses excluded')
+telemetry.describe('http_response_bytes_total', 'Bytes of the response bodies sent')
+telemetry.describe('sqlite_query_duration_seconds', 'Time spent executing read queries and fetching their rows')
+telemetry.describe('sqlite_rows_fetched_total', 'Rows fetched by read queries')
+telemetry.describe('sqlite_slow_queries_total', 'Read queries slower than SLOW_QUERY_THRESHOLD')
+telemetry.describe('readings_serialize_duration_seconds', 'Time spent serializing readings to JSON, per chunk')
+telemetry.describe('readings_serialized_total', 'Readings serialized in responses')
+telemetry.describe('ingest_insert_duration_seconds', 'Time spent inserting readings and updating the rollups, per transaction')
+telemetry.describe('ingest_readings_inserted_total', 'Readings inserted')
+
+# Setup the SQLite DB, opening the first connection to each shard creates and migrates its schema
+for path in connections.shard_paths():
+    connections.writer(path)
+
+SENSOR_TYPES = ['temperature', 'humidity']
+READING_COLUMNS = ['device_uuid', 'type', 'value', 'date_created']
+NDJSON_MIMETYPES = ['application/x-ndjson', 'application/jsonlines', 'application/x-jsonlines']
+READINGS_MIMETYPES = {'json': 'application/json', 'ndjson': 'application/x-ndjson', 'columnar': 'application/json'}
+METRICS = ['min', 'max', 'median', 'mean', 'mode', 'quartiles']
+# Readings are dated from the epoch to the end of year 9999, the range time.gmtime and SQLite integers handle everywhere
+MAX_DATE_CREATED = 253402300800
+SERIES_MODES = ['buckets', 'lttb']
+PERCENTILES = [50, 90, 95, 99]
+INTERPOLATIONS = ['absolute', 'lower']
+
+def do_db_request(query, params=(), path=None, route=None):
+    """
+    Run the query on the read-only connection to the sql database and return the rows requested
+
+    :param query: SQL query
+    :type string:
+    :param params: The parameters bound to the query
+    :type sequence:
+    :param path: The shard to query, see ConnectionManager.shard_path
+    :type string:
+    :param route: The route to label the telemetry with, defaults to the route of the current request
+    :type string:
+    """
+    conn = connections.reader(path)
+    cur = conn.cursor()
+
+    started = time.perf_counter()
+    cur.execute(query, params)
+    rows = cur.fetchall()
+    elapsed = time.perf_counter() - started
+    cur.close()
+
+    route = route or current_route()
+    telemetry.observe('sqlite_query_duration_seconds', elapsed, {'route': route})
+    telemetry.inc('sqlite_rows_fetched_total', {'route': route}, len(rows))
+    telemetry.slow_query(conn, query, params, elapsed)
+    return rows
+
+def iter_db_request(query, params=(), path=None, route=None, chunk_size=1000):
+    """
+    Run the query on the read-only connection to the sql database and yield the rows requested,
+    fetching chunk_size rows at a time so only a chunk is held however many rows are read.
+    See do_db_request for the parameters.
+    """
+    conn = connections.reader(path)
+    route = route or current_route()
+    started = time.perf_counter()
+    cur = conn.execute(query, params)
+    elapsed = time.perf_counter() - started
+    fetched = 0
+    try:
+        while True:
+            started = time.perf_counter()
+            rows = cur.fetchmany(chunk_size)
+            elapsed += time.perf_counter() - started
+            fetched += len(rows)
+            yield from rows
+            if len(rows) < chunk_size:
+                return
+    finally:
+        cur.close()
+        telemetry.observe('sqlite_query_duration_seconds', elapsed, {'route': route})
+        telemetry.inc('sqlite_rows_fetched_total', {'route': route}, fetched)
+        telemetry.slow_query(conn, query, params, elapsed)
+
+_fan_out_pool = None
+
+def fan_out(function, items):
+    """
+    Call function with each item from a pool of SHARD_WORKERS threads, e.g. to query every
+    shard in parallel, and return the results in the order of the items
+
+    :param function: Called with one item
+    :type callable:
+    :param items: The items, e.g. the shards to query
+    :type list:
+    """
+    global _fan_out_pool
+    if len(items) <= 1:
+        return [function(item) for item in items]
+
+    if _fan_out_pool is None:
+        _fan_out_pool = concurrent.futures.ThreadPoolExecutor(app.config['SHARD_WORKERS'], thread_name_prefix='fan-out')
+    calls = []
+    for item in items:
+        call = functools.partial(function, item)
+        if has_request_context():
+            # Keep the request around so the queries are labeled with its route
+            call = copy_current_request_context(call)
+        calls.append(_fan_out_pool.submit(call))
+    return [call.result() for call in calls]
+
+def current_route():
+    """
+    Return the rule of the route handling the current request, used to label the telemetry
+    """
+    if has_request_context() and request.url_rule is not None:
+        return request.url_rule.rule
+    return 'none'
+
+def readings_source(path, time_range=None):
+    """
+    Return the SQL source of the readings of a shard created within time_range: the union
+    of the partitions overlapping the range, so the other partitions are never read
+
+    :param path: The shard holding the readings
+    :type string:
+    :param time_range: The (start, end) range, None for every partition
+    :type tuple:
+    """
+    return partitions.source(partitions.overlapping(connections.reader(path), time_range))
+
+def retained_range(path, time_range):
+    """
+    Return the part of time_range after the retention horizon of a shard. The bucketed rollups
+    of expired partitions are deleted after the partitions are dropped, so they must not be read.
+
+    :param path: The shard holding the readings
+    :type string:
+    :param time_range: The (start, end) range
+    :type tuple:
+    """
+    horizon = partitions.horizon(connections.reader(path))
+    if horizon is None or time_range[0] >= horizon:
+        return time_range
+    return (horizon, time_range[1])
+
+def rollup_summary(device_uuid, sensor_type):
+    """
+    Return the Summary of all the readings of a device and sensor type from the rollups table
+
+    :param device_uuid: The uuid of the device
+    :type string:
+    :param sensor_type: The type of sensor
+    :type string:
+    """
+    rows = do_db_request('select {} from rollups where device_uuid=? and type=?'.format(rollups.SUMMARY_COLUMNS), [device_uuid, sensor_type],
+                         connections.shard_path(device_uuid))
+    return Summary.from_row(rows[0]) if rows else Summary()
+
+def last_modified(device_uuid):
+    """
+    Return the modified marker of a device, the epoch in milliseconds of the last change to its
+    readings made by any process, see db.TOUCH_DEVICE, or None when the device is not stored
 
-# Setup the SQLite DB
-conn = sqlite3.connect('database.db')
-conn.execute('CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
-conn.close()
+    :param device_uuid: The uuid of the device
+    :type string:
+    """
+    rows = do_db_request('select modified from devices where device_uuid=?', [device_uuid], connections.shard_path(device_uuid))
+    return rows[0]['modified'] if rows else None
+
+def readings_summary(device_uuid, sensor_type, time_range=None):
+    """
+    Return the Summary of the readings of a device and sensor type. All time summaries
+    come straight from the rollups table. Ranges are answered by combining the time bucketed
+    rollups fully covered by the range with the readings of the edges left over.
+
+    :param device_uuid: The uuid of the device
+    :type string:
+    :param sensor_type: The type of sensor
+    :type string:
+    :param time_range: Only summarize the readings created within this (start, end) range
+    :type tuple:
+    """
+    if time_range is None:
+        return rollup_summary(device_uuid, sensor_type)
+
+    path = connections.shard_path(device_uuid)
+    summary = Summary()
+    buckets, edges = rollups.plan(*retained_range(path, time_range))
+    for resolution, first, last in buckets:
+        rows = do_db_request('select {} from rollup_buckets where device_uuid=? and type=? and resolution=? and bucket between ? and ?'.format(rollups.SUMMARY_COLUMNS),
+                             [device_uuid, sensor_type, resolution, first, last], path)
+        for row in rows:
+            summary.merge(Summary.from_row(row))
+    for edge in edges:
+        query, params = readings_filter(device_uuid, sensor_type, edge)
+        rows = do_db_request('select value, count(*), min(date_created) from {} where {} group by value'.format(readings_source(path, edge), query), params, path)
+        summary.merge(Summary.from_value_rows(rows))
+    return summary
+
+def median_reading(device_uuid, sensor_type, time_range, histogram):
+    """
+    Return the reading found at the median rank of the histogram, ordered by date_created among
+    the readings sharing the median value, or None when there are no readings
+
+    :param histogram: The histogram of the readings selected by sensor_type and time_range
+    :type stats.Histogram:
+    """
+    if not histogram.count:
+        return None
+
+    # Fetch the reading that sorting the readings by value would have put at the median rank
+    path = connections.shard_path(device_uuid)
+    query, params = readings_filter(device_uuid, sensor_type, time_range)
+    rank = histogram.median_rank()
+    value = histogram.value_at(rank)
+    rows = do_db_request('select date_created from {} where {} and value=? order by date_created limit 1 offset ?'.format(readings_source(path, time_range), query),
+                         params + [value, rank - histogram.count_below(value)], path)
+    return {'device_uuid': device_uuid, 'type': sensor_type, 'value': value, 'date_created': rows[0]['date_created']}
+
+def summary_metric(metric, device_uuid, sensor_type, time_range, summary):
+    """
+    Return a metric of the summarized readings the way its endpoint returns it,
+    or None when the metric can not be found
+
+    :param metric: One of METRICS
+    :type string:
+    :param summary: The Summary of the readings selected by sensor_type and time_range
+    :type stats.Summary:
+    """
+    if metric == 'min':
+        if summary.min_value is None:
+            return None
+        return {'device_uuid': device_uuid, 'type': sensor_type, 'value': summary.min_value, 'date_created': summary.min_date_created}
+    if metric == 'max':
+        if summary.max_value is None:
+            return None
+        return {'device_uuid': device_uuid, 'type': sensor_type, 'value': summary.max_value, 'date_created': summary.max_date_created}
+    if metric == 'median':
+        return median_reading(device_uuid, sensor_type, time_range, summary.histogram)
+    if metric == 'mean':
+        if not summary.count:
+            return None
+        return {'value': round(summary.total / summary.count, 4)}
+    if metric == 'mode':
+        modes = summary.histogram.mode()
+        if not modes:
+            return None
+        # A single mode is returned as an integer, multimodes as a list
+        return {'value': modes[0] if len(modes) == 1 else modes}
+    if metric == 'quartiles':
+        quartiles = summary.histogram.quartiles()
+        if quartiles is None:
+            return None
+        return {'quartile_1': quartiles[0], 'quartile_3': quartiles[1]}
+    raise ValueError('metric {} not supported'.format(metric))
+
+def device_metrics(device_uuid, sensor_type, time_range, metrics):
+    """
+    Return the {metric: result} of a device's readings, see summary_metric. Results are
+    served from the metric cache when possible and the readings are summarized once
+    for all the metrics that were not cached.
 
-def find_median(sorted_list, absolute=True):
+    :param device_uuid: The uuid of the device
+    :type string:
+    :param sensor_type: The type of sensor
+    :type string:
+    :param time_range: Only use the readings created within this (start, end) range
+    :type tuple:
+    :param metrics: Some of METRICS
+    :type list:
     """
-    Find the median given a sorted list; if absolute is true and there are an even
-    number of items in the list return a calculated median; otherwise return the lower of the two medians.
+    # Read the marker first so a change committed while computing, by any process, invalidates the results
+    version = last_modified(device_uuid)
+    summary = None
+    results = {}
+    for metric in metrics:
+        key = (device_uuid, sensor_type, time_range, metric)
+        hit, result = metric_cache.get(key, version)
+        if not hit:
+            if summary is None:
+                summary = readings_summary(device_uuid, sensor_type, time_range)
+            result = summary_metric(metric, device_uuid, sensor_type, time_range, summary)
+            metric_cache.put(key, version, result)
+        results[metric] = result
+    return results
+
+def parse_metrics(args):
+    """
+    Return the metrics requested by the query parameters, every metric by default.
+    Raises a ValueError if one of them is not supported.
 
-    :param absolute: wether or not to return the absolute median
+    :param args: The query parameters of the request
+    :type dict:
+    """
+    if not args.get('metrics'):
+        return list(METRICS)
+
+    metrics = []
+    for metric in args['metrics'].split(','):
+        metric = metric.strip()
+        if metric not in METRICS:
+            raise ValueError('metric {} not supported'.format(metric))
+        if metric not in metrics:
+            metrics.append(metric)
+    return metrics
+
+def parse_percentiles(args):
+    """
+    Return the (percents, absolute) requested by the query parameters: the percentiles to find,
+    PERCENTILES by default, and whether to interpolate between the two closest values
+    (absolute) or return the lower one (lower), PERCENTILE_INTERPOLATION by default.
+    Raises a ValueError if a percentile is not a number between 0 and 100 or the interpolation is not supported.
+
+    :param args: The query parameters of the request
+    :type dict:
+    """
+    percents = []
+    for percent in args['p'].split(',') if args.get('p') else PERCENTILES:
+        try:
+            number = float(percent)
+        except ValueError:
+            number = -1
+        if not 0 <= number <= 100:
+            raise ValueError('percentile {} not supported'.format(str(percent).strip()))
+        number = int(number) if number.is_integer() else number
+        if number not in percents:
+            percents.append(number)
+
+    interpolation = args.get('interpolation', app.config['PERCENTILE_INTERPOLATION'])
+    if interpolation not in INTERPOLATIONS:
+        raise ValueError('interpolation {} not supported'.format(interpolation))
+    return percents, interpolation == 'absolute'
+
+def device_percentiles(device_uuid, sensor_type, time_range, percents, absolute=True):
+    """
+    Return the {'p<percent>': value} of several percentiles of a device's readings, or None when there
+    are no readings. They are all selected from the histogram of the readings summary, so the
+    readings are never sorted and all time percentiles are read from the rollups. Results are kept in the metric cache.
+
+    :param device_uuid: The uuid of the device
+    :type string:
+    :param sensor_type: The type of sensor
+    :type string:
+    :param time_range: Only use the readings created within this (start, end) range
+    :type tuple:
+    :param percents: Numbers between 0 and 100
+    :type list:
+    :param absolute: wether or not to interpolate between the two closest values
     :type boolean:
     """
-    n = len(sorted_list)
-    if n % 2 == 0:
-        if absolute:
-            median = (sorted_list[n // 2 - 1] + sorted_list[n // 2]) / 2
+    version = last_modified(device_uuid)
+    key = (device_uuid, sensor_type, time_range, 'percentiles', tuple(percents), absolute)
+    hit, result = metric_cache.get(key, version)
+    if hit:
+        return result
+
+    values = readings_summary(device_uuid, sensor_type, time_range).histogram.percentiles(percents, absolute)
+    if values is not None:
+        result = {'p{:g}'.format(percent): round(value, 4) for percent, value in values.items()}
+    metric_cache.put(key, version, result)
+    return result
+
+def fleet_filter(device_uuids, sensor_type, time_range=None):
+    """
+    Build the where clause, and its parameters, selecting the rollups of several devices.
+    The devices are bound as a single JSON array so any number of them fits in one query.
+
+    :param device_uuids: The uuids of the devices, None for every device
+    :type list:
+    :param sensor_type: Only select the readings of this sensor type
+    :type string:
+    :param time_range: Only select the readings created within this (start, end) range
+    :type tuple:
+    """
+    query = 'type=?'
+    params = [sensor_type]
+    if device_uuids is not None:
+        query += ' and device_uuid in (select value from json_each(?))'
+        params.append(json.dumps(device_uuids))
+    if time_range is not None:
+        query += ' and date_created between ? and ?'
+        params.extend(time_range)
+    return query, params
+
+def fleet_readings_filter(path, device_uuids, sensor_type, time_range=None):
+    """
+    Build the where clause, and its parameters, selecting the readings of several devices of a shard
+
+    :param path: The shard holding the readings of the devices
+    :type string:
+    :param device_uuids: The uuids of the devices, None for every device
+    :type list:
+    :param sensor_type: Only select the readings of this sensor type
+    :type string:
+    :param time_range: Only select the readings created within this (start, end) range
+    :type tuple:
+    """
+    query = 'type_code=?'
+    params = [SENSOR_TYPE_CODES.get(sensor_type)]
+    if device_uuids is not None:
+        query += ' and device_id in (select value from json_each(?))'
+        params.append(json.dumps(list(device_ids.get(path, device_uuids).values())))
+    if time_range is not None:
+        query += ' and date_created between ? and ?'
+        params.extend(time_range)
+    return query, params
+
+def fleet_shards(device_uuids):
+    """
+    Return the (shard, device_uuids) pairs holding the readings of several devices
+
+    :param device_uuids: The uuids of the devices, None for every device
+    :type list:
+    """
+    if device_uuids is None:
+        return [(path, None) for path in connections.shard_paths()]
+
+    shards = collections.OrderedDict()
+    for device_uuid in device_uuids:
+        shards.setdefault(connections.shard_path(device_uuid), []).append(device_uuid)
+    return list(shards.items())
+
+def fleet_summaries(device_uuids, sensor_type, time_range=None):
+    """
+    Return the {device_uuid: Summary} of the readings of several devices, like readings_summary
+    would for each of them, summarizing every shard in parallel. Requested devices without
+    readings get an empty Summary.
+
+    :param device_uuids: The uuids of the devices, None for every device with readings
+    :type list:
+    :param sensor_type: The type of sensor
+    :type string:
+    :param time_range: Only summarize the readings created within this (start, end) range
+    :type tuple:
+    """
+    summaries = collections.OrderedDict((device_uuid, None) for device_uuid in device_uuids or [])
+    for shard_summaries in fan_out(lambda shard: shard_fleet_summaries(shard[0], shard[1], sensor_type, time_range), fleet_shards(device_uuids)):
+        summaries.update(shard_summaries)
+    return summaries
+
+def shard_fleet_summaries(path, device_uuids, sensor_type, time_range=None):
+    """
+    Return the {device_uuid: Summary} of the readings of several devices of a shard, with one
+    query grouped by device per rollup resolution and edge
+
+    :param path: The shard holding the readings of the devices
+    :type string:
+    :param device_uuids: The uuids of the devices, None for every device of the shard
+    :type list:
+    """
+    summaries = collections.OrderedDict((device_uuid, Summary()) for device_uuid in device_uuids or [])
+
+    def merge(device_uuid, summary):
+        if device_uuid not in summaries:
+            summaries[device_uuid] = Summary()
+        summaries[device_uuid].merge(summary)
+
+    query, params = fleet_filter(device_uuids, sensor_type)
+    if time_range is None:
+        for row in do_db_request('select device_uuid, {} from rollups where {}'.format(rollups.SUMMARY_COLUMNS, query), params, path):
+            merge(row['device_uuid'], Summary.from_row(row))
+        return summaries
+
+    buckets, edges = rollups.plan(*retained_range(path, time_range))
+    for resolution, first, last in buckets:
+        rows = do_db_request('select device_uuid, {} from rollup_buckets where {} and resolution=? and bucket between ? and ?'.format(rollups.SUMMARY_COLUMNS, query),
+                             params + [resolution, first, last], path)
+        for row in rows:
+            merge(row['device_uuid'], Summary.from_row(row))
+    for edge in edges:
+        edge_query, edge_params = fleet_readings_filter(path, device_uuids, sensor_type, edge)
+        rows = do_db_request('select device_id, value, count(*), min(date_created) from {} where {} group by device_id, value'.format(readings_source(path, edge), edge_query),
+                             edge_params, path)
+        by_device = collections.defaultdict(list)
+        for row in rows:
+            by_device[row[0]].append(tuple(row)[1:])
+        uuids = device_ids.uuids(path, list(by_device))
+        for device_id, value_rows in by_device.items():
+            merge(uuids[device_id], Summary.from_value_rows(value_rows))
+    return summaries
+
+def fleet_medians(summaries, sensor_type, time_range):
+    """
+    Return the {device_uuid: median reading} of several devices, like median_reading would for
+    each of them, querying every shard in parallel
+
+    :param summaries: The {device_uuid: Summary} of the devices
+    :type dict:
+    """
+    medians = dict.fromkeys(summaries)
+    shards = [(path, {device_uuid: summaries[device_uuid] for device_uuid in device_uuids}) for path, device_uuids in fleet_shards(list(summaries))]
+    for shard_medians in fan_out(lambda shard: shard_fleet_medians(shard[0], shard[1], sensor_type, time_range), shards):
+        medians.update(shard_medians)
+    return medians
+
+def shard_fleet_medians(path, summaries, sensor_type, time_range):
+    """
+    Return the {device_uuid: median reading} of several devices of a shard, fetching the
+    date_created of every median reading in a single query
+
+    :param path: The shard holding the readings of the devices
+    :type string:
+    :param summaries: The {device_uuid: Summary} of the devices
+    :type dict:
+    """
+    ids = device_ids.get(path, list(summaries))
+    lookups = []
+    for device_uuid, summary in summaries.items():
+        histogram = summary.histogram
+        if histogram.count:
+            rank = histogram.median_rank()
+            value = histogram.value_at(rank)
+            lookups.append([ids[device_uuid], value, rank - histogram.count_below(value)])
+
+    # The lookups are bound first, as ?1, so they can be referred to again below
+    query = "(device_id, value) in (select json_extract(value, '$[0]'), json_extract(value, '$[1]') from json_each(?)) and type_code=?"
+    params = [json.dumps(lookups), SENSOR_TYPE_CODES.get(sensor_type)]
+    if time_range is not None:
+        query += ' and date_created between ? and ?'
+        params.extend(time_range)
+    # Number the readings holding the median value of each device by date_created and keep the one at the wanted offset
+    rows = do_db_request('''select device_id, value, date_created from (
+        select device_id, value, date_created, row_number() over (partition by device_id order by date_created) - 1 as position
+        from {} where {}) where position = (select json_extract(value, '$[2]') from json_each(?1) where json_extract(value, '$[0]') = device_id)'''.format(
+        readings_source(path, time_range), query), params, path)
+
+    uuids = device_ids.uuids(path, [row['device_id'] for row in rows])
+    medians = dict.fromkeys(summaries)
+    for device_id, value, date_created in rows:
+        medians[uuids[device_id]] = {'device_uuid': uuids[device_id], 'type': sensor_type, 'value': value, 'date_created': date_created}
+    return medians
+
+def fleet_metric(metric, device_uuids, sensor_type, time_range, summaries, overall):
+    """
+    Return a metric over the readings of several devices taken together, the way the
+    endpoint of a single device holding all of them would return it, or None when the
+    metric can not be found. The min, max and median readings keep the device they belong to.
+
+    :param metric: One of METRICS
+    :type string:
+    :param device_uuids: The uuids of the devices, None for every device
+    :type list:
+    :param summaries: The {device_uuid: Summary} of the devices
+    :type dict:
+    :param overall: The Summary of the readings of every device
+    :type stats.Summary:
+    """
+    if metric in ['min', 'max']:
+        # Like a single device, the earliest of the readings holding the min or max value wins
+        candidates = [(getattr(summary, metric + '_value'), getattr(summary, metric + '_date_created'), device_uuid)
+                      for device_uuid, summary in summaries.items() if getattr(summary, metric + '_value') is not None]
+        if not candidates:
+            return None
+        if metric == 'min':
+            value, date_created, device_uuid = min(candidates)
+        else:
+            value, date_created, device_uuid = min(candidates, key=lambda candidate: (-candidate[0], candidate[1], candidate[2]))
+        return {'device_uuid': device_uuid, 'type': sensor_type, 'value': value, 'date_created': date_created}
+    if metric == 'median':
+        histogram = overall.histogram
+        if not histogram.count:
+            return None
+        rank = histogram.median_rank()
+        value = histogram.value_at(rank)
+        offset = rank - histogram.count_below(value)
+        shards = fleet_shards(device_uuids)
+        median_query = '''select (select device_uuid from devices d where d.id = r.device_id) as device_uuid, r.date_created
+            from {} r where {} and value=? order by r.date_created, device_uuid limit ? offset ?'''
+        if len(shards) == 1:
+            query, params = fleet_readings_filter(shards[0][0], shards[0][1], sensor_type, time_range)
+            rows = do_db_request(median_query.format(readings_source(shards[0][0], time_range), query), params + [value, 1, offset], shards[0][0])
+        else:
+            # Every shard reads its readings holding the median value in order, merging them lazily finds the one at the offset
+            # while only a chunk of each shard is held
+            cursors = []
+            for path, shard_device_uuids in shards:
+                query, params = fleet_readings_filter(path, shard_device_uuids, sensor_type, time_range)
+                cursors.append(iter_db_request(median_query.format(readings_source(path, time_range), query), params + [value, -1, 0], path))
+            try:
+                rows = list(itertools.islice(heapq.merge(*cursors, key=lambda row: (row['date_created'], row['device_uuid'])), offset, offset + 1))
+            finally:
+                for cursor in cursors:
+                    cursor.close()
+        return {'device_uuid': rows[0]['device_uuid'], 'type': sensor_type, 'value': value, 'date_created': rows[0]['date_created']}
+    return summary_metric(metric, None, sensor_type, time_range, overall)
+
+def fleet_metrics(device_uuids, sensor_type, time_range, metrics):
+    """
+    Return the {metric: {'devices': {device_uuid: result}, 'overall': result}} of several devices.
+    Per device results are what the endpoints of each device return, see summary_metric.
+
+    :param device_uuids: The uuids of the devices, None for every device with readings
+    :type list:
+    :param sensor_type: The type of sensor
+    :type string:
+    :param time_range: Only use the readings created within this (start, end) range
+    :type tuple:
+    :param metrics: Some of METRICS
+    :type list:
+    """
+    summaries = fleet_summaries(device_uuids, sensor_type, time_range)
+    overall = Summary()
+    for summary in summaries.values():
+        overall.merge(summary)
+
+    results = {}
+    for metric in metrics:
+        if metric == 'median':
+            devices = fleet_medians(summaries, sensor_type, time_range)
         else:
-            median = sorted_list[n // 2 - 1]
+            devices = {device_uuid: summary_metric(metric, device_uuid, sensor_type, time_range, summary)
+                       for device_uuid, summary in summaries.items()}
+        results[metric] = {'devices': devices, 'overall': fleet_metric(metric, device_uuids, sensor_type, time_range, summaries, overall)}
+    return results
+
+def parse_time_range(args):
+    """
+    Return the (start, end) epoch range requested by the query parameters, or None when
+    the request is not limited to a range. Readings are stored with an integer date_created
+    so the range is rounded inwards to whole seconds.
+    Raises a ValueError if start or end is not a number.
+
+    :param args: The query parameters of the request
+    :type dict:
+    """
+    if 'start' not in args or 'end' not in args:
+        return None
+
+    try:
+        return (math.ceil(float(args['start'])), math.floor(float(args['end'])))
+    except (ValueError, OverflowError):
+        raise ValueError('start/end {}/{} not supported'.format(args['start'], args['end']))
+
+def readings_filter(device_uuid, sensor_type=None, time_range=None):
+    """
+    Build the where clause, and its parameters, selecting the readings of a device.
+    Devices and sensor types that are not stored select no readings.
+
+    :param device_uuid: The uuid of the device
+    :type string:
+    :param sensor_type: Only select the readings of this sensor type
+    :type string:
+    :param time_range: Only select the readings created within this (start, end) range
+    :type tuple:
+    """
+    query = 'device_id=?'
+    params = [device_ids.get_one(connections.shard_path(device_uuid), device_uuid)]
+    if sensor_type is not None:
+        query += ' and type_code=?'
+        params.append(SENSOR_TYPE_CODES.get(sensor_type))
+    if time_range is not None:
+        query += ' and date_created between ? and ?'
+        params.extend(time_range)
+    return query, params
+
+def parse_limit(args):
+    """
+    Return the page size requested by the query parameters, or None when the request is not paginated.
+    Raises a ValueError if the limit is not a number between 1 and READINGS_MAX_LIMIT.
+
+    :param args: The query parameters of the request
+    :type dict:
+    """
+    if 'limit' not in args:
+        return None
+
+    try:
+        limit = int(args['limit'])
+    except ValueError:
+        limit = 0
+    if limit < 1 or limit > app.config['READINGS_MAX_LIMIT']:
+        raise ValueError('limit {} not supported'.format(args['limit']))
+    return limit
+
+def parse_series(args, time_range, mode='buckets'):
+    """
+    Return the (width, origin) of the buckets requested by the query parameters: either their
+    width in seconds, aligned on multiples of the width, or the number of points of the series,
+    splitting the range evenly from its start. The lttb mode keeps the first and last readings
+    besides a reading per bucket, so they are left out of the points.
+    Raises a ValueError if neither or both are given, or if the series would have more than SERIES_MAX_POINTS points.
+
+    :param args: The query parameters of the request
+    :type dict:
+    :param time_range: The (start, end) range of the series
+    :type tuple:
+    :param mode: One of SERIES_MODES
+    :type string:
+    """
+    if ('bucket' in args) == ('points' in args):
+        raise ValueError('one of bucket/points is a required query parameter')
+
+    max_points = app.config['SERIES_MAX_POINTS']
+    if 'bucket' in args:
+        try:
+            width = int(args['bucket'])
+        except ValueError:
+            width = 0
+        if width < 1:
+            raise ValueError('bucket {} not supported'.format(args['bucket']))
+        origin = time_range[0] - time_range[0] % width
+        if series.bucket_count(time_range, width, origin) > max_points:
+            raise ValueError('bucket {} not supported, the series would have more than {} points'.format(args['bucket'], max_points))
+        return width, origin
+
+    try:
+        points = int(args['points'])
+    except ValueError:
+        points = 0
+    minimum = 3 if mode == 'lttb' else 1
+    if points < minimum or points > max_points:
+        raise ValueError('points {} not supported'.format(args['points']))
+    return series.bucket_width(time_range, points - 2 if mode == 'lttb' else points), time_range[0]
+
+def series_buckets(device_uuid, sensor_type, time_range, width, origin):
+    """
+    Return the (bucket, count, min, max, mean value, mean date_created) of every bucket of a
+    device's readings, computed by SQLite in a single grouped scan of the readings
+
+    :param width: The width of the buckets in seconds
+    :type int:
+    :param origin: The start of the first bucket
+    :type int:
+    """
+    path = connections.shard_path(device_uuid)
+    query, params = readings_filter(device_uuid, sensor_type, time_range)
+    return do_db_request('''select (date_created - ?) / ? as bucket, count(*), min(value), max(value), avg(value), avg(date_created)
+        from {} where {} group by bucket order by bucket'''.format(readings_source(path, time_range), query), [origin, width] + params, path)
+
+def device_series(device_uuid, sensor_type, time_range, width, origin, mode='buckets'):
+    """
+    Return the series of a device's readings the way the series endpoint returns it: the
+    date_created, count, min, max and mean of every bucket holding readings, or in the lttb mode the
+    date_created and value of the readings representing them. Series are kept in the metric cache.
+
+    :param device_uuid: The uuid of the device
+    :type string:
+    :param sensor_type: The type of sensor
+    :type string:
+    :param time_range: The (start, end) range of the series
+    :type tuple:
+    :param width: The width of the buckets in seconds
+    :type int:
+    :param origin: The start of the first bucket
+    :type int:
+    :param mode: One of SERIES_MODES
+    :type string:
+    """
+    version = last_modified(device_uuid)
+    key = (device_uuid, sensor_type, time_range, 'series', width, origin, mode)
+    hit, result = metric_cache.get(key, version)
+    if hit:
+        return result
+
+    buckets = series_buckets(device_uuid, sensor_type, time_range, width, origin)
+    if mode == 'lttb':
+        # Stream the readings of the range, the averages of the buckets are the third points of the triangles
+        path = connections.shard_path(device_uuid)
+        query, params = readings_filter(device_uuid, sensor_type, time_range)
+        chunks = iter_readings(readings_source(path, time_range), query, params, chunk_size=app.config['READINGS_CHUNK_SIZE'], path=path)
+        readings = (((row['date_created'] - origin) // width, row['date_created'], row['value']) for rows in chunks for row in rows)
+        averages = {row[0]: (row[5], row[4]) for row in buckets}
+        points = [{'date_created': date_created, 'value': value} for date_created, value in series.largest_triangles(readings, averages)]
     else:
-        median = sorted_list[n // 2]
-    return median
+        points = [{'date_created': origin + row[0] * width, 'count': row[1], 'min': row[2], 'max': row[3], 'mean': round(row[4], 4)}
+                  for row in buckets]
+
+    result = {'bucket': width, 'series': points}
+    metric_cache.put(key, version, result)
+    return result
+
+def reading_key(row):
+    """
+    Return the (date_created, type_code, seq) identifying a reading of a device, in the order readings are listed
+    """
+    return (row['date_created'], row['type_code'], row['seq'])
 
-def do_db_request(query):
+def encode_cursor(row):
     """
-    Run the query on the sql database and return the rows requested
+    Return the opaque cursor pointing after a reading
 
-    :param query: SQL query
+    :param row: A reading with its date_created, type_code and seq
+    :type sqlite3.Row:
+    """
+    return base64.urlsafe_b64encode('{}:{}:{}'.format(*reading_key(row)).encode()).decode()
+
+def decode_cursor(cursor):
+    """
+    Return the (date_created, type_code, seq) a cursor points after.
+    Raises a ValueError if the cursor was not made by encode_cursor.
+
+    :param cursor: An opaque cursor
+    :type string:
+    """
+    try:
+        date_created, type_code, seq = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+        return (int(date_created), int(type_code), int(seq))
+    except ValueError:
+        raise ValueError('cursor {} not supported'.format(cursor))
+
+def readings_page(source, query, params, after=None, limit=None, path=None, route=None):
+    """
+    Return up to limit readings ordered by (date_created, type_code, seq), starting after a cursor.
+    The order matches the (device_id, date_created) index of every partition so pages are read
+    with an index range scan however deep into the history they are.
+
+    :param source: The partitions holding the readings, see readings_source
+    :type string:
+    :param query: The where clause selecting the readings
+    :type string:
+    :param params: The parameters of the where clause
+    :type list:
+    :param after: The (date_created, type_code, seq) to start after
+    :type tuple:
+    :param limit: The maximum number of readings to return
+    :type int:
+    :param path: The shard holding the readings
+    :type string:
+    :param route: The route to label the telemetry with
+    :type string:
+    """
+    if after is not None:
+        query += ' and (date_created, type_code, seq) > (?, ?, ?)'
+        params = params + list(after)
+    return do_db_request('select type_code, seq, value, date_created from {} where {} order by date_created, type_code, seq limit ?'.format(source, query),
+                         params + [-1 if limit is None else limit], path, route)
+
+def iter_readings(source, query, params, after=None, chunk_size=1000, path=None, route=None):
+    """
+    Yield every reading selected by the where clause in chunks of chunk_size rows. Each chunk
+    is its own keyset query so no cursor (or read transaction) is held open while the
+    previous chunk is being sent to the client. The chunks are read once the request is over,
+    so the route to label the telemetry with is given by the caller.
+    """
+    while True:
+        rows = readings_page(source, query, params, after, chunk_size, path, route)
+        if rows:
+            yield rows
+        if len(rows) < chunk_size:
+            return
+        after = reading_key(rows[-1])
+
+def serialize_readings(device_uuid, chunks, output_format='json', route=None):
+    """
+    Serialize chunks of readings of a device into a JSON array or NDJSON, one chunk at a time
+
+    :param device_uuid: The uuid of the device
+    :type string:
+    :param chunks: Lists of readings
+    :type iterable:
+    :param output_format: json or ndjson
+    :type string:
+    :param route: The route to label the telemetry with, defaults to the route of the current request
     :type string:
-    :param commit: Wether or not to commit to the database
+    """
+    route = route or current_route()
+    separator = '['
+    for rows in chunks:
+        started = time.perf_counter()
+        readings = (json.dumps(dict(zip(READING_COLUMNS, (device_uuid, SENSOR_TYPE_NAMES[row[0]], row[2], row[3])))) for row in rows)
+        if output_format == 'ndjson':
+            body = ''.join(reading + '\n' for reading in readings)
+        else:
+            body = separator + ','.join(readings)
+            separator = ','
+        telemetry.observe('readings_serialize_duration_seconds', time.perf_counter() - started, {'route': route})
+        telemetry.inc('readings_serialized_total', {'route': route}, len(rows))
+        yield body
+    if output_format != 'ndjson':
+        yield '[]' if separator == '[' else ']'
+
+def serialize_columns(rows, types=False, route=None):
+    """
+    Serialize a page of readings of a device into a JSON object of columns, the date_created
+    and value of every reading (and its type when types is true) without repeating the keys
+    per reading. The columns are sliced straight out of the rows.
+
+    :param rows: A page of readings, see readings_page
+    :type list:
+    :param types: Whether to add the column of the sensor types, e.g. when they were not filtered
     :type boolean:
+    :param route: The route to label the telemetry with, defaults to the route of the current request
+    :type string:
+    """
+    route = route or current_route()
+    started = time.perf_counter()
+    type_codes, seqs, values, dates = zip(*rows) if rows else ([], [], [], [])
+    columns = {'date_created': dates, 'value': values}
+    if types:
+        columns['type'] = [SENSOR_TYPE_NAMES[type_code] for type_code in type_codes]
+    body = json.dumps(columns)
+    telemetry.observe('readings_serialize_duration_seconds', time.perf_counter() - started, {'route': route})
+    telemetry.inc('readings_serialized_total', {'route': route}, len(rows))
+    return body
+
+def validate_reading(device_uuid, sensor_type, value, date_created):
+    """
+    Validate a sensor reading sent by a client and return the row to insert.
+    Raises a ValueError describing the problem if the reading is not supported.
+
+    :param device_uuid: The uuid of the device the reading belongs to
+    :type string:
+    :param sensor_type: The type of sensor (temperature or humidity)
+    :type string:
+    :param value: The integer value of the sensor reading, between 0 and 100
+    :type int:
+    :param date_created: The epoch date of the sensor reading, before MAX_DATE_CREATED
+    :type int:
+    """
+    if not device_uuid or not isinstance(device_uuid, str):
+        raise ValueError('device_uuid {} not supported'.format(device_uuid))
+
+    if sensor_type not in SENSOR_TYPES:
+        raise ValueError('type {} not supported'.format(sensor_type))
+
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('value {} not supported'.format(value))
+    if value > 100 or value < 0:
+        raise ValueError('value {} not supported'.format(value))
+
+    try:
+        epoch = int(date_created)
+    except (TypeError, ValueError, OverflowError):
+        epoch = -1
+    if epoch < 0 or epoch >= MAX_DATE_CREATED:
+        raise ValueError('date_created {} not supported'.format(date_created))
+    date_created = epoch
+    retention_days = app.config['RETENTION_DAYS']
+    if retention_days and date_created < time.time() - retention_days * partitions.DAY:
+        raise ValueError('date_created {} is older than the retention period'.format(date_created))
+
+    return (device_uuid, sensor_type, value, date_created)
+
+def insert_readings(readings):
+    """
+    Insert validated readings into the sql database using a single transaction per shard
+
+    :param readings: (device_uuid, type, value, date_created) tuples
+    :type list:
+    """
+    shards = collections.OrderedDict()
+    for reading in readings:
+        shards.setdefault(connections.shard_path(reading[0]), []).append(reading)
+
+    for path, shard_readings in shards.items():
+        started = time.perf_counter()
+        ids = device_ids.assign(path, set(reading[0] for reading in shard_readings))
+        with connections.writer(path) as conn:
+            # Readings that became older than the retention period while they were queued are dropped
+            written = write_readings(conn, shard_readings, ids, app.config['PARTITION_DAYS'])
+            rollups.update(conn, written)
+        telemetry.observe('ingest_insert_duration_seconds', time.perf_counter() - started)
+        telemetry.inc('ingest_readings_inserted_total', amount=len(written))
+
+def accept_readings(readings):
     """
-    # Set the db that we want and open the connection
-    if app.config['TESTING']:
-        conn = sqlite3.connect('test_database.db')
+    Insert validated readings, or queue them for the write-behind buffer when INGEST_WRITE_BEHIND
+    is set. Returns True when the readings were only queued.
+    Raises BufferFull when the write-behind buffer has no room left for the readings.
+
+    :param readings: (device_uuid, type, value, date_created) tuples
+    :type list:
+    """
+    if app.config['INGEST_WRITE_BEHIND']:
+        write_behind.submit(readings)
+        return True
+
+    insert_readings(readings)
+    return False
+
+write_behind = WriteBehindBuffer(app.config, insert_readings)
+
+def count_response_bytes(body, route):
+    """
+    Count the bytes of a streamed response body as they are sent
+    """
+    for chunk in body:
+        telemetry.inc('http_response_bytes_total', {'route': route}, len(chunk.encode() if isinstance(chunk, str) else chunk))
+        yield chunk
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    """
+    Record the latency of the route handler and the size of the response
+    """
+    route = current_route()
+    labels = {'route': route, 'method': request.method, 'status': str(response.status_code)}
+    telemetry.observe('http_request_duration_seconds', time.perf_counter() - g.request_started, labels)
+    if response.is_streamed:
+        response.response = count_response_bytes(response.response, route)
     else:
-        conn = sqlite3.connect('database.db')
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
+        telemetry.inc('http_response_bytes_total', {'route': route}, response.content_length or 0)
+    return response
 
-    cur.execute(query)
-    rows = cur.fetchall()
-    return rows
+def conditional_get(route):
+    """
+    Decorate the GET routes of a device so their responses carry an ETag and Last-Modified
+    taken from the modified marker of the device, and requests whose If-None-Match (or, without
+    it, If-Modified-Since) still matches are answered with a 304 after reading that marker only.
+    The marker is read before the route runs so a concurrent insert is never hidden.
+    Disabled by setting CONDITIONAL_GETS to False.
+    """
+    @functools.wraps(route)
+    def wrapper(device_uuid, *args, **kwargs):
+        if request.method != 'GET' or not app.config['CONDITIONAL_GETS']:
+            return route(device_uuid, *args, **kwargs)
+
+        modified = last_modified(device_uuid)
+        if modified is None:
+            return route(device_uuid, *args, **kwargs)
+        etag = str(modified)
+        # Last-Modified only has a resolution of a second, another change could still happen within the second of the
+        # last one, so dates are only used once that second is over and the ETag is relied on meanwhile
+        last_second = modified // 1000
+        settled = last_second < int(time.time())
+
+        if request.if_none_match:
+            changed = not request.if_none_match.contains_weak(etag)
+        elif request.if_modified_since is not None and settled:
+            changed = last_second > request.if_modified_since.timestamp()
+        else:
+            changed = True
+
+        response = Response(status=304) if not changed else app.make_response(route(device_uuid, *args, **kwargs))
+        if response.status_code in [200, 304]:
+            response.set_etag(etag)
+            if settled:
+                response.last_modified = last_second
+        return response
+    return wrapper
+
+def parse_batch():
+    """
+    Parse the body of a batch request into an iterable of items. The body can either
+    be a JSON array or, when sent as application/x-ndjson, one JSON object per line.
+    Lines of an NDJSON stream that can not be decoded are yielded as ValueErrors so the
+    rest of the batch can still be processed.
+    """
+    if request.mimetype in NDJSON_MIMETYPES:
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield ValueError('invalid JSON {}'.format(line.decode('utf-8', 'replace')))
+    else:
+        items = json.loads(request.data)
+        if not isinstance(items, list):
+            raise ValueError('batch must be a JSON array')
+        for item in items:
+            yield item
 
 @app.route('/devices/<string:device_uuid>/readings/', methods = ['POST', 'GET'])
+@conditional_get
 def request_device_readings(device_uuid):
     """
     This endpoint allows clients to POST or GET data specific sensor types.
@@ -65,6 +1121,16 @@ def request_device_readings(device_uuid):
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
     * type -> The type of sensor value a client is looking for
+    * limit -> The number of readings per page, the cursor of the next page
+        is returned in the X-Next-Cursor header when there are more readings
+    * after -> The cursor of the page to return
+    * format -> json (default) for a JSON array, ndjson for one reading per line or
+        columnar for a JSON object of the date_created and value (and type, when
+        the readings are not filtered by type) columns, which requires a limit
+
+    Readings are returned ordered by date_created. Without a limit every reading
+    is streamed back in chunks instead of being loaded at once. Responses carry
+    an ETag and Last-Modified, see conditional_get.
     """
     if request.method == 'POST':
         # Grab the post parameters
@@ -73,44 +1139,108 @@ def request_device_readings(device_uuid):
         value = post_data.get('value')
         date_created = post_data.get('date_created', int(time.time()))
 
-        if sensor_type not in ['temperature', 'humidity']:
-            return 'type {} not supported'.format(sensor_type), 400
-
-        if int(value) > 100 or int(value) < 0:
-            return 'value {} not supported'.format(value), 400
-
-        # Set the db that we want and open the connection
-        if app.config['TESTING']:
-            conn = sqlite3.connect('test_database.db')
-        else:
-            conn = sqlite3.connect('database.db')
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
+        try:
+            reading = validate_reading(device_uuid, sensor_type, value, date_created)
+        except ValueError as e:
+            return str(e), 400
 
         # Insert data into db
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    (device_uuid, sensor_type, value, date_created))
-
-        conn.commit()
+        try:
+            queued = accept_readings([reading])
+        except BufferFull as e:
+            return str(e), 429
 
         # Return success
+        if queued:
+            return 'accepted', 202
         return 'success', 201
     else:
         # Check optional parameters
-        optional_query = ''
-        if 'type' in request.args:
-            optional_query += ' and type="{}"'.format(request.args['type'])
-
-        if 'start' in request.args and 'end' in request.args:
-            optional_query += ' and date_created between {} and {}'.format(request.args['start'], request.args['end'])
+        try:
+            time_range = parse_time_range(request.args)
+            limit = parse_limit(request.args)
+            after = decode_cursor(request.args['after']) if 'after' in request.args else None
+        except ValueError as e:
+            return str(e), 400
+
+        output_format = request.args.get('format', 'json')
+        if output_format not in READINGS_MIMETYPES:
+            return 'format {} not supported'.format(output_format), 400
+        # Columns can only be written once every reading was read, so they are paginated
+        if output_format == 'columnar' and limit is None:
+            return 'limit is a required query parameter with the columnar format', 400
+
+        query, params = readings_filter(device_uuid, request.args.get('type'), time_range)
+        path = connections.shard_path(device_uuid)
+        source = readings_source(path, time_range)
+
+        if limit is None:
+            # Stream the readings back one chunk at a time
+            route = current_route()
+            chunks = iter_readings(source, query, params, after, app.config['READINGS_CHUNK_SIZE'], path, route)
+            return Response(serialize_readings(device_uuid, chunks, output_format, route), 200, mimetype=READINGS_MIMETYPES[output_format])
 
         # Execute the query
-        rows = do_db_request('select * from readings where device_uuid="{}"{}'.format(device_uuid, optional_query))
+        rows = readings_page(source, query, params, after, limit, path)
+        headers = {}
+        if len(rows) == limit:
+            headers['X-Next-Cursor'] = encode_cursor(rows[-1])
 
         # Return the JSON
-        return jsonify([dict(zip(['device_uuid', 'type', 'value', 'date_created'], row)) for row in rows]), 200
+        if output_format == 'columnar':
+            # The type is only repeated when the readings were not filtered by type
+            return Response(serialize_columns(rows, 'type' not in request.args), 200, headers, mimetype=READINGS_MIMETYPES[output_format])
+        return Response(serialize_readings(device_uuid, [rows], output_format), 200, headers, mimetype=READINGS_MIMETYPES[output_format])
+
+@app.route('/readings/batch/', methods = ['POST'])
+@app.route('/devices/<string:device_uuid>/readings/batch/', methods = ['POST'])
+def request_readings_batch(device_uuid=None):
+    """
+    This endpoint allows clients to POST many sensor readings at once. Every reading
+    is validated like a single POST; the valid ones are inserted in one transaction
+    and the invalid ones are reported back by their position in the batch.
+
+    The body is either a JSON array or an NDJSON stream (Content-Type: application/x-ndjson)
+    of readings with the following fields:
+    * device_uuid -> The uuid of the device, only when posting to /readings/batch/
+    * type -> The type of sensor (temperature or humidity)
+    * value -> The integer value of the sensor reading
+    * date_created -> The epoch date of the sensor reading.
+        If none provided, we set to now.
+    """
+    now = int(time.time())
+    readings = []
+    errors = []
+    try:
+        for index, item in enumerate(parse_batch()):
+            try:
+                if isinstance(item, ValueError):
+                    raise item
+                if not isinstance(item, dict):
+                    raise ValueError('reading {} not supported'.format(item))
+                readings.append(validate_reading(
+                    device_uuid if device_uuid is not None else item.get('device_uuid'),
+                    item.get('type'), item.get('value'), item.get('date_created', now)))
+            except ValueError as e:
+                errors.append({'index': index, 'error': str(e)})
+    except ValueError as e:
+        return str(e), 400
+
+    queued = False
+    if readings:
+        try:
+            queued = accept_readings(readings)
+        except BufferFull as e:
+            return str(e), 429
+
+    if queued:
+        return jsonify({'accepted': len(readings), 'errors': errors}), 202
+
+    status = 201 if readings or not errors else 400
+    return jsonify({'inserted': len(readings), 'errors': errors}), status
 
 @app.route('/devices/<string:device_uuid>/readings/min/', methods = ['GET'])
+@conditional_get
 def request_device_readings_min(device_uuid):
     """
     This endpoint allows clients to GET the min sensor reading for a device.
@@ -127,23 +1257,20 @@ def request_device_readings_min(device_uuid):
         return 'type is a required query parameter', 400
 
     # Check optional parameters
-    optional_query = ''
-    if 'start' in request.args and 'end' in request.args:
-        optional_query = ' and date_created between {} and {}'.format(request.args['start'], request.args['end'])
+    try:
+        time_range = parse_time_range(request.args)
+    except ValueError as e:
+        return str(e), 400
 
-    rows = do_db_request('select * from readings where device_uuid="{}" and type="{}"{}'.format(device_uuid, request.args['type'], optional_query))
+    reading = device_metrics(device_uuid, request.args['type'], time_range, ['min'])['min']
 
-    min = {}
-    for reading in [dict(zip(['device_uuid', 'type', 'value', 'date_created'], row)) for row in rows]:
-        if reading.get('value') < min.get('value', 101):
-            min = reading
-
-    if min:
-        return jsonify(min), 200
+    if reading is not None:
+        return jsonify(reading), 200
     else:
         return "minimum not found", 404
 
 @app.route('/devices/<string:device_uuid>/readings/max/', methods = ['GET'])
+@conditional_get
 def request_device_readings_max(device_uuid):
     """
     This endpoint allows clients to GET the max sensor reading for a device.
@@ -160,23 +1287,20 @@ def request_device_readings_max(device_uuid):
         return 'type is a required query parameter', 400
 
     # Check optional parameters
-    optional_query = ''
-    if 'start' in request.args and 'end' in request.args:
-        optional_query = ' and date_created between {} and {}'.format(request.args['start'], request.args['end'])
-
-    rows = do_db_request('select * from readings where device_uuid="{}" and type="{}"{}'.format(device_uuid, request.args['type'], optional_query))
+    try:
+        time_range = parse_time_range(request.args)
+    except ValueError as e:
+        return str(e), 400
 
-    max = {}
-    for reading in [dict(zip(['device_uuid', 'type', 'value', 'date_created'], row)) for row in rows]:
-        if reading.get('value') > max.get('value', -1):
-            max = reading
+    reading = device_metrics(device_uuid, request.args['type'], time_range, ['max'])['max']
 
-    if max:
-        return jsonify(max), 200
+    if reading is not None:
+        return jsonify(reading), 200
     else:
         return "maximum not found", 404
 
 @app.route('/devices/<string:device_uuid>/readings/median/', methods = ['GET'])
+@conditional_get
 def request_device_readings_median(device_uuid):
     """
     This endpoint allows clients to GET the median sensor reading for a device.
@@ -196,22 +1320,20 @@ def request_device_readings_median(device_uuid):
         return 'type is a required query parameter', 400
 
     # Check optional parameters
-    optional_query = ''
-    if 'start' in request.args and 'end' in request.args:
-        optional_query = ' and date_created between {} and {}'.format(request.args['start'], request.args['end'])
-
-    rows = do_db_request('select * from readings where device_uuid="{}" and type="{}"{}'.format(device_uuid, request.args['type'], optional_query))
+    try:
+        time_range = parse_time_range(request.args)
+    except ValueError as e:
+        return str(e), 400
 
-    median = {}
-    readings = sorted([dict(zip(['device_uuid', 'type', 'value', 'date_created'], row)) for row in rows], key = lambda i: i['value'])
-    median = find_median(readings, absolute=False)
+    reading = device_metrics(device_uuid, request.args['type'], time_range, ['median'])['median']
 
-    if median:
-        return jsonify(median), 200
-    else:
+    if reading is None:
         return "median not found", 404
 
+    return jsonify(reading), 200
+
 @app.route('/devices/<string:device_uuid>/readings/mean/', methods = ['GET'])
+@conditional_get
 def request_device_readings_mean(device_uuid):
     """
     This endpoint allows clients to GET the mean sensor readings for a device.
@@ -229,21 +1351,20 @@ def request_device_readings_mean(device_uuid):
         return 'type is a required query parameter', 400
 
     # Check optional parameters
-    optional_query = ''
-    if 'start' in request.args and 'end' in request.args:
-        optional_query = ' and date_created between {} and {}'.format(request.args['start'], request.args['end'])
+    try:
+        time_range = parse_time_range(request.args)
+    except ValueError as e:
+        return str(e), 400
 
-    rows = do_db_request('select * from readings where device_uuid="{}" and type="{}"{}'.format(device_uuid, request.args['type'], optional_query))
+    mean = device_metrics(device_uuid, request.args['type'], time_range, ['mean'])['mean']
 
-    mean = 0
-    readings = [dict(zip(['device_uuid', 'type', 'value', 'date_created'], row)) for row in rows]
-    for reading in readings:
-        mean += reading['value']
-    mean = round(mean / len(readings), 4)
+    if mean is None:
+        return "mean not found", 404
 
-    return jsonify({"value": mean}), 200
+    return jsonify(mean), 200
 
 @app.route('/devices/<string:device_uuid>/readings/mode/', methods = ['GET'])
+@conditional_get
 def request_device_readings_mode(device_uuid):
     """
     This endpoint allows clients to GET the mode sensor reading value for a device.
@@ -263,40 +1384,20 @@ def request_device_readings_mode(device_uuid):
         return 'type is a required query parameter', 400
 
     # Check optional parameters
-    optional_query = ''
-    if 'start' in request.args and 'end' in request.args:
-        optional_query = ' and date_created between {} and {}'.format(request.args['start'], request.args['end'])
-
-    rows = do_db_request('select * from readings where device_uuid="{}" and type="{}"{}'.format(device_uuid, request.args['type'], optional_query))
-
-    freq_map = {}
-    readings = [dict(zip(['device_uuid', 'type', 'value', 'date_created'], row)) for row in rows]
-    for reading in readings:
-        if reading['value'] in freq_map:
-            freq_map[reading['value']] += 1
-        else:
-            freq_map[reading['value']] = 1
+    try:
+        time_range = parse_time_range(request.args)
+    except ValueError as e:
+        return str(e), 400
 
-    max = -1
-    count_map = {}
-    for k, v in freq_map.items():
-        if v in count_map:
-            count_map[v].append(k)
-        else:
-            count_map[v] = [k]
-        if v > max:
-            max = v
+    mode = device_metrics(device_uuid, request.args['type'], time_range, ['mode'])['mode']
 
-    if not count_map:
+    if mode is None:
         return "no mode found", 404
 
-    if len(count_map[v]) == 1:
-        return jsonify({"value": count_map[v][0]}), 200
-    else:
-        # We found more than one mode
-        return jsonify({"value": count_map[v]}), 200
+    return jsonify(mode), 200
 
 @app.route('/devices/<string:device_uuid>/readings/quartiles/', methods = ['GET'])
+@conditional_get
 def request_device_readings_quartiles(device_uuid):
     """
     This endpoint allows clients to GET the 1st and 3rd quartile
@@ -319,22 +1420,232 @@ def request_device_readings_quartiles(device_uuid):
     if 'start' not in request.args or 'end' not in request.args:
         return 'start/end are required query parameters', 400
 
-    rows = do_db_request('select * from readings where device_uuid="{}" and type="{}" and date_created between {} and {}'.format(
-        device_uuid, request.args['type'], request.args['start'], request.args['end']))
+    try:
+        time_range = parse_time_range(request.args)
+    except ValueError as e:
+        return str(e), 400
 
-    readings = sorted([row['value'] for row in rows])
-    n = len(readings)
-    if n % 2 == 0:
-        first_half = readings[:n // 2]
-        second_half = readings[n // 2:]
-    else:
-        first_half = readings[:n // 2]
-        second_half = readings[n // 2 + 1:]
+    quartiles = device_metrics(device_uuid, request.args['type'], time_range, ['quartiles'])['quartiles']
 
-    first_quartile = find_median(first_half, absolute=True)
-    third_quartile = find_median(second_half, absolute=True)
+    if quartiles is None:
+        return "quartiles not found", 404
 
-    return jsonify({'quartile_1': first_quartile, 'quartile_3': third_quartile}), 200
+    return jsonify(quartiles), 200
+
+@app.route('/devices/<string:device_uuid>/readings/percentiles/', methods = ['GET'])
+@conditional_get
+def request_device_readings_percentiles(device_uuid):
+    """
+    This endpoint allows clients to GET several percentiles of a device's readings at once,
+    e.g. the p99 temperature to alert on.
+
+    Mandatory Query Parameters:
+    * type -> The type of sensor value a client is looking for
+
+    Optional Query Parameters
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    * p -> A comma separated list of percentiles between 0 and 100, 50,90,95,99 by default
+    * interpolation -> absolute to interpolate between the two closest values like the
+        absolute median, or lower to return the lower one like the lower median
+    """
+    # Check mandatory parameters
+    if 'type' not in request.args:
+        return 'type is a required query parameter', 400
+
+    # Check optional parameters
+    try:
+        time_range = parse_time_range(request.args)
+        percents, absolute = parse_percentiles(request.args)
+    except ValueError as e:
+        return str(e), 400
+
+    percentiles = device_percentiles(device_uuid, request.args['type'], time_range, percents, absolute)
+
+    if percentiles is None:
+        return "percentiles not found", 404
+
+    return jsonify(percentiles), 200
+
+@app.route('/devices/<string:device_uuid>/readings/stats/', methods = ['GET'])
+@conditional_get
+def request_device_readings_stats(device_uuid):
+    """
+    This endpoint allows clients to GET several metrics of a device's readings at once.
+    Every metric is computed from a single summary of the readings and returned like its
+    own endpoint would return it, or null when it can not be found.
+
+    Mandatory Query Parameters:
+    * type -> The type of sensor value a client is looking for
+
+    Optional Query Parameters
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    * metrics -> A comma separated list of min, max, median, mean, mode and quartiles, all of them by default
+    """
+    # Check mandatory parameters
+    if 'type' not in request.args:
+        return 'type is a required query parameter', 400
+
+    # Check optional parameters
+    try:
+        time_range = parse_time_range(request.args)
+        metrics = parse_metrics(request.args)
+    except ValueError as e:
+        return str(e), 400
+
+    return jsonify(device_metrics(device_uuid, request.args['type'], time_range, metrics)), 200
+
+@app.route('/devices/<string:device_uuid>/readings/series/', methods = ['GET'])
+@conditional_get
+def request_device_readings_series(device_uuid):
+    """
+    This endpoint allows clients to GET a downsampled series of a device's readings, e.g. to
+    chart them. The range is split into buckets and every bucket holding readings is returned
+    with its start date_created and the count, min, max and mean of its readings, or in the lttb
+    mode as the reading that best represents it, the first and last readings of the range included.
+
+    Mandatory Query Parameters:
+    * type -> The type of sensor value a client is looking for
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    * bucket -> The width of the buckets in seconds, aligned on multiples of the width
+    * points -> Or the number of points of the series, e.g. the width of the chart in pixels
+
+    Optional Query Parameters
+    * mode -> buckets (default) or lttb
+    """
+    # Check mandatory parameters
+    if 'type' not in request.args:
+        return 'type is a required query parameter', 400
+
+    if 'start' not in request.args or 'end' not in request.args:
+        return 'start/end are required query parameters', 400
+
+    mode = request.args.get('mode', 'buckets')
+    if mode not in SERIES_MODES:
+        return 'mode {} not supported'.format(mode), 400
+
+    try:
+        time_range = parse_time_range(request.args)
+        width, origin = parse_series(request.args, time_range, mode)
+    except ValueError as e:
+        return str(e), 400
+
+    return jsonify(device_series(device_uuid, request.args['type'], time_range, width, origin, mode)), 200
+
+@app.route('/readings/<string:metric>/', methods = ['GET'])
+def request_fleet_readings_metric(metric):
+    """
+    This endpoint allows clients to GET a metric (min, max, median, mean, mode or quartiles),
+    or several of them with stats, for many devices at once. Each metric is returned for every
+    device, like its per device endpoint would, and over the readings of all the devices together:
+
+        {'devices': {<uuid>: <result>}, 'overall': <result>}
+
+    Results that can not be found are null. The stats metric returns {<metric>: <devices and overall>}.
+
+    Mandatory Query Parameters:
+    * type -> The type of sensor value a client is looking for
+
+    Optional Query Parameters
+    * device_uuid -> A device to include, repeated for every device; every device when omitted
+    * start -> The epoch start time for a sensor being created, mandatory for quartiles
+    * end -> The epoch end time for a sensor being created, mandatory for quartiles
+    * metrics -> For stats, a comma separated list of metrics, all of them by default
+    """
+    if metric != 'stats' and metric not in METRICS:
+        return 'metric {} not supported'.format(metric), 404
+
+    # Check mandatory parameters
+    if 'type' not in request.args:
+        return 'type is a required query parameter', 400
+
+    if metric == 'quartiles' and ('start' not in request.args or 'end' not in request.args):
+        return 'start/end are required query parameters', 400
+
+    # Check optional parameters
+    try:
+        time_range = parse_time_range(request.args)
+        metrics = parse_metrics(request.args) if metric == 'stats' else [metric]
+    except ValueError as e:
+        return str(e), 400
+
+    device_uuids = request.args.getlist('device_uuid') or None
+    results = fleet_metrics(device_uuids, request.args['type'], time_range, metrics)
+
+    if metric == 'stats':
+        return jsonify(results), 200
+    return jsonify(results[metric]), 200
+
+@app.route('/ingest/stats/', methods = ['GET'])
+def request_ingest_stats():
+    """
+    This endpoint allows clients to GET the counters of the write-behind ingestion
+    buffer: its queue depth, the readings accepted, rejected and flushed, and how
+    long flushes take.
+    """
+    return jsonify(write_behind.stats()), 200
+
+@app.route('/cache/stats/', methods = ['GET'])
+def request_cache_stats():
+    """
+    This endpoint allows clients to GET the counters of the metric cache:
+    its size and the number of hits, misses and evictions.
+    """
+    return jsonify(metric_cache.stats()), 200
+
+@app.route('/metrics', methods = ['GET'])
+def request_metrics():
+    """
+    This endpoint allows clients to GET the telemetry of the API in the Prometheus text format:
+    latency histograms per route, SQL time and rows fetched, readings serialized, response bytes,
+    inserts, and the counters of the metric cache and write-behind buffer.
+    """
+    gauges = {}
+    for name, value in metric_cache.stats().items():
+        gauges['metric_cache_' + name] = ('Metric cache {}'.format(name), value)
+    for name, value in write_behind.stats().items():
+        gauges['ingest_buffer_' + name] = ('Write-behind buffer {}'.format(name.replace('_', ' ')), value)
+    return Response(telemetry.render(gauges), 200, mimetype='text/plain; version=0.0.4')
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """
+    Recompute the rollups of every device from the partitions of the readings.
+    """
+    for path in connections.shard_paths():
+        rollups.rebuild(connections.writer(path))
+    metric_cache.clear()
+    click.echo('rollups rebuilt')
+
+@app.cli.command('reshard')
+@click.argument('shards', type=int)
+def reshard_command(shards):
+    """
+    Copy the readings into SHARDS new shard files. Stop the API first, then set SHARDS
+    in the config once the copy is done; the old files can be removed afterwards.
+    """
+    if shards < 1:
+        raise click.BadParameter('shards must be at least 1')
+    try:
+        paths = reshard(connections, shards)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    device_ids.clear()
+    click.echo('readings copied to {}'.format(', '.join(paths)))
+
+@app.cli.command('expire-readings')
+def expire_readings_command():
+    """
+    Drop the partitions of readings older than RETENTION_DAYS. It can run while the API is
+    serving, e.g. daily from cron.
+    """
+    if not app.config['RETENTION_DAYS']:
+        raise click.ClickException('RETENTION_DAYS is not set')
+    dropped = expire(connections, app.config['RETENTION_DAYS'])
+    metric_cache.clear()
+    click.echo('dropped {} partitions'.format(len(dropped)))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,286 @@
+"""
+Load and latency benchmark of the API.
+
+Generates a synthetic fleet of devices, then drives every route with concurrent
+requests and prints the throughput and latency percentiles of each one as JSON
+so runs can be compared:
+
+    python benchmark.py --devices 100 --readings 1000 --span 86400 --output before.json
+
+By default the app is driven in process through its test client, against a scratch
+database. With --url the requests are sent to a running server instead, and the fleet
+is generated in that server's database through the batch endpoint.
+"""
+import concurrent.futures
+import json
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import click
+
+from app import METRICS, app, connections
+
+# How many readings are sent per batch request while generating the fleet
+GENERATE_BATCH_SIZE = 1000
+
+def percentile(sorted_values, p):
+    """
+    Return the p-th percentile of sorted values using the nearest rank
+
+    :param p: The percentile, between 0 and 100
+    :type float:
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+class AppClient:
+    """
+    Send requests to the app in process, through one test client per thread
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, content_type=None, headers=None):
+        """
+        Return the (status, response size) of a request
+        """
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = app.test_client()
+        response = client.open(path, method=method, data=body, content_type=content_type, headers=headers)
+        return response.status_code, len(response.get_data())
+
+class HttpClient:
+    """
+    Send requests to a running server
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def request(self, method, path, body=None, content_type=None, headers=None):
+        """
+        Return the (status, response size) of a request
+        """
+        data = body.encode() if isinstance(body, str) else body
+        headers = dict(headers or {})
+        if content_type:
+            headers['Content-Type'] = content_type
+        req = urllib.request.Request(self.url + path, data=data, method=method, headers=headers)
+        try:
+            with urllib.request.urlopen(req) as response:
+                return response.status, len(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, len(e.read())
+
+class Fleet:
+    """
+    The synthetic devices the benchmark generates readings for and sends requests about
+
+    :param devices: The number of devices
+    :type int:
+    :param readings: The number of readings per device and sensor type
+    :type int:
+    :param span: The number of seconds the readings of a device are spread over
+    :type int:
+    :param end: The epoch date of the most recent readings
+    :type int:
+    """
+
+    def __init__(self, devices, readings, span, end, seed=0):
+        self.device_uuids = ['bench-{:06d}'.format(i) for i in range(devices)]
+        self.readings = readings
+        self.span = span
+        self.end = end
+        self.start = end - span
+        self.seed = seed
+
+    def iter_readings(self):
+        """
+        Yield the readings of every device, a random walk of values per device and sensor type
+        """
+        rand = random.Random(self.seed)
+        step = max(1, self.span // max(1, self.readings))
+        for device_uuid in self.device_uuids:
+            for sensor_type in ['temperature', 'humidity']:
+                value = rand.randint(20, 80)
+                for i in range(self.readings):
+                    value = min(100, max(0, value + rand.randint(-3, 3)))
+                    yield {'device_uuid': device_uuid, 'type': sensor_type, 'value': value,
+                           'date_created': self.start + i * step + rand.randint(0, step - 1)}
+
+    def random_range(self, rand):
+        """
+        Return a random (start, end) range within the span of the readings
+        """
+        start = rand.randint(self.start, self.end)
+        return start, rand.randint(start, self.end)
+
+def generate(client, fleet):
+    """
+    Insert the readings of the fleet through the batch endpoint and return how long it took
+    """
+    started = time.monotonic()
+    batch = []
+    count = 0
+    for reading in fleet.iter_readings():
+        batch.append(reading)
+        if len(batch) == GENERATE_BATCH_SIZE:
+            client.request('POST', '/readings/batch/', json.dumps(batch), 'application/json')
+            count += len(batch)
+            batch = []
+    if batch:
+        client.request('POST', '/readings/batch/', json.dumps(batch), 'application/json')
+        count += len(batch)
+    seconds = time.monotonic() - started
+    return {'readings': count, 'seconds': round(seconds, 3), 'throughput': round(count / seconds, 1) if seconds else None}
+
+def endpoints(fleet):
+    """
+    Return the {name: build} of every benchmarked route, build returns the (method, path, body, content_type)
+    of a random request given a random.Random, optionally followed by its headers
+    """
+    def device(rand):
+        return rand.choice(fleet.device_uuids)
+
+    def sensor_type(rand):
+        return rand.choice(['temperature', 'humidity'])
+
+    def reading(rand):
+        return {'type': sensor_type(rand), 'value': rand.randint(0, 100), 'date_created': fleet.end + rand.randint(1, 60)}
+
+    def ranged(rand):
+        return '&start={}&end={}'.format(*fleet.random_range(rand))
+
+    routes = {
+        'post_reading': lambda rand: ('POST', '/devices/{}/readings/'.format(device(rand)), json.dumps(reading(rand)), 'application/json'),
+        'post_batch': lambda rand: ('POST', '/devices/{}/readings/batch/'.format(device(rand)), json.dumps([reading(rand) for i in range(100)]), 'application/json'),
+        'get_readings': lambda rand: ('GET', '/devices/{}/readings/?type={}&limit=100'.format(device(rand), sensor_type(rand)), None, None),
+        'get_readings_range': lambda rand: ('GET', '/devices/{}/readings/?type={}&limit=100{}'.format(device(rand), sensor_type(rand), ranged(rand)), None, None),
+        'get_readings_columnar': lambda rand: ('GET', '/devices/{}/readings/?type={}&limit=100&format=columnar'.format(device(rand), sensor_type(rand)), None, None),
+        # Answered with a 304 from the modified marker of the device since * matches any ETag
+        'get_readings_not_modified': lambda rand: ('GET', '/devices/{}/readings/?type={}&limit=100'.format(device(rand), sensor_type(rand)), None, None, {'If-None-Match': '*'}),
+    }
+    for metric in METRICS + ['stats', 'percentiles']:
+        if metric != 'quartiles':
+            routes['get_' + metric] = lambda rand, metric=metric: ('GET', '/devices/{}/readings/{}/?type={}'.format(device(rand), metric, sensor_type(rand)), None, None)
+        routes['get_{}_range'.format(metric)] = lambda rand, metric=metric: (
+            'GET', '/devices/{}/readings/{}/?type={}{}'.format(device(rand), metric, sensor_type(rand), ranged(rand)), None, None)
+    routes['get_series_range'] = lambda rand: ('GET', '/devices/{}/readings/series/?type={}&points=100{}'.format(device(rand), sensor_type(rand), ranged(rand)), None, None)
+    routes['get_series_lttb_range'] = lambda rand: ('GET', '/devices/{}/readings/series/?type={}&points=100&mode=lttb{}'.format(device(rand), sensor_type(rand), ranged(rand)), None, None)
+    routes['get_fleet_stats'] = lambda rand: ('GET', '/readings/stats/?type={}{}'.format(
+        sensor_type(rand), ''.join('&device_uuid={}'.format(device(rand)) for i in range(10))), None, None)
+    routes['get_fleet_stats_range'] = lambda rand: ('GET', '/readings/stats/?type={}{}'.format(sensor_type(rand), ranged(rand)), None, None)
+    return routes
+
+def run_endpoint(client, build, requests, executor, seed=0):
+    """
+    Send requests built by build from the threads of executor and return their throughput and latency
+
+    :param build: Returns the (method, path, body, content_type) of a random request, optionally followed by its headers
+    :type callable:
+    :param executor: The threads sending the requests
+    :type concurrent.futures.Executor:
+    """
+    rand = random.Random(seed)
+    planned = [build(rand) for i in range(requests)]
+
+    def send(planned_request):
+        started = time.perf_counter()
+        status, size = client.request(*planned_request)
+        return time.perf_counter() - started, status, size
+
+    started = time.monotonic()
+    results = list(executor.map(send, planned))
+    seconds = time.monotonic() - started
+
+    latencies = sorted(latency * 1000 for latency, status, size in results)
+    statuses = {}
+    for latency, status, size in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'requests': requests,
+        'seconds': round(seconds, 3),
+        'throughput': round(requests / seconds, 1) if seconds else None,
+        'statuses': statuses,
+        'response_bytes': sum(size for latency, status, size in results),
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies), 3) if latencies else None,
+            'p50': round(percentile(latencies, 50), 3) if latencies else None,
+            'p95': round(percentile(latencies, 95), 3) if latencies else None,
+            'p99': round(percentile(latencies, 99), 3) if latencies else None,
+            'max': round(latencies[-1], 3) if latencies else None,
+        },
+    }
+
+def run(client, fleet, requests, concurrency, only=None, seed=0):
+    """
+    Generate the fleet then benchmark every route, or the routes named in only, and return the report
+    """
+    report = {'generate': generate(client, fleet), 'endpoints': {}}
+    # The same threads are reused for every route so the app keeps the same connections open
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        for name, build in endpoints(fleet).items():
+            if only and name not in only:
+                continue
+            report['endpoints'][name] = run_endpoint(client, build, requests, executor, seed)
+    return report
+
+@click.command()
+@click.option('--devices', default=100, help='Number of devices in the fleet.')
+@click.option('--readings', default=1000, help='Number of readings per device and sensor type.')
+@click.option('--span', default=86400, help='Number of seconds the readings of a device are spread over.')
+@click.option('--requests', default=1000, help='Number of requests sent to each route.')
+@click.option('--concurrency', default=8, help='Number of requests sent at the same time.')
+@click.option('--endpoint', 'only', multiple=True, help='Only benchmark this route, can be repeated.')
+@click.option('--database', default=None, help='The scratch database file, a temporary file by default.')
+@click.option('--url', default=None, help='Benchmark a running server instead of the app in process.')
+@click.option('--no-cache', is_flag=True, help='Disable the metric cache of the app in process.')
+@click.option('--seed', default=0, help='Seed of the generated fleet and requests.')
+@click.option('--output', type=click.File('w'), default='-', help='Where to write the JSON report.')
+def main(devices, readings, span, requests, concurrency, only, database, url, no_cache, seed, output):
+    """
+    Benchmark the API against a synthetic fleet and report the throughput and p50/p95/p99 latency of every route
+    """
+    fleet = Fleet(devices, readings, span, int(time.time()) - 60, seed)
+    config = {'devices': devices, 'readings': readings, 'span': span, 'requests': requests,
+              'concurrency': concurrency, 'url': url, 'cache': not no_cache, 'seed': seed}
+
+    if url is not None:
+        report = run(HttpClient(url), fleet, requests, concurrency, only, seed)
+    else:
+        scratch = None
+        if database is None:
+            handle, scratch = tempfile.mkstemp(suffix='.db')
+            os.close(handle)
+            os.remove(scratch)
+            database = scratch
+        app.config['TESTING'] = False
+        app.config['DATABASE'] = database
+        if no_cache:
+            app.config['METRIC_CACHE_SIZE'] = 0
+        try:
+            report = run(AppClient(), fleet, requests, concurrency, only, seed)
+        finally:
+            connections.close_all()
+            if scratch is not None:
+                for suffix in ['', '-wal', '-shm']:
+                    if os.path.exists(scratch + suffix):
+                        os.remove(scratch + suffix)
+        config['database'] = database
+
+    report['config'] = config
+    output.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+"""
+Bulk import and export of readings as NDJSON or CSV archives.
+
+Imports stream the readings of a local file, gzip compressed or not, validate them like
+the POST route does and load them in large transactions:
+
+    python bulk.py import readings-2024-01-31.ndjson.gz
+    python bulk.py import readings.csv --batch-size 100000
+
+Exports stream the readings of a device, or of every device, within an optional range:
+
+    python bulk.py export --device-uuid abc --start 1706659200 --end 1706745599 --output abc.csv.gz
+
+The format is taken from the file extension (.ndjson/.jsonl or .csv, optionally followed by .gz)
+unless --format is given. Both commands report the number of readings per second on stderr.
+"""
+import collections
+import csv
+import gzip
+import io
+import json
+import sys
+import time
+
+import click
+
+import partitions
+import rollups
+from app import READING_COLUMNS, app, connections, device_ids, validate_reading
+from db import SENSOR_TYPE_CODES, SENSOR_TYPE_NAMES, write_readings
+
+FORMATS = ['ndjson', 'csv']
+
+# How many rejected readings are printed, the others are only counted
+MAX_REPORTED_ERRORS = 10
+
+def guess_format(path):
+    """
+    Return the format of a file from its extension, ndjson unless it is a CSV file
+    """
+    name = path.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    return 'csv' if name.endswith('.csv') else 'ndjson'
+
+def open_input(path):
+    """
+    Open a local file, or stdin for '-', as text. Gzip compressed files are recognized by their magic number.
+    """
+    stream = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    if not hasattr(stream, 'peek'):
+        stream = io.BufferedReader(stream)
+    if stream.peek(2)[:2] == b'\x1f\x8b':
+        stream = gzip.GzipFile(fileobj=stream)
+    return io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+def open_output(path):
+    """
+    Open a local file, or stdout for '-', as text. Files ending with .gz are gzip compressed.
+    """
+    if path == '-':
+        return io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', newline='')
+    if path.lower().endswith('.gz'):
+        return gzip.open(path, 'wt', encoding='utf-8', newline='')
+    return open(path, 'w', encoding='utf-8', newline='')
+
+def iter_records(stream, input_format):
+    """
+    Yield the (line number, record) of every reading of a stream, the record is a dict of the
+    reading, or the error found parsing its line
+
+    :param input_format: ndjson or csv
+    :type string:
+    """
+    if input_format == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield line_number, 'invalid JSON'
+            continue
+        yield line_number, record if isinstance(record, dict) else 'reading must be an object'
+
+class Rejections:
+    """
+    Count the records rejected by an import and keep the (line number, error) of the first
+    MAX_REPORTED_ERRORS only, so a file of bad lines does not pile its errors up in memory.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.first = []
+
+    def add(self, line_number, error):
+        self.count += 1
+        if len(self.first) < MAX_REPORTED_ERRORS:
+            self.first.append((line_number, error))
+
+def validate_records(records, rejections):
+    """
+    Validate records like the POST route does and yield them as (device_uuid, type, value, date_created) tuples.
+    The rejected records are added to rejections, see Rejections.
+    """
+    now = int(time.time())
+    for line_number, record in records:
+        if not isinstance(record, dict):
+            rejections.add(line_number, record)
+            continue
+        date_created = record.get('date_created')
+        try:
+            yield validate_reading(record.get('device_uuid'), record.get('type'), record.get('value'), now if date_created in [None, ''] else date_created)
+        except ValueError as e:
+            rejections.add(line_number, str(e))
+
+def load(readings, batch_size=50000, synchronous='OFF'):
+    """
+    Insert readings in transactions of up to batch_size readings per shard, and return how many
+    were inserted. The load runs with a relaxed synchronous level, and the secondary indexes of
+    the partitions it creates are only built once every reading is in, which is much faster
+    than maintaining them row by row. Queries reading those partitions are slower until then.
+
+    :param readings: (device_uuid, type, value, date_created) tuples
+    :type iterable:
+    :param batch_size: The number of readings per transaction
+    :type int:
+    :param synchronous: The synchronous level of the load, restored to SQLITE_SYNCHRONOUS after it
+    :type string:
+    """
+    paths = connections.shard_paths()
+    for path in paths:
+        connections.writer(path).execute('PRAGMA synchronous={}'.format(synchronous))
+
+    inserted = 0
+    try:
+        batch = []
+        for reading in readings:
+            batch.append(reading)
+            if len(batch) == batch_size:
+                inserted += load_batch(batch)
+                batch = []
+        if batch:
+            inserted += load_batch(batch)
+
+        for path in paths:
+            conn = connections.writer(path)
+            with conn:
+                for name in partitions.overlapping(conn):
+                    partitions.index(conn, name)
+    finally:
+        for path in paths:
+            connections.writer(path).execute('PRAGMA synchronous={}'.format(app.config['SQLITE_SYNCHRONOUS']))
+    return inserted
+
+def load_batch(readings):
+    """
+    Insert readings, and fold them into the rollups, in a single transaction per shard
+    """
+    shards = collections.OrderedDict()
+    for reading in readings:
+        shards.setdefault(connections.shard_path(reading[0]), []).append(reading)
+
+    inserted = 0
+    for path, shard_readings in shards.items():
+        ids = device_ids.assign(path, set(reading[0] for reading in shard_readings))
+        with connections.writer(path) as conn:
+            written = write_readings(conn, shard_readings, ids, app.config['PARTITION_DAYS'], indexed=False)
+            rollups.update(conn, written)
+        inserted += len(written)
+    return inserted
+
+def export(device_uuid=None, sensor_type=None, time_range=None, chunk_size=10000):
+    """
+    Yield the (device_uuid, type, value, date_created) of the readings of a device, or of every
+    device, partition by partition and in (device, type, date_created) order within a partition.
+    Every partition is read with its own query, fetching chunk_size rows at a time.
+
+    :param device_uuid: Only export the readings of this device
+    :type string:
+    :param sensor_type: Only export the readings of this sensor type
+    :type string:
+    :param time_range: Only export the readings created within this (start, end) range
+    :type tuple:
+    """
+    paths = [connections.shard_path(device_uuid)] if device_uuid is not None else connections.shard_paths()
+    for path in paths:
+        conn = connections.reader(path)
+        query = '1'
+        params = []
+        if device_uuid is not None:
+            query += ' and device_id=?'
+            params.append(device_ids.get_one(path, device_uuid))
+        if sensor_type is not None:
+            query += ' and type_code=?'
+            params.append(SENSOR_TYPE_CODES.get(sensor_type))
+        if time_range is not None:
+            query += ' and date_created between ? and ?'
+            params.extend(time_range)
+
+        for name in partitions.overlapping(conn, time_range):
+            cur = conn.execute('select device_id, type_code, value, date_created from "{}" where {} order by device_id, type_code, date_created, seq'.format(name, query), params)
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                uuids = device_ids.uuids(path, list(set(row[0] for row in rows)))
+                for device_id, type_code, value, date_created in rows:
+                    yield (uuids[device_id], SENSOR_TYPE_NAMES[type_code], value, date_created)
+            cur.close()
+
+def dump(readings, stream, output_format):
+    """
+    Write readings to a stream as NDJSON or CSV and return how many were written
+    """
+    count = 0
+    if output_format == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(READING_COLUMNS)
+        for reading in readings:
+            writer.writerow(reading)
+            count += 1
+        return count
+
+    for reading in readings:
+        stream.write(json.dumps(dict(zip(READING_COLUMNS, reading))) + '\n')
+        count += 1
+    return count
+
+def report(action, count, seconds):
+    """
+    Print the throughput of an import or export on stderr
+    """
+    click.echo('{} {} readings in {:.1f}s ({:.0f} readings/s)'.format(action, count, seconds, count / seconds if seconds else 0), err=True)
+
+@click.group()
+def cli():
+    """
+    Bulk import and export of readings as NDJSON or CSV archives
+    """
+
+@cli.command('import')
+@click.argument('path')
+@click.option('--format', 'input_format', type=click.Choice(FORMATS), default=None, help='The format of the file, guessed from its extension by default.')
+@click.option('--batch-size', default=50000, help='Number of readings inserted per transaction.')
+@click.option('--synchronous', type=click.Choice(['OFF', 'NORMAL']), default='OFF', help='The synchronous level of the load.')
+def import_command(path, input_format, batch_size, synchronous):
+    """
+    Load the readings of PATH, '-' for stdin. Invalid readings are reported and skipped.
+    """
+    rejections = Rejections()
+    started = time.monotonic()
+    with open_input(path) as stream:
+        records = iter_records(stream, input_format or guess_format(path))
+        inserted = load(validate_records(records, rejections), batch_size, synchronous)
+    report('imported', inserted, time.monotonic() - started)
+
+    for line_number, error in rejections.first:
+        click.echo('line {}: {}'.format(line_number, error), err=True)
+    if rejections.count:
+        click.echo('{} readings rejected'.format(rejections.count), err=True)
+
+@cli.command('export')
+@click.option('--device-uuid', default=None, help='Only export the readings of this device.')
+@click.option('--type', 'sensor_type', type=click.Choice(sorted(SENSOR_TYPE_CODES)), default=None, help='Only export the readings of this sensor type.')
+@click.option('--start', type=int, default=None, help='The epoch start of the readings to export.')
+@click.option('--end', type=int, default=None, help='The epoch end of the readings to export, included.')
+@click.option('--format', 'output_format', type=click.Choice(FORMATS), default=None, help='The format of the file, guessed from its extension by default.')
+@click.option('--output', default='-', help='Where to write the readings, stdout by default.')
+def export_command(device_uuid, sensor_type, start, end, output_format, output):
+    """
+    Write the readings of a device, or of every device, within an optional range
+    """
+    if (start is None) != (end is None):
+        raise click.BadParameter('start and end must be given together')
+    time_range = (start, end) if start is not None else None
+
+    started = time.monotonic()
+    stream = open_output(output)
+    try:
+        count = dump(export(device_uuid, sensor_type, time_range), stream, output_format or guess_format(output))
+    finally:
+        if output == '-':
+            stream.flush()
+            stream.detach()
+        else:
+            stream.close()
+    report('exported', count, time.monotonic() - started)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,88 @@
+import collections
+import threading
+import time
+
+class MetricCache:
+    """
+    Keep the results of the metric endpoints in a bounded LRU cache, keyed by
+    (device_uuid, type, time range, metric).
+
+    Every entry remembers the version of its device when it was computed, the modified
+    marker the database moves forward every time readings of that device change, so an
+    entry computed before the last change is never served again, whichever process
+    made it. The cache is tuned with the following settings from the flask config:
+
+    * METRIC_CACHE_SIZE -> The number of results kept, 0 disables the cache
+    * METRIC_CACHE_TTL -> How long in seconds a result is served, 0 to keep it until it is evicted
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        """
+        Return (True, result) when a result computed at the current version of the
+        device is cached, otherwise (False, None)
+
+        :param key: (device_uuid, type, time range, metric)
+        :type tuple:
+        :param version: The modified marker of the device, read before looking the result up
+        :type int:
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_version, expires, result = entry
+                if entry_version == version and (expires is None or expires > time.monotonic()):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, result
+                del self._entries[key]
+                self.evictions += 1
+            self.misses += 1
+            return False, None
+
+    def put(self, key, version, result):
+        """
+        Cache a result computed at the given version of the device
+
+        :param key: (device_uuid, type, time range, metric)
+        :type tuple:
+        :param version: The modified marker of the device read before computing the result
+        :type int:
+        """
+        size = self.config.get('METRIC_CACHE_SIZE', 10000)
+        ttl = self.config.get('METRIC_CACHE_TTL', 60)
+        if size <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (version, time.monotonic() + ttl if ttl else None, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Drop every cached result, e.g. after the rollups were rebuilt without moving the markers
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Return the counters of the cache
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,580 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+import weakref
+import zlib
+
+from urllib.parse import quote
+
+import partitions
+import rollups
+from stats import HistogramAggregate, histogram_merge
+
+SYNCHRONOUS_LEVELS = ['OFF', 'NORMAL', 'FULL', 'EXTRA']
+
+# The codes sensor types are stored as. They are part of the stored data so a code must never change or be reused.
+SENSOR_TYPE_CODES = {'temperature': 1, 'humidity': 2}
+SENSOR_TYPE_NAMES = {code: name for name, code in SENSOR_TYPE_CODES.items()}
+
+# Readings of a device and sensor type created the same second are told apart by seq
+INSERT_READING = '''INSERT INTO "{0}" (device_id, type_code, date_created, seq, value) VALUES (?1, ?2, ?3,
+    (SELECT coalesce(max(seq) + 1, 0) FROM "{0}" WHERE device_id = ?1 AND type_code = ?2 AND date_created = ?3), ?4)'''
+
+# Every change to the readings of a device moves its modified marker forward: to the time of the change in
+# milliseconds, or past the previous marker when several changes happen within the same millisecond
+TOUCH_DEVICE = 'UPDATE devices SET modified = max(modified + 1, ?) WHERE id = ?'
+
+# The schema that predates migrations, created for new databases before they are migrated
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)',
+]
+
+def partition_readings(conn):
+    """
+    Move the readings of the single readings table into a partition per day
+    """
+    days = conn.execute('SELECT DISTINCT date_created - (date_created % {0:d} + {0:d}) % {0:d} FROM readings ORDER BY 1'.format(partitions.DAY)).fetchall()
+    for (start,) in days:
+        name = partitions.create(conn, start, start + partitions.DAY)
+        conn.execute('INSERT INTO "{0}" ({1}) SELECT {1} FROM readings WHERE type_code IN ({2}) AND date_created >= ? AND date_created < ?'.format(
+            name, partitions.COLUMNS, ','.join(str(code) for code in SENSOR_TYPE_CODES.values())), (start, start + partitions.DAY))
+
+def index_partitions(conn):
+    """
+    Create the secondary indexes missing from the partitions that were not expired
+    """
+    for name in partitions.overlapping(conn):
+        partitions.index(conn, name)
+
+# Every migration is a list of statements, or functions of the connection, applied in a single
+# transaction. The index of a migration in this list plus one is the schema version it brings
+# the database to, so new migrations must only ever be appended.
+MIGRATIONS = [
+    # 1: Covering index so the per device queries are served from an index range scan
+    [
+        'CREATE INDEX IF NOT EXISTS readings_device_type_date ON readings (device_uuid, type, date_created, value)',
+    ],
+    # 2: All time rollups per device and sensor type, built from the existing readings
+    [
+        '''CREATE TABLE rollups (device_uuid TEXT NOT NULL, type TEXT NOT NULL, count INTEGER NOT NULL, total INTEGER NOT NULL,
+            min_value INTEGER, min_date_created INTEGER, max_value INTEGER, max_date_created INTEGER, histogram BLOB NOT NULL,
+            PRIMARY KEY (device_uuid, type)) WITHOUT ROWID''',
+        '''INSERT INTO rollups (device_uuid, type, count, total, min_value, min_date_created, max_value, max_date_created, histogram)
+            SELECT device_uuid, type, count(value), sum(value), min(value), NULL, max(value), NULL, value_histogram(value)
+            FROM readings GROUP BY device_uuid, type''',
+        '''UPDATE rollups SET
+            min_date_created = (SELECT min(date_created) FROM readings r
+                WHERE r.device_uuid = rollups.device_uuid AND r.type = rollups.type AND r.value = rollups.min_value),
+            max_date_created = (SELECT min(date_created) FROM readings r
+                WHERE r.device_uuid = rollups.device_uuid AND r.type = rollups.type AND r.value = rollups.max_value)''',
+    ],
+    # 3: Day, hour and minute rollups per device and sensor type, built from the existing readings
+    [
+        '''CREATE TABLE rollup_buckets (device_uuid TEXT NOT NULL, type TEXT NOT NULL, resolution INTEGER NOT NULL, bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL, total INTEGER NOT NULL, min_value INTEGER, min_date_created INTEGER, max_value INTEGER,
+            max_date_created INTEGER, histogram BLOB NOT NULL, PRIMARY KEY (device_uuid, type, resolution, bucket)) WITHOUT ROWID''',
+    ] + [
+        '''INSERT INTO rollup_buckets (device_uuid, type, resolution, bucket, count, total, min_value, min_date_created, max_value, max_date_created, histogram)
+            SELECT device_uuid, type, {0:d}, date_created - (date_created % {0:d} + {0:d}) % {0:d} AS bucket,
+                count(value), sum(value), min(value), NULL, max(value), NULL, value_histogram(value)
+            FROM readings GROUP BY device_uuid, type, bucket'''.format(resolution) for resolution in [86400, 3600, 60]
+    ] + [
+        '''UPDATE rollup_buckets SET
+            min_date_created = (SELECT min(date_created) FROM readings r
+                WHERE r.device_uuid = rollup_buckets.device_uuid AND r.type = rollup_buckets.type
+                AND r.date_created BETWEEN bucket AND bucket + resolution - 1 AND r.value = rollup_buckets.min_value),
+            max_date_created = (SELECT min(date_created) FROM readings r
+                WHERE r.device_uuid = rollup_buckets.device_uuid AND r.type = rollup_buckets.type
+                AND r.date_created BETWEEN bucket AND bucket + resolution - 1 AND r.value = rollup_buckets.max_value)''',
+    ],
+    # 4: Index matching the (date_created, rowid) order the readings of a device are paginated in
+    [
+        'CREATE INDEX IF NOT EXISTS readings_device_date ON readings (device_uuid, date_created)',
+    ],
+    # 5: Indexes serving the range queries over every device of the fleet endpoints
+    [
+        'CREATE INDEX IF NOT EXISTS readings_type_date ON readings (type, date_created, device_uuid, value)',
+        'CREATE INDEX IF NOT EXISTS rollup_buckets_type_bucket ON rollup_buckets (type, resolution, bucket)',
+    ],
+    # 6: Compact readings referring to their device by an integer id and to their sensor type by its code,
+    #    clustered by device, type and date so the readings of a device are stored together
+    [
+        'CREATE TABLE devices (id INTEGER PRIMARY KEY, device_uuid TEXT NOT NULL UNIQUE)',
+        'INSERT INTO devices (device_uuid) SELECT DISTINCT device_uuid FROM readings ORDER BY device_uuid',
+        '''CREATE TABLE compact_readings (device_id INTEGER NOT NULL, type_code INTEGER NOT NULL, date_created INTEGER NOT NULL,
+            seq INTEGER NOT NULL, value INTEGER NOT NULL, PRIMARY KEY (device_id, type_code, date_created, seq)) WITHOUT ROWID''',
+        '''INSERT INTO compact_readings (device_id, type_code, date_created, seq, value)
+            SELECT d.id, type_code(r.type), r.date_created,
+                row_number() OVER (PARTITION BY r.device_uuid, r.type, r.date_created ORDER BY r.rowid) - 1, r.value
+            FROM readings r JOIN devices d ON d.device_uuid = r.device_uuid''',
+        'DROP TABLE readings',
+        'ALTER TABLE compact_readings RENAME TO readings',
+        'CREATE INDEX readings_device_date ON readings (device_id, date_created)',
+        'CREATE INDEX readings_type_date ON readings (type_code, date_created, device_id, value)',
+    ],
+    # 7: Readings split into a table per day so expiring old readings drops a table instead of deleting rows
+    [
+        partitions.CATALOGUE,
+        partition_readings,
+        'DROP TABLE readings',
+    ],
+    # 8: Marker of the last change to the readings of every device, validating the responses of its routes
+    [
+        'ALTER TABLE devices ADD COLUMN modified INTEGER NOT NULL DEFAULT 0',
+        "UPDATE devices SET modified = CAST(strftime('%s', 'now') AS INTEGER) * 1000",
+    ],
+    # 9: Index of the partitions by device, type and value serving the lookup of the median reading
+    [
+        index_partitions,
+    ],
+]
+
+def shard_index(device_uuid, shards):
+    """
+    Return the shard holding the readings of a device. The hash must stay stable across
+    processes and releases since it decides which file the readings were written to.
+
+    :param device_uuid: The uuid of the device
+    :type string:
+    :param shards: The number of shards
+    :type int:
+    """
+    return zlib.crc32(device_uuid.encode('utf-8')) % shards
+
+def shard_file(path, index, shards):
+    """
+    Return the file of a shard, e.g. database.2-of-8.db for the third of eight shards of
+    database.db. A single shard is the database file itself.
+
+    :param path: The database file
+    :type string:
+    :param index: The shard, between 0 and shards - 1
+    :type int:
+    :param shards: The number of shards
+    :type int:
+    """
+    if shards == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return '{}.{}-of-{}{}'.format(root, index, shards, ext)
+
+def register_functions(conn):
+    """
+    Register the SQL functions used to maintain the rollups, and translate sensor types, on a connection
+    """
+    conn.create_function('histogram_merge', 2, histogram_merge, deterministic=True)
+    conn.create_aggregate('value_histogram', 1, HistogramAggregate)
+    conn.create_function('type_code', 1, SENSOR_TYPE_CODES.get, deterministic=True)
+    conn.create_function('type_name', 1, SENSOR_TYPE_NAMES.get, deterministic=True)
+
+def write_readings(conn, readings, device_ids, partition_days=1, indexed=True):
+    """
+    Insert readings into the partitions of their date_created, and move the modified marker of
+    their devices forward, in the transaction of conn.
+    Returns the readings inserted, readings created before the retention horizon are left out.
+
+    :param conn: A read-write connection
+    :type sqlite3.Connection:
+    :param readings: (device_uuid, type, value, date_created) tuples
+    :type list:
+    :param device_ids: The {device_uuid: id} of the devices of the readings, see DeviceIds.assign
+    :type dict:
+    :param partition_days: The number of days covered by a new partition
+    :type int:
+    :param indexed: Whether to create the secondary indexes of new partitions, see partitions.create
+    :type bool:
+    """
+    # Hold the write lock while the catalogue is read, or two writers could both create the partition of a new day
+    if not conn.in_transaction:
+        conn.execute('BEGIN IMMEDIATE')
+    written = []
+    for name, partition_readings in partitions.route(conn, readings, partition_days, indexed).items():
+        conn.executemany(INSERT_READING.format(name), [(device_ids[device_uuid], SENSOR_TYPE_CODES[sensor_type], date_created, value)
+                                                       for device_uuid, sensor_type, value, date_created in partition_readings])
+        written.extend(partition_readings)
+    modified = int(time.time() * 1000)
+    conn.executemany(TOUCH_DEVICE, [(modified, device_id) for device_id in sorted(set(device_ids[reading[0]] for reading in written))])
+    return written
+
+def migrate(conn):
+    """
+    Create the schema if needed and apply the migrations the database has not seen yet.
+    The schema version is tracked with PRAGMA user_version and returned.
+
+    :param conn: A read-write connection to the database
+    :type sqlite3.Connection:
+    """
+    register_functions(conn)
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version == 0:
+        for statement in SCHEMA:
+            conn.execute(statement)
+
+    while version < len(MIGRATIONS):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Another process could have migrated while we were waiting for the lock
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version < len(MIGRATIONS):
+                for statement in MIGRATIONS[version]:
+                    if callable(statement):
+                        statement(conn)
+                    else:
+                        conn.execute(statement)
+                version += 1
+                conn.execute('PRAGMA user_version = {:d}'.format(version))
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+    return version
+
+class ThreadConnections:
+    """
+    The read-write and read-only connections of a thread, by database file
+    """
+
+    def __init__(self):
+        self.writers = {}
+        self.readers = {}
+
+class ConnectionManager:
+    """
+    Keep long lived SQLite connections open and reuse them across requests.
+
+    Every thread gets its own read-write connection and its own read-only connection
+    per database file so connections are never shared between threads, and they are closed
+    once the thread exits. A database file is only migrated by the first connection opened to it. The connections
+    are opened in WAL mode so readers do not block the writer (and vice versa), and
+    tuned with the following settings from the flask config:
+
+    * DATABASE -> The database file used in production
+    * TEST_DATABASE -> The database file used when TESTING is set
+    * SHARDS -> The number of files the readings are split into by device, see shard_file
+    * SQLITE_SYNCHRONOUS -> The synchronous level (OFF, NORMAL, FULL or EXTRA)
+    * SQLITE_MMAP_SIZE -> The number of bytes of the database to memory map for reads
+    * SQLITE_BUSY_TIMEOUT -> How long in milliseconds to wait on a locked database
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._lock = threading.Lock()
+        self._reset()
+        atexit.register(self.close_all)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._local = threading.local()
+        self._connections = []
+        self._migrated = set()
+
+    def path(self):
+        """
+        Return the database file to use, the test database is used when TESTING is set
+        """
+        if self.config.get('TESTING'):
+            return self.config.get('TEST_DATABASE', 'test_database.db')
+        return self.config.get('DATABASE', 'database.db')
+
+    def shards(self):
+        """
+        Return the number of shards
+        """
+        return int(self.config.get('SHARDS', 1))
+
+    def shard_paths(self, shards=None):
+        """
+        Return the file of every shard
+
+        :param shards: The number of shards, defaults to the configured number
+        :type int:
+        """
+        shards = shards or self.shards()
+        return [shard_file(self.path(), index, shards) for index in range(shards)]
+
+    def shard_path(self, device_uuid):
+        """
+        Return the file of the shard holding the readings of a device
+
+        :param device_uuid: The uuid of the device
+        :type string:
+        """
+        shards = self.shards()
+        return shard_file(self.path(), shard_index(device_uuid, shards), shards)
+
+    def writer(self, path=None):
+        """
+        Return the read-write connection of the current thread
+
+        :param path: The database file, defaults to the configured database
+        :type string:
+        """
+        return self._get('writers', path or self.path())
+
+    def reader(self, path=None):
+        """
+        Return the read-only connection of the current thread
+
+        :param path: The database file, defaults to the configured database
+        :type string:
+        """
+        return self._get('readers', path or self.path())
+
+    def close_all(self):
+        """
+        Close every connection opened by this manager, from any thread
+        """
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._local = threading.local()
+            self._migrated = set()
+        if self._pid != os.getpid():
+            # Connections inherited from the parent process belong to the parent
+            return
+        for conn in connections:
+            conn.close()
+
+    def _get(self, kind, path):
+        # Connections must never cross a fork, start over in the child process
+        if self._pid != os.getpid():
+            with self._lock:
+                self._reset()
+
+        opened = getattr(self._local, 'opened', None)
+        if opened is None:
+            opened = self._local.opened = ThreadConnections()
+            # The thread-local is cleared when its thread exits, close the connections of the thread then
+            weakref.finalize(opened, self._release, opened.writers, opened.readers)
+
+        connections = getattr(opened, kind)
+        conn = connections.get(path)
+        if conn is None:
+            if kind == 'writers':
+                conn = self._open_writer(path)
+            else:
+                conn = self._open_reader(path)
+            connections[path] = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _release(self, *groups):
+        # Only close the connections still owned by this manager, not those already closed
+        # by close_all or inherited from the parent process
+        with self._lock:
+            released = [conn for connections in groups for conn in connections.values() if conn in self._connections]
+            for conn in released:
+                self._connections.remove(conn)
+        for conn in released:
+            conn.close()
+
+    def _open_writer(self, path):
+        synchronous = str(self.config.get('SQLITE_SYNCHRONOUS', 'NORMAL')).upper()
+        if synchronous not in SYNCHRONOUS_LEVELS:
+            raise ValueError('synchronous level {} not supported'.format(synchronous))
+
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous={}'.format(synchronous))
+        self._tune(conn)
+        if path not in self._migrated:
+            migrate(conn)
+            with self._lock:
+                self._migrated.add(path)
+        return conn
+
+    def _open_reader(self, path):
+        # A read-only connection can not create the database file or its schema, so
+        # let the writer create and migrate it (and switch it to WAL) first
+        self.writer(path)
+
+        conn = sqlite3.connect('file:{}?mode=ro'.format(quote(os.path.abspath(path))), uri=True, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        self._tune(conn)
+        return conn
+
+    def _tune(self, conn):
+        register_functions(conn)
+        conn.execute('PRAGMA mmap_size={:d}'.format(int(self.config.get('SQLITE_MMAP_SIZE', 0))))
+        conn.execute('PRAGMA busy_timeout={:d}'.format(int(self.config.get('SQLITE_BUSY_TIMEOUT', 5000))))
+
+class DeviceIds:
+    """
+    Keep the integer ids the devices of every shard are stored as in memory, so uuids are
+    resolved without touching the devices table once a device has been seen. The id of a
+    device never changes once it is committed, so the cache never needs to be invalidated
+    unless the database itself is replaced.
+    """
+
+    def __init__(self, connections):
+        self.connections = connections
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """
+        Forget every id, e.g. after the database files were replaced
+        """
+        with self._lock:
+            self._ids = {}
+            self._uuids = {}
+
+    def get(self, path, device_uuids):
+        """
+        Return the {device_uuid: id} of the devices of a shard, devices without readings are left out
+
+        :param path: The shard of the devices
+        :type string:
+        :param device_uuids: The uuids of the devices
+        :type iterable:
+        """
+        with self._lock:
+            ids = self._ids.get(path, {})
+            found = {device_uuid: ids[device_uuid] for device_uuid in device_uuids if device_uuid in ids}
+        missing = [device_uuid for device_uuid in device_uuids if device_uuid not in found]
+        if missing:
+            found.update(self._load(self.connections.reader(path), path, 'device_uuid', missing))
+        return found
+
+    def get_one(self, path, device_uuid):
+        """
+        Return the id of a device of a shard, or None when it has no readings
+        """
+        return self.get(path, [device_uuid]).get(device_uuid)
+
+    def assign(self, path, device_uuids):
+        """
+        Return the {device_uuid: id} of the devices of a shard, adding the devices that are not
+        stored yet in their own transaction. An id is only ever cached once it is committed,
+        so it can not be handed out again by a transaction that was rolled back.
+
+        :param path: The shard of the devices
+        :type string:
+        :param device_uuids: The uuids of the devices
+        :type iterable:
+        """
+        device_uuids = list(device_uuids)
+        ids = self.get(path, device_uuids)
+        missing = [device_uuid for device_uuid in device_uuids if device_uuid not in ids]
+        if missing:
+            conn = self.connections.writer(path)
+            with conn:
+                conn.executemany('INSERT OR IGNORE INTO devices (device_uuid) VALUES (?)', [(device_uuid,) for device_uuid in missing])
+            ids.update(self._load(conn, path, 'device_uuid', missing))
+        return ids
+
+    def uuids(self, path, ids):
+        """
+        Return the {id: device_uuid} of device ids of a shard
+
+        :param path: The shard of the devices
+        :type string:
+        :param ids: The ids of the devices
+        :type iterable:
+        """
+        with self._lock:
+            uuids = self._uuids.get(path, {})
+            found = {device_id: uuids[device_id] for device_id in ids if device_id in uuids}
+        missing = [device_id for device_id in ids if device_id not in found]
+        if missing:
+            loaded = self._load(self.connections.reader(path), path, 'id', missing)
+            found.update({device_id: device_uuid for device_uuid, device_id in loaded.items()})
+        return found
+
+    def _load(self, conn, path, column, keys):
+        rows = conn.execute('SELECT device_uuid, id FROM devices WHERE {} IN (SELECT value FROM json_each(?))'.format(column),
+                            [json.dumps(keys)]).fetchall()
+        with self._lock:
+            ids = self._ids.setdefault(path, {})
+            uuids = self._uuids.setdefault(path, {})
+            for device_uuid, device_id in rows:
+                ids[device_uuid] = device_id
+                uuids[device_id] = device_uuid
+        return {device_uuid: device_id for device_uuid, device_id in rows}
+
+def reshard(connections, shards, chunk_size=10000):
+    """
+    Copy the readings of the configured shards into the files of a new number of shards,
+    and build their rollups. This is an offline operation: nothing must write to the
+    database meanwhile. The old files are left untouched so SHARDS can be switched
+    over once the copy is done. Returns the new shard files.
+    Raises a ValueError if one of the new files already exists.
+
+    :param connections: The connections to the database
+    :type ConnectionManager:
+    :param shards: The new number of shards
+    :type int:
+    :param chunk_size: The number of readings copied per transaction
+    :type int:
+    """
+    sources = connections.shard_paths()
+    targets = connections.shard_paths(shards)
+    if sources == targets:
+        return targets
+    for target in targets:
+        if os.path.exists(target):
+            raise ValueError('shard {} already exists'.format(target))
+
+    device_ids = DeviceIds(connections)
+    partition_days = int(connections.config.get('PARTITION_DAYS', 1))
+    for source in sources:
+        conn = connections.reader(source)
+        cur = conn.execute('''select (select device_uuid from devices d where d.id = r.device_id), type_name(r.type_code), r.value, r.date_created
+            from {} r order by r.date_created, r.device_id, r.type_code, r.seq'''.format(partitions.source(partitions.overlapping(conn))))
+        while True:
+            readings = cur.fetchmany(chunk_size)
+            if not readings:
+                break
+            by_shard = {}
+            for reading in readings:
+                by_shard.setdefault(targets[shard_index(reading[0], shards)], []).append(tuple(reading))
+            for target, shard_readings in by_shard.items():
+                ids = device_ids.assign(target, set(reading[0] for reading in shard_readings))
+                with connections.writer(target) as conn:
+                    write_readings(conn, shard_readings, ids, partition_days)
+        cur.close()
+
+    for target in targets:
+        rollups.rebuild(connections.writer(target))
+    return targets
+
+def expire(connections, retention_days, now=None, batch_size=10000):
+    """
+    Drop the partitions of every shard whose readings were all created more than retention_days
+    ago. Each partition is dropped, and removed from the all time rollups, in a transaction of
+    its own which only reads its day rollups, however many readings it holds. The bucketed
+    rollups left behind are deleted afterwards in transactions of batch_size rows so ingestion
+    is never blocked for long. Returns the names of the partitions dropped.
+
+    :param connections: The connections to the database
+    :type ConnectionManager:
+    :param retention_days: How many days of readings to keep
+    :type int:
+    :param now: The epoch date the retention period is counted back from, defaults to now
+    :type int:
+    :param batch_size: The number of bucketed rollups deleted per transaction
+    :type int:
+    """
+    before = int(time.time() if now is None else now) - retention_days * partitions.DAY
+    dropped = []
+    for path in connections.shard_paths():
+        conn = connections.writer(path)
+        for name, start, stop in partitions.expirable(conn, before):
+            with conn:
+                # The day rollups of the partition tell which devices had readings in it
+                modified = int(time.time() * 1000)
+                for sensor_type in SENSOR_TYPE_CODES:
+                    conn.execute('''UPDATE devices SET modified = max(modified + 1, ?) WHERE device_uuid IN (
+                        SELECT device_uuid FROM rollup_buckets WHERE type = ? AND resolution = ? AND bucket >= ? AND bucket < ?)''',
+                                 (modified, sensor_type, rollups.RESOLUTIONS[0], start, stop))
+                partitions.drop(conn, name)
+                rollups.subtract(conn, list(SENSOR_TYPE_CODES), start, stop)
+            dropped.append(name)
+        horizon = partitions.horizon(conn)
+        if horizon is not None:
+            rollups.delete_buckets(conn, list(SENSOR_TYPE_CODES), horizon, batch_size)
+    return dropped
@@ -0,0 +1,203 @@
+import atexit
+import collections
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# How many times a batch is tried once the buffer is closed before giving up on it
+SHUTDOWN_ATTEMPTS = 3
+
+class BufferFull(Exception):
+    """
+    Raised when the write-behind buffer can not accept more readings
+    """
+
+class WriteBehindBuffer:
+    """
+    Accept validated readings into a bounded in-memory queue and insert them from a
+    background thread in large batches, committing every INGEST_BATCH_SIZE readings or
+    every INGEST_FLUSH_INTERVAL milliseconds, whichever comes first (group commit).
+
+    The buffer is tuned with the following settings from the flask config:
+
+    * INGEST_QUEUE_SIZE -> The number of readings the queue holds before refusing more
+    * INGEST_BATCH_SIZE -> The maximum number of readings inserted per transaction
+    * INGEST_FLUSH_INTERVAL -> How long in milliseconds readings wait for a batch to fill up
+    * INGEST_MAX_ATTEMPTS -> How many times a batch is tried before looking for the readings failing it
+
+    Readings that could not be inserted are put back at the front of the queue and
+    retried, so a struggling database shows up as backpressure (BufferFull) instead
+    of lost readings. A batch failing INGEST_MAX_ATTEMPTS times is flushed in halves,
+    down to single readings, and the readings that still fail are logged and dropped
+    so they can not hold up the queue. Whatever is left in the queue is flushed when
+    the process exits.
+    """
+
+    def __init__(self, config, flush):
+        """
+        :param config: The flask config
+        :type dict:
+        :param flush: Called from the background thread with each batch of readings to insert
+        :type callable:
+        """
+        self.config = config
+        self.flush = flush
+        self._condition = threading.Condition()
+        self._reset()
+        atexit.register(self.close)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._readings = collections.deque()
+        self._in_flight = 0
+        self._thread = None
+        self._closed = False
+        self.accepted = 0
+        self.rejected = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.failures = 0
+        self.dropped = 0
+        self.flush_seconds = 0.0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+    def submit(self, readings):
+        """
+        Queue readings to be inserted, all or none of them.
+        Raises BufferFull when the queue does not have room for every reading.
+
+        :param readings: (device_uuid, type, value, date_created) tuples
+        :type list:
+        """
+        with self._condition:
+            # The queue and writer thread of a parent process do not survive a fork
+            if self._pid != os.getpid():
+                self._reset()
+
+            capacity = self.config.get('INGEST_QUEUE_SIZE', 100000)
+            if self._closed or len(self._readings) + len(readings) > capacity:
+                self.rejected += len(readings)
+                raise BufferFull('ingestion queue is full, retry later')
+
+            was_empty = not self._readings
+            self._readings.extend(readings)
+            self.accepted += len(readings)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+            # Wake the writer up when it waits for readings, then again once a batch is full
+            if was_empty or len(self._readings) >= self.config.get('INGEST_BATCH_SIZE', 1000):
+                self._condition.notify()
+
+    def close(self):
+        """
+        Stop accepting readings, flush the queue and wait for the writer thread to finish
+        """
+        with self._condition:
+            if self._pid != os.getpid():
+                return
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def stats(self):
+        """
+        Return the counters of the buffer
+        """
+        with self._condition:
+            return {
+                'queue_depth': len(self._readings),
+                'in_flight': self._in_flight,
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+                'flushed': self.flushed,
+                'flushes': self.flushes,
+                'failures': self.failures,
+                'dropped': self.dropped,
+                'flush_seconds': self.flush_seconds,
+                'last_flush_seconds': self.last_flush_seconds,
+                'max_flush_seconds': self.max_flush_seconds,
+            }
+
+    def _run(self):
+        attempts = 0
+        while True:
+            batch_size = self.config.get('INGEST_BATCH_SIZE', 1000)
+            interval = self.config.get('INGEST_FLUSH_INTERVAL', 50) / 1000
+
+            with self._condition:
+                while not self._readings and not self._closed:
+                    self._condition.wait()
+                # Give the batch a chance to fill up, submit wakes us up early once it has
+                if not self._closed and len(self._readings) < batch_size:
+                    self._condition.wait(interval)
+                if not self._readings:
+                    return
+                batch = [self._readings.popleft() for i in range(min(batch_size, len(self._readings)))]
+                self._in_flight = len(batch)
+                closed = self._closed
+
+            try:
+                self._flush(batch)
+            except Exception:
+                attempts += 1
+                with self._condition:
+                    self.failures += 1
+                    self._in_flight = 0
+                    if closed and attempts >= SHUTDOWN_ATTEMPTS:
+                        logger.exception('Dropping %d readings that could not be flushed on shutdown', len(batch) + len(self._readings))
+                        self._readings.clear()
+                        return
+                    retry = attempts < self.config.get('INGEST_MAX_ATTEMPTS', 5)
+                    if retry:
+                        logger.exception('Failed to flush %d readings, retrying', len(batch))
+                        self._readings.extendleft(reversed(batch))
+                if retry:
+                    time.sleep(interval)
+                    continue
+                # The batch probably holds readings that can never be stored, find them instead of wedging the queue
+                logger.exception('Failed to flush %d readings %d times, flushing them in halves', len(batch), attempts)
+                self._isolate(batch)
+            attempts = 0
+            with self._condition:
+                self._in_flight = 0
+
+    def _flush(self, batch):
+        """
+        Flush a batch and record its latency
+        """
+        start = time.monotonic()
+        self.flush(batch)
+        elapsed = time.monotonic() - start
+        with self._condition:
+            self.flushed += len(batch)
+            self.flushes += 1
+            self.flush_seconds += elapsed
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+
+    def _isolate(self, batch):
+        """
+        Flush a batch that kept failing in halves, splitting the halves that fail again
+        down to single readings, and drop the readings that can not be flushed on their own
+        """
+        middle = len(batch) // 2
+        for half in [batch[:middle], batch[middle:]]:
+            if not half:
+                continue
+            try:
+                self._flush(half)
+            except Exception:
+                if len(half) > 1:
+                    self._isolate(half)
+                    continue
+                logger.exception('Dropping reading %r that could not be flushed', half[0])
+                with self._condition:
+                    self.failures += 1
+                    self.dropped += 1
@@ -0,0 +1,143 @@
+import bisect
+import time
+
+DAY = 86400
+
+# Every partition of the readings is a table covering the [start, stop) range of date_created. Expired
+# partitions are dropped but stay in the catalogue, they mark the horizon older readings are refused before.
+CATALOGUE = '''CREATE TABLE IF NOT EXISTS partitions (name TEXT PRIMARY KEY, start INTEGER NOT NULL, stop INTEGER NOT NULL,
+    expired INTEGER NOT NULL DEFAULT 0)'''
+
+COLUMNS = 'device_id, type_code, date_created, seq, value'
+
+# The source of the readings when no partition overlaps the requested range
+EMPTY = '(SELECT NULL AS device_id, NULL AS type_code, NULL AS date_created, NULL AS seq, NULL AS value WHERE 0)'
+
+# SQLite refuses compound selects of more than 500 terms, so larger unions are nested in groups
+UNION_SIZE = 100
+
+def partition_name(start):
+    """
+    Return the name of the table of the partition starting at start, e.g. readings_20240131
+    """
+    return 'readings_' + time.strftime('%Y%m%d', time.gmtime(start))
+
+def create(conn, start, stop, indexed=True):
+    """
+    Create the table of a partition, and register it in the catalogue, in the transaction of conn.
+    The readings of a device are clustered by type and date like the unpartitioned table was.
+
+    :param start: The epoch start of the partition, a multiple of a day
+    :type int:
+    :param stop: The epoch end of the partition, excluded
+    :type int:
+    :param indexed: Whether to create the secondary indexes now, or later with index
+    :type bool:
+    """
+    name = partition_name(start)
+    # Registering it first opens the transaction, so the table is never created without its catalogue entry
+    conn.execute('INSERT INTO partitions (name, start, stop) VALUES (?,?,?)', (name, start, stop))
+    conn.execute('''CREATE TABLE "{}" (device_id INTEGER NOT NULL, type_code INTEGER NOT NULL, date_created INTEGER NOT NULL,
+        seq INTEGER NOT NULL, value INTEGER NOT NULL, PRIMARY KEY (device_id, type_code, date_created, seq)) WITHOUT ROWID'''.format(name))
+    if indexed:
+        index(conn, name)
+    return name
+
+def index(conn, name):
+    """
+    Create the secondary indexes of a partition when they do not exist yet
+    """
+    conn.execute('CREATE INDEX IF NOT EXISTS "{0}_device_date" ON "{0}" (device_id, date_created)'.format(name))
+    conn.execute('CREATE INDEX IF NOT EXISTS "{0}_type_date" ON "{0}" (type_code, date_created, device_id, value)'.format(name))
+    # Finds the reading at the median rank among the readings of a device holding the median value with a single seek
+    conn.execute('CREATE INDEX IF NOT EXISTS "{0}_device_value" ON "{0}" (device_id, type_code, value, date_created)'.format(name))
+
+def route(conn, readings, days=1, indexed=True):
+    """
+    Group readings by the partition of their date_created, creating the partitions they need
+    in the transaction of conn. Readings created before the horizon are left out, their
+    partition was already expired. Returns {partition name: readings}.
+
+    :param readings: (device_uuid, type, value, date_created) tuples
+    :type list:
+    :param days: The number of days covered by a new partition
+    :type int:
+    :param indexed: Whether to create the secondary indexes of new partitions, see create
+    :type bool:
+    """
+    rows = [tuple(row) for row in conn.execute('SELECT name, start, stop, expired FROM partitions ORDER BY start')]
+    starts = [row[1] for row in rows]
+    expired = [row[2] for row in rows if row[3]]
+    horizon = max(expired) if expired else None
+
+    routed = {}
+    for reading in readings:
+        date_created = reading[3]
+        if horizon is not None and date_created < horizon:
+            continue
+        position = bisect.bisect_right(starts, date_created) - 1
+        if position < 0 or rows[position][2] <= date_created:
+            # Partitions are aligned on their width, and cut short by their neighbours when the width changed
+            width = days * DAY
+            start = date_created - date_created % width
+            stop = start + width
+            if position >= 0:
+                start = max(start, rows[position][2])
+            if position + 1 < len(rows):
+                stop = min(stop, rows[position + 1][1])
+            position += 1
+            rows.insert(position, (create(conn, start, stop, indexed), start, stop, 0))
+            starts.insert(position, start)
+        routed.setdefault(rows[position][0], []).append(reading)
+    return routed
+
+def overlapping(conn, time_range=None):
+    """
+    Return the names of the partitions that were not expired holding readings created within time_range, oldest first
+
+    :param time_range: The (start, end) range, end included, None for every partition
+    :type tuple:
+    """
+    query = 'SELECT name FROM partitions WHERE NOT expired'
+    params = []
+    if time_range is not None:
+        query += ' AND stop > ? AND start <= ?'
+        params.extend(time_range)
+    return [row[0] for row in conn.execute(query + ' ORDER BY start', params)]
+
+def horizon(conn):
+    """
+    Return the date before which every partition was expired, or None when none was
+    """
+    return conn.execute('SELECT max(stop) FROM partitions WHERE expired').fetchone()[0]
+
+def expirable(conn, before):
+    """
+    Return the (name, start, stop) of the partitions whose readings were all created before a date, oldest first
+    """
+    return [tuple(row) for row in conn.execute('SELECT name, start, stop FROM partitions WHERE NOT expired AND stop <= ? ORDER BY start', (before,))]
+
+def drop(conn, name):
+    """
+    Drop the table of a partition in the transaction of conn and mark it as expired in the catalogue
+    """
+    conn.execute('UPDATE partitions SET expired = 1 WHERE name = ?', (name,))
+    conn.execute('DROP TABLE IF EXISTS "{}"'.format(name))
+
+def source(names):
+    """
+    Return the SQL source of the readings of partitions: the table of a single partition or
+    the union of their tables. SQLite pushes the where clause down into every table of the
+    union and merges their ordered results, so each table is still read with an index search.
+
+    :param names: The names of the partitions, oldest first
+    :type list:
+    """
+    if not names:
+        return EMPTY
+    if len(names) == 1:
+        return '"{}"'.format(names[0])
+    if len(names) > UNION_SIZE:
+        return '(' + ' UNION ALL '.join('SELECT {} FROM {}'.format(COLUMNS, source(names[i:i + UNION_SIZE]))
+                                        for i in range(0, len(names), UNION_SIZE)) + ')'
+    return '(' + ' UNION ALL '.join('SELECT {} FROM "{}"'.format(COLUMNS, name) for name in names) + ')'
@@ -0,0 +1,192 @@
+import partitions
+from stats import Summary
+
+# The bucket sizes (in seconds) of the time bucketed rollups, largest first: day, hour and minute
+RESOLUTIONS = [86400, 3600, 60]
+
+SUMMARY_COLUMNS = 'count, total, min_value, min_date_created, max_value, max_date_created, histogram'
+
+# Merge the summary being inserted (excluded) into the existing rollup row. SQLite evaluates
+# every expression against the row as it was before the update.
+MERGE_SUMMARY = '''
+    count = count + excluded.count,
+    total = total + excluded.total,
+    min_date_created = CASE WHEN min_value IS NULL OR excluded.min_value < min_value
+        OR (excluded.min_value = min_value AND excluded.min_date_created < min_date_created)
+        THEN excluded.min_date_created ELSE min_date_created END,
+    min_value = CASE WHEN min_value IS NULL OR excluded.min_value < min_value THEN excluded.min_value ELSE min_value END,
+    max_date_created = CASE WHEN max_value IS NULL OR excluded.max_value > max_value
+        OR (excluded.max_value = max_value AND excluded.max_date_created < max_date_created)
+        THEN excluded.max_date_created ELSE max_date_created END,
+    max_value = CASE WHEN max_value IS NULL OR excluded.max_value > max_value THEN excluded.max_value ELSE max_value END,
+    histogram = histogram_merge(histogram, excluded.histogram)'''
+
+UPSERT_ROLLUP = '''INSERT INTO rollups (device_uuid, type, {}) VALUES (?,?,?,?,?,?,?,?,?)
+ON CONFLICT (device_uuid, type) DO UPDATE SET {}'''.format(SUMMARY_COLUMNS, MERGE_SUMMARY)
+
+UPSERT_BUCKET = '''INSERT INTO rollup_buckets (device_uuid, type, resolution, bucket, {}) VALUES (?,?,?,?,?,?,?,?,?,?,?)
+ON CONFLICT (device_uuid, type, resolution, bucket) DO UPDATE SET {}'''.format(SUMMARY_COLUMNS, MERGE_SUMMARY)
+
+# Summarize the readings of a partition into the buckets of a resolution, along with the earliest reading of their min and max values
+REBUILD_BUCKETS = '''INSERT INTO rollup_buckets (device_uuid, type, resolution, bucket, {1})
+    SELECT (SELECT device_uuid FROM devices d WHERE d.id = g.device_id), type_name(g.type_code), {2:d}, g.bucket, g.count, g.total,
+        g.min_value, (SELECT min(date_created) FROM "{0}" r WHERE r.device_id = g.device_id AND r.type_code = g.type_code
+            AND r.date_created BETWEEN g.bucket AND g.bucket + {2:d} - 1 AND r.value = g.min_value),
+        g.max_value, (SELECT min(date_created) FROM "{0}" r WHERE r.device_id = g.device_id AND r.type_code = g.type_code
+            AND r.date_created BETWEEN g.bucket AND g.bucket + {2:d} - 1 AND r.value = g.max_value),
+        g.histogram
+    FROM (SELECT device_id, type_code, date_created - (date_created % {2:d} + {2:d}) % {2:d} AS bucket, count(value) AS count,
+        sum(value) AS total, min(value) AS min_value, max(value) AS max_value, value_histogram(value) AS histogram
+        FROM "{0}" GROUP BY device_id, type_code, bucket) g'''
+
+# Every reading is counted in exactly one day bucket, so merging the day buckets gives the all time rollups
+REBUILD_ROLLUPS = '''INSERT INTO rollups (device_uuid, type, {0}) SELECT device_uuid, type, {0} FROM rollup_buckets WHERE resolution = {1:d}
+ON CONFLICT (device_uuid, type) DO UPDATE SET {2}'''.format(SUMMARY_COLUMNS, RESOLUTIONS[0], MERGE_SUMMARY)
+
+DELETE_BUCKETS = '''DELETE FROM rollup_buckets WHERE (device_uuid, type, resolution, bucket) IN (
+    SELECT device_uuid, type, resolution, bucket FROM rollup_buckets WHERE type = ? AND resolution = ? AND bucket < ? LIMIT ?)'''
+
+def bucket_start(date_created, resolution):
+    """
+    Return the start of the bucket of the given resolution holding date_created
+    """
+    return date_created - date_created % resolution
+
+def summarize(readings, resolution=None):
+    """
+    Summarize readings per device and sensor type, and per bucket when a resolution is given
+
+    :param readings: (device_uuid, type, value, date_created) tuples
+    :type iterable:
+    :param resolution: The size of the buckets in seconds
+    :type int:
+    """
+    summaries = {}
+    for device_uuid, sensor_type, value, date_created in readings:
+        if resolution is None:
+            key = (device_uuid, sensor_type)
+        else:
+            key = (device_uuid, sensor_type, resolution, bucket_start(date_created, resolution))
+        if key not in summaries:
+            summaries[key] = Summary()
+        summaries[key].add(value, date_created)
+    return summaries
+
+def plan(start, end, resolutions=RESOLUTIONS):
+    """
+    Split the [start, end] range into the buckets it fully covers, using the largest
+    buckets first, and the edges left over that have to be read from the readings table.
+    Returns (buckets, edges) where buckets are (resolution, first bucket, last bucket)
+    and edges are (start, end) ranges.
+
+    :param start: The epoch start of the range
+    :type int:
+    :param end: The epoch end of the range, included
+    :type int:
+    """
+    if start > end:
+        return [], []
+    if not resolutions:
+        return [], [(start, end)]
+
+    resolution = resolutions[0]
+    first = -(-start // resolution) * resolution
+    last = (end + 1) // resolution * resolution - resolution
+    if first > last:
+        return plan(start, end, resolutions[1:])
+
+    before = plan(start, first - 1, resolutions[1:])
+    after = plan(last + resolution, end, resolutions[1:])
+    return before[0] + [(resolution, first, last)] + after[0], before[1] + after[1]
+
+def update(conn, readings):
+    """
+    Fold newly inserted readings into the rollups. This must run in the transaction
+    inserting the readings so the rollups never disagree with the readings table.
+
+    :param conn: The read-write connection the readings are inserted with
+    :type sqlite3.Connection:
+    :param readings: (device_uuid, type, value, date_created) tuples
+    :type list:
+    """
+    conn.executemany(UPSERT_ROLLUP, [key + summary.to_row() for key, summary in summarize(readings).items()])
+    for resolution in RESOLUTIONS:
+        conn.executemany(UPSERT_BUCKET, [key + summary.to_row() for key, summary in summarize(readings, resolution).items()])
+
+def subtract(conn, sensor_types, start, stop):
+    """
+    Remove the readings created within [start, stop) from the all time rollups. Only the day
+    rollups of the range are read, so this costs the same however many readings it held.
+    This must run in the transaction dropping those readings.
+
+    :param conn: A read-write connection
+    :type sqlite3.Connection:
+    :param sensor_types: The sensor types to remove the readings of
+    :type list:
+    :param start: The epoch start of the range, a multiple of a day
+    :type int:
+    :param stop: The epoch end of the range, excluded, a multiple of a day
+    :type int:
+    """
+    day = RESOLUTIONS[0]
+    removed = {}
+    for sensor_type in sensor_types:
+        rows = conn.execute('SELECT device_uuid, type, {} FROM rollup_buckets WHERE type = ? AND resolution = ? AND bucket >= ? AND bucket < ?'.format(SUMMARY_COLUMNS),
+                            (sensor_type, day, start, stop))
+        for row in rows:
+            removed.setdefault((row['device_uuid'], row['type']), Summary()).merge(Summary.from_row(row))
+
+    for key, expired in removed.items():
+        row = conn.execute('SELECT {} FROM rollups WHERE device_uuid = ? AND type = ?'.format(SUMMARY_COLUMNS), key).fetchone()
+        if row is None:
+            continue
+        summary = Summary.from_row(row)
+        kept = Summary(summary.count - expired.count, summary.total - expired.total, summary.min_value, summary.min_date_created,
+                       summary.max_value, summary.max_date_created, summary.histogram.subtract(expired.histogram))
+        if not kept.count:
+            conn.execute('DELETE FROM rollups WHERE device_uuid = ? AND type = ?', key)
+            continue
+        if summary.min_date_created < stop or summary.max_date_created < stop:
+            # The min or max reading was removed, the day rollups left hold the earliest reading of every min and max
+            remaining = Summary()
+            for bucket in conn.execute('SELECT {} FROM rollup_buckets WHERE device_uuid = ? AND type = ? AND resolution = ? AND bucket >= ?'.format(SUMMARY_COLUMNS),
+                                       key + (day, stop)):
+                remaining.merge(Summary.from_row(bucket))
+            kept.min_value, kept.min_date_created = remaining.min_value, remaining.min_date_created
+            kept.max_value, kept.max_date_created = remaining.max_value, remaining.max_date_created
+        conn.execute('UPDATE rollups SET count = ?, total = ?, min_value = ?, min_date_created = ?, max_value = ?, max_date_created = ?, histogram = ? '
+                     'WHERE device_uuid = ? AND type = ?', kept.to_row() + key)
+
+def delete_buckets(conn, sensor_types, before, batch_size=10000):
+    """
+    Delete the time bucketed rollups of the buckets starting before a date, in transactions of
+    batch_size rows so writers waiting on the database are never blocked for long
+
+    :param conn: A read-write connection
+    :type sqlite3.Connection:
+    :param sensor_types: The sensor types to delete the buckets of
+    :type list:
+    :param before: The epoch date, a multiple of a day
+    :type int:
+    """
+    for sensor_type in sensor_types:
+        for resolution in RESOLUTIONS:
+            deleted = batch_size
+            while deleted == batch_size:
+                with conn:
+                    deleted = conn.execute(DELETE_BUCKETS, (sensor_type, resolution, before, batch_size)).rowcount
+
+def rebuild(conn):
+    """
+    Recompute every rollup, and every time bucketed rollup, from the partitions of the readings in a single transaction
+
+    :param conn: A read-write connection
+    :type sqlite3.Connection:
+    """
+    with conn:
+        conn.execute('DELETE FROM rollup_buckets')
+        for name in partitions.overlapping(conn):
+            for resolution in RESOLUTIONS:
+                conn.execute(REBUILD_BUCKETS.format(name, SUMMARY_COLUMNS, resolution))
+        conn.execute('DELETE FROM rollups')
+        conn.execute(REBUILD_ROLLUPS)
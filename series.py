@@ -0,0 +1,67 @@
+"""
+Downsampling of the readings of a device for charts. The readings of a range are split into
+consecutive time buckets, each summarized or represented by a few points, so the size of the
+series depends on the number of buckets rather than on the number of readings.
+"""
+import math
+
+def bucket_width(time_range, points):
+    """
+    Return the width in seconds of the buckets splitting a range into at most points buckets
+
+    :param time_range: The (start, end) range, end included
+    :type tuple:
+    :param points: The maximum number of buckets
+    :type int:
+    """
+    start, end = time_range
+    return max(1, math.ceil((end - start + 1) / points))
+
+def bucket_count(time_range, width, origin):
+    """
+    Return the number of buckets of width seconds starting at origin needed to cover a range
+    """
+    return max(0, (time_range[1] - origin) // width + 1)
+
+def triangle_area(a, b, c):
+    """
+    Return the area of the triangle of three (date_created, value) points
+    """
+    return abs((a[0] - c[0]) * (b[1] - a[1]) - (a[0] - b[0]) * (c[1] - a[1])) / 2
+
+def largest_triangles(readings, averages):
+    """
+    Downsample readings with the Largest-Triangle-Three-Buckets algorithm and return the
+    (date_created, value) of the readings kept: the first and last readings, and in between
+    the reading of every bucket forming the largest triangle with the reading kept before it
+    and the average of the next bucket. The buckets are time ranges rather than equal numbers
+    of readings, so the readings are read once and only the readings of a bucket are held.
+
+    :param readings: (bucket, date_created, value) of the readings, ordered by date_created
+    :type iterable:
+    :param averages: {bucket: (mean date_created, mean value)} of the buckets holding readings
+    :type dict:
+    """
+    kept = []
+    bucket = None
+    candidates = []
+    for reading_bucket, date_created, value in readings:
+        point = (date_created, value)
+        if not kept:
+            kept.append(point)
+            continue
+        if reading_bucket != bucket:
+            if candidates:
+                # A reading inserted after the averages were read may start a bucket they do not know
+                following = averages.get(reading_bucket, point)
+                kept.append(max(candidates, key=lambda candidate: triangle_area(kept[-1], candidate, following)))
+            bucket = reading_bucket
+            candidates = []
+        candidates.append(point)
+
+    if candidates:
+        last = candidates.pop()
+        if candidates:
+            kept.append(max(candidates, key=lambda candidate: triangle_area(kept[-1], candidate, last)))
+        kept.append(last)
+    return kept
@@ -0,0 +1,329 @@
+import struct
+
+MIN_VALUE = 0
+MAX_VALUE = 100
+
+# Histograms are stored sparsely as (value, count) pairs since most buckets are empty
+HISTOGRAM_PAIR = struct.Struct('<BQ')
+
+def find_median(sorted_list, absolute=True):
+    """
+    Find the median given a sorted list; if absolute is true and there are an even
+    number of items in the list return a calculated median; otherwise return the lower of the two medians.
+
+    :param absolute: wether or not to return the absolute median
+    :type boolean:
+    """
+    n = len(sorted_list)
+    if n % 2 == 0:
+        if absolute:
+            median = (sorted_list[n // 2 - 1] + sorted_list[n // 2]) / 2
+        else:
+            median = sorted_list[n // 2 - 1]
+    else:
+        median = sorted_list[n // 2]
+    return median
+
+class Histogram:
+    """
+    The number of readings per sensor value.
+
+    Sensor values are validated to integers between 0 and 100, so 101 buckets hold
+    everything needed to find the exact median, modes and quartiles of any number of
+    readings without sorting them. Every statistic below is O(101) and follows the
+    semantics of the list based implementation documented in the README.
+    """
+
+    def __init__(self, counts=None):
+        self.counts = list(counts) if counts is not None else [0] * (MAX_VALUE - MIN_VALUE + 1)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build a histogram from (value, count) rows, e.g. the result of a
+        `select value, count(*) ... group by value` query
+
+        :param rows: (value, count) pairs
+        :type iterable:
+        """
+        histogram = cls()
+        for value, count in rows:
+            histogram.add(value, count)
+        return histogram
+
+    def add(self, value, count=1):
+        """
+        Count a value (count times)
+
+        :param value: A sensor value between 0 and 100
+        :type int:
+        """
+        if value is None or value < MIN_VALUE or value > MAX_VALUE or value != int(value):
+            raise ValueError('value {} not supported'.format(value))
+        self.counts[int(value) - MIN_VALUE] += count
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Load a histogram stored with to_bytes
+
+        :param data: The stored histogram
+        :type bytes:
+        """
+        histogram = cls()
+        for value, count in HISTOGRAM_PAIR.iter_unpack(data or b''):
+            histogram.counts[value] += count
+        return histogram
+
+    def to_bytes(self):
+        """
+        Return the histogram in the compact form stored in the database
+        """
+        return b''.join(HISTOGRAM_PAIR.pack(i, n) for i, n in enumerate(self.counts) if n)
+
+    def merge(self, other):
+        """
+        Add the counts of another histogram to this one
+        """
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        return self
+
+    def subtract(self, other):
+        """
+        Remove the counts of another histogram, of readings counted in this one, from this one
+        """
+        self.counts = [a - b for a, b in zip(self.counts, other.counts)]
+        return self
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    @property
+    def total(self):
+        return sum((MIN_VALUE + i) * n for i, n in enumerate(self.counts))
+
+    def values(self):
+        """
+        Return the (value, count) pairs of the values that were counted, in ascending order
+        """
+        return [(MIN_VALUE + i, n) for i, n in enumerate(self.counts) if n]
+
+    def value_at(self, rank):
+        """
+        Return the value found at rank (zero based) if all the readings were sorted
+
+        :param rank: The position in the sorted readings
+        :type int:
+        """
+        if rank < 0 or rank >= self.count:
+            raise IndexError('rank {} out of range'.format(rank))
+        for i, n in enumerate(self.counts):
+            if rank < n:
+                return MIN_VALUE + i
+            rank -= n
+
+    def values_at(self, ranks):
+        """
+        Return the {rank: value} of the values found at several ranks if all the readings were sorted, in a single pass over the counts
+
+        :param ranks: Positions in the sorted readings
+        :type iterable:
+        """
+        ranks = sorted(set(ranks))
+        if ranks and (ranks[0] < 0 or ranks[-1] >= self.count):
+            raise IndexError('ranks {} out of range'.format(ranks))
+        found = {}
+        position = 0
+        below = 0
+        for i, n in enumerate(self.counts):
+            below += n
+            while position < len(ranks) and ranks[position] < below:
+                found[ranks[position]] = MIN_VALUE + i
+                position += 1
+        return found
+
+    def percentiles(self, percents, absolute=True):
+        """
+        Return the {percent: value} of several percentiles, or None when there are no readings.
+        The percentile p is found at rank p / 100 * (count - 1) of the sorted readings; between two
+        ranks it is interpolated linearly if absolute is true, otherwise the lower value is returned,
+        so the 50th percentile is the median find_median would return.
+
+        :param percents: Numbers between 0 and 100
+        :type iterable:
+        :param absolute: wether or not to interpolate between the two closest values
+        :type boolean:
+        """
+        n = self.count
+        if not n:
+            return None
+        positions = {}
+        for percent in percents:
+            rank, remainder = divmod(percent * (n - 1), 100)
+            positions[percent] = (int(rank), remainder / 100 if absolute else 0)
+        values = self.values_at([rank + offset for rank, fraction in positions.values() for offset in ([0, 1] if fraction else [0])])
+
+        results = {}
+        for percent, (rank, fraction) in positions.items():
+            value = values[rank]
+            if fraction:
+                value += (values[rank + 1] - value) * fraction
+            results[percent] = value
+        return results
+
+    def count_below(self, value):
+        """
+        Return the number of readings with a value lower than value
+        """
+        return sum(self.counts[:max(0, value - MIN_VALUE)])
+
+    def median_rank(self):
+        """
+        Return the rank of the reading returned as the median; the lower of the two medians
+        when there are an even number of readings
+        """
+        return (self.count - 1) // 2
+
+    def median(self, absolute=True, offset=0, n=None):
+        """
+        Find the median like find_median would over the sorted readings, or over the
+        n sorted readings starting at rank offset. Returns None when there are no readings.
+
+        :param absolute: wether or not to return the absolute median
+        :type boolean:
+        """
+        if n is None:
+            n = self.count - offset
+        if n <= 0:
+            return None
+        if n % 2 == 0:
+            if absolute:
+                return (self.value_at(offset + n // 2 - 1) + self.value_at(offset + n // 2)) / 2
+            return self.value_at(offset + n // 2 - 1)
+        return self.value_at(offset + n // 2)
+
+    def mode(self):
+        """
+        Return the values counted the most times, in ascending order
+        """
+        most = max(self.counts)
+        if not most:
+            return []
+        return [MIN_VALUE + i for i, n in enumerate(self.counts) if n == most]
+
+    def quartiles(self):
+        """
+        Return the 1st and 3rd quartiles, or None when there are not enough readings.
+        The median is not included in either half when there are an odd number of readings.
+        """
+        n = self.count
+        half = n // 2
+        if not half:
+            return None
+        return (self.median(absolute=True, offset=0, n=half), self.median(absolute=True, offset=n - half, n=half))
+
+class Summary:
+    """
+    Everything needed to answer the metric endpoints for a set of readings: their count,
+    total, min and max readings and histogram. Summaries of disjoint sets of readings
+    can be merged, which is how the rollup tables are maintained and combined.
+
+    When several readings hold the min or max value, the earliest one is kept.
+    """
+
+    def __init__(self, count=0, total=0, min_value=None, min_date_created=None,
+                 max_value=None, max_date_created=None, histogram=None):
+        self.count = count
+        self.total = total
+        self.min_value = min_value
+        self.min_date_created = min_date_created
+        self.max_value = max_value
+        self.max_date_created = max_date_created
+        self.histogram = histogram if histogram is not None else Histogram()
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Load a summary from a rollup row
+
+        :param row: A row with the columns of a rollup table
+        :type sqlite3.Row:
+        """
+        return cls(row['count'], row['total'], row['min_value'], row['min_date_created'],
+                   row['max_value'], row['max_date_created'], Histogram.from_bytes(row['histogram']))
+
+    @classmethod
+    def from_value_rows(cls, rows):
+        """
+        Build a summary from (value, count, date_created) rows holding the number of readings
+        per value and the earliest date_created of those readings, e.g. the result of a
+        `select value, count(*), min(date_created) ... group by value` query
+
+        :param rows: (value, count, date_created) tuples
+        :type iterable:
+        """
+        summary = cls()
+        for value, count, date_created in sorted(rows, key=lambda row: row[0]):
+            summary.histogram.add(value, count)
+            summary.count += count
+            summary.total += value * count
+            if summary.min_value is None:
+                summary.min_value, summary.min_date_created = value, date_created
+            summary.max_value, summary.max_date_created = value, date_created
+        return summary
+
+    def to_row(self):
+        """
+        Return the (count, total, min_value, min_date_created, max_value, max_date_created, histogram)
+        columns of a rollup row
+        """
+        return (self.count, self.total, self.min_value, self.min_date_created,
+                self.max_value, self.max_date_created, self.histogram.to_bytes())
+
+    def add(self, value, date_created):
+        """
+        Count a single reading
+        """
+        self.histogram.add(value)
+        if self.min_value is None or value < self.min_value or (value == self.min_value and date_created < self.min_date_created):
+            self.min_value, self.min_date_created = value, date_created
+        if self.max_value is None or value > self.max_value or (value == self.max_value and date_created < self.max_date_created):
+            self.max_value, self.max_date_created = value, date_created
+        self.count += 1
+        self.total += value
+
+    def merge(self, other):
+        """
+        Add the readings summarized by other to this summary
+        """
+        if other.min_value is not None and (self.min_value is None or other.min_value < self.min_value or
+                (other.min_value == self.min_value and other.min_date_created < self.min_date_created)):
+            self.min_value, self.min_date_created = other.min_value, other.min_date_created
+        if other.max_value is not None and (self.max_value is None or other.max_value > self.max_value or
+                (other.max_value == self.max_value and other.max_date_created < self.max_date_created)):
+            self.max_value, self.max_date_created = other.max_value, other.max_date_created
+        self.count += other.count
+        self.total += other.total
+        self.histogram.merge(other.histogram)
+        return self
+
+def histogram_merge(first, second):
+    """
+    SQL function merging two stored histograms, used to update the rollup tables in place
+    """
+    return Histogram.from_bytes(first).merge(Histogram.from_bytes(second)).to_bytes()
+
+class HistogramAggregate:
+    """
+    SQL aggregate building the stored histogram of a column of values
+    """
+
+    def __init__(self):
+        self.histogram = Histogram()
+
+    def step(self, value):
+        self.histogram.add(value)
+
+    def finalize(self):
+        return self.histogram.to_bytes()
@@ -0,0 +1,133 @@
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# The upper bounds in seconds of the latency histogram buckets, the Prometheus client defaults
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+def escape(value):
+    """
+    Escape a label value of the Prometheus text format
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels, extra=()):
+    """
+    Return the {name="value",...} of sorted (name, value) label pairs, or an empty string without labels
+    """
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in pairs) + '}'
+
+def format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class Telemetry:
+    """
+    Record counters and latency histograms of the hot paths of the API and render them
+    in the Prometheus text format. Every metric is identified by its name and a dict of
+    labels, which must only take a bounded set of values (routes, not device uuids).
+
+    The slow query log is tuned with the following setting from the flask config:
+
+    * SLOW_QUERY_THRESHOLD -> Queries taking longer than this many milliseconds are logged
+        with their parameters and query plan, 0 disables the log
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+
+    def describe(self, name, text):
+        """
+        Register the help text of a metric
+        """
+        self._help[name] = text
+
+    def inc(self, name, labels=None, amount=1):
+        """
+        Add amount to a counter
+        """
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, labels=None):
+        """
+        Count a duration in a latency histogram
+        """
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+            histogram[0][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+
+    def slow_query(self, conn, query, params, seconds):
+        """
+        Log a query with its parameters and query plan when it took longer than SLOW_QUERY_THRESHOLD
+
+        :param conn: The connection the query ran on, used to explain it
+        :type sqlite3.Connection:
+        """
+        threshold = self.config.get('SLOW_QUERY_THRESHOLD', 100)
+        if not threshold or seconds * 1000 < threshold:
+            return False
+
+        try:
+            plan = [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + query, params).fetchall()]
+        except Exception as e:
+            plan = ['could not explain the query: {}'.format(e)]
+        logger.warning('Slow query took %.1fms: %s\nparams: %r\nplan:\n  %s', seconds * 1000, query, list(params), '\n  '.join(plan))
+        self.inc('sqlite_slow_queries_total')
+        return True
+
+    def render(self, gauges=None):
+        """
+        Return every metric in the Prometheus text format
+
+        :param gauges: Extra {name: (help, value)} gauges, e.g. the counters of the ingestion buffer
+        :type dict:
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(buckets), total)) for key, (buckets, total) in self._histograms.items())
+
+        lines = []
+        described = set()
+
+        def header(name, kind, text):
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP {} {}'.format(name, text))
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (name, labels), value in counters:
+            header(name, 'counter', self._help.get(name, name))
+            lines.append('{}{} {}'.format(name, format_labels(labels), format_number(value)))
+
+        for (name, labels), (buckets, total) in histograms:
+            header(name, 'histogram', self._help.get(name, name))
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + [float('inf')], buckets):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels, [('le', format_number(bound))]), cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), format_number(total)))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), cumulative))
+
+        for name, (text, value) in sorted((gauges or {}).items()):
+            header(name, 'gauge', text)
+            lines.append('{} {}'.format(name, format_number(value)))
+
+        return '\n'.join(lines) + '\n'
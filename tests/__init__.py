@@ -0,0 +1,14 @@
+import sqlite3
+
+from db import migrate
+
+def reset_database(path):
+    """
+    Drop every table of the database and migrate it back to an empty schema
+    """
+    conn = sqlite3.connect(path)
+    for (table,) in conn.execute("select name from sqlite_master where type='table' and name not like 'sqlite_%'").fetchall():
+        conn.execute('DROP TABLE IF EXISTS {}'.format(table))
+    conn.execute('PRAGMA user_version = 0')
+    migrate(conn)
+    conn.close()
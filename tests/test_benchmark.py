@@ -0,0 +1,40 @@
+import unittest
+
+from app import app, device_ids, metric_cache
+from benchmark import AppClient, Fleet, endpoints, percentile, run
+from tests import reset_database
+
+class BenchmarkTestCases(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        reset_database('test_database.db')
+        metric_cache.clear()
+        device_ids.clear()
+
+    def test_percentile(self):
+        # Given latencies from 1 to 100
+        latencies = list(range(1, 101))
+
+        # Then the nearest rank percentiles should be returned
+        self.assertEqual(percentile(latencies, 50), 50)
+        self.assertEqual(percentile(latencies, 99), 99)
+        self.assertEqual(percentile(latencies, 100), 100)
+        self.assertEqual(percentile([], 50), None)
+
+    def test_run(self):
+        # Given a small fleet
+        fleet = Fleet(devices=3, readings=20, span=3600, end=100000)
+
+        # When we benchmark every route
+        report = run(AppClient(), fleet, requests=4, concurrency=2)
+
+        # Then every reading should have been generated
+        self.assertEqual(report['generate']['readings'], 3 * 2 * 20)
+
+        # And every route should have been reported without server errors
+        self.assertEqual(sorted(report['endpoints']), sorted(endpoints(fleet)))
+        for name, result in report['endpoints'].items():
+            self.assertEqual(sum(result['statuses'].values()), 4)
+            self.assertTrue(all(int(status) < 500 for status in result['statuses']), name)
+            self.assertTrue(result['latency_ms']['p50'] <= result['latency_ms']['p99'])
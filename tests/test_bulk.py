@@ -0,0 +1,113 @@
+import csv
+import gzip
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from click.testing import CliRunner
+
+import bulk
+from app import app, device_ids, metric_cache
+from tests import reset_database
+
+class BulkTestCases(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        reset_database('test_database.db')
+        metric_cache.clear()
+        device_ids.clear()
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.client = app.test_client
+        self.runner = CliRunner()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def test_import_ndjson_gz(self):
+        # Given a gzip compressed NDJSON archive with invalid readings and an invalid line
+        with gzip.open(self.path('readings.ndjson.gz'), 'wt') as f:
+            for i in range(100):
+                f.write(json.dumps({'device_uuid': 'device_{}'.format(i % 3), 'type': 'temperature', 'value': i, 'date_created': 1000 + i}) + '\n')
+            f.write(json.dumps({'device_uuid': 'device_0', 'type': 'pressure', 'value': 1, 'date_created': 1000}) + '\n')
+            f.write('not json\n')
+            f.write(json.dumps({'device_uuid': 'device_0', 'type': 'temperature', 'value': 1, 'date_created': 1e30}) + '\n')
+
+        # When we import it in small transactions
+        result = self.runner.invoke(bulk.cli, ['import', self.path('readings.ndjson.gz'), '--batch-size', '7'])
+
+        # Then the valid readings should be inserted and the others reported
+        self.assertEqual(result.exit_code, 0, result.stderr)
+        self.assertIn('imported 100 readings', result.stderr)
+        self.assertIn('line 101: type pressure not supported', result.stderr)
+        self.assertIn('line 102: invalid JSON', result.stderr)
+        self.assertIn('line 103: date_created 1e+30 not supported', result.stderr)
+        self.assertIn('3 readings rejected', result.stderr)
+
+        # And the rollups should include them
+        request = self.client().get('/devices/device_0/readings/stats/?type=temperature&metrics=min,max')
+        data = json.loads(request.data)
+        self.assertEqual(data['min']['value'], 0)
+        self.assertEqual(data['max']['value'], 99)
+
+        # And the secondary indexes of the partitions should be built once loaded
+        conn = sqlite3.connect('test_database.db')
+        indexes = [row[0] for row in conn.execute("select name from sqlite_master where type='index' and tbl_name='readings_19700101' order by name")]
+        self.assertEqual(indexes, ['readings_19700101_device_date', 'readings_19700101_device_value', 'readings_19700101_type_date'])
+        self.assertEqual(conn.execute('PRAGMA synchronous').fetchone()[0], 2)
+
+    def test_import_many_rejected(self):
+        # Given an archive of invalid lines only
+        records = [(line_number, 'invalid JSON') for line_number in range(1, 1001)]
+
+        # When we validate them
+        rejections = bulk.Rejections()
+        self.assertEqual(list(bulk.validate_records(iter(records), rejections)), [])
+
+        # Then every line should be counted but only the first ones kept
+        self.assertEqual(rejections.count, 1000)
+        self.assertEqual(rejections.first, records[:bulk.MAX_REPORTED_ERRORS])
+
+    def test_import_csv(self):
+        # Given a CSV archive
+        with open(self.path('readings.csv'), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['device_uuid', 'type', 'value', 'date_created'])
+            writer.writerow(['device_0', 'humidity', '40', '1000'])
+            writer.writerow(['device_0', 'humidity', '101', '1001'])
+            writer.writerow(['device_0', 'humidity', '60', '1002'])
+
+        # When we import it
+        result = self.runner.invoke(bulk.cli, ['import', self.path('readings.csv')])
+
+        # Then the valid readings should be inserted
+        self.assertEqual(result.exit_code, 0, result.stderr)
+        self.assertIn('line 3: value 101 not supported', result.stderr)
+        request = self.client().get('/devices/device_0/readings/?type=humidity')
+        self.assertEqual([reading['value'] for reading in json.loads(request.data)], [40, 60])
+
+    def test_export(self):
+        # Given readings of several devices
+        readings = [{'device_uuid': 'device_{}'.format(i % 2), 'type': 'temperature', 'value': i, 'date_created': 1000 + i} for i in range(10)]
+        with open(self.path('readings.ndjson'), 'w') as f:
+            f.write(''.join(json.dumps(reading) + '\n' for reading in readings))
+        self.runner.invoke(bulk.cli, ['import', self.path('readings.ndjson')])
+
+        # When we export the readings of a device within a range
+        result = self.runner.invoke(bulk.cli, ['export', '--device-uuid', 'device_0', '--start', '1002', '--end', '1006'])
+
+        # Then only its readings of that range should be written
+        self.assertEqual(result.exit_code, 0, result.stderr)
+        self.assertEqual([json.loads(line) for line in result.stdout.splitlines()], [readings[2], readings[4], readings[6]])
+
+        # And exporting every reading to a compressed CSV file should round trip
+        result = self.runner.invoke(bulk.cli, ['export', '--output', self.path('export.csv.gz')])
+        self.assertEqual(result.exit_code, 0, result.stderr)
+        self.assertIn('exported 10 readings', result.stderr)
+        with gzip.open(self.path('export.csv.gz'), 'rt', newline='') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(sorted((row['device_uuid'], int(row['value'])) for row in rows), sorted((reading['device_uuid'], reading['value']) for reading in readings))
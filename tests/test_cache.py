@@ -0,0 +1,63 @@
+import time
+import unittest
+
+from cache import MetricCache
+
+class MetricCacheTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {'METRIC_CACHE_SIZE': 2, 'METRIC_CACHE_TTL': 60}
+        self.cache = MetricCache(self.config)
+
+    def test_hit(self):
+        # Given a cached result
+        self.cache.put(('device', 'temperature', None, 'min'), 0, {'value': 1})
+
+        # When we look it up at the same version
+        # Then it should be served
+        self.assertEqual(self.cache.get(('device', 'temperature', None, 'min'), 0), (True, {'value': 1}))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_new_version(self):
+        # Given a result cached at the current version of its device
+        self.cache.put(('device', 'temperature', None, 'min'), 1000, {'value': 1})
+
+        # When the readings of the device changed since
+        # Then the result should not be served anymore
+        self.assertEqual(self.cache.get(('device', 'temperature', None, 'min'), 1001), (False, None))
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_lru_eviction(self):
+        # Given a full cache whose oldest entry was just used
+        self.cache.put('a', 0, 1)
+        self.cache.put('b', 0, 2)
+        self.cache.get('a', 0)
+
+        # When another result is cached
+        self.cache.put('c', 0, 3)
+
+        # Then the least recently used entry should be evicted
+        self.assertEqual(self.cache.get('b', 0), (False, None))
+        self.assertEqual(self.cache.get('a', 0), (True, 1))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_ttl(self):
+        # Given a result cached with a short TTL
+        self.config['METRIC_CACHE_TTL'] = 0.01
+        self.cache.put('a', 0, 1)
+
+        # When the TTL is over
+        time.sleep(0.02)
+
+        # Then it should not be served anymore
+        self.assertEqual(self.cache.get('a', 0), (False, None))
+
+    def test_disabled(self):
+        # Given a cache of size 0
+        self.config['METRIC_CACHE_SIZE'] = 0
+
+        # When a result is cached
+        self.cache.put('a', 0, 1)
+
+        # Then nothing should be kept
+        self.assertEqual(self.cache.get('a', 0), (False, None))
@@ -0,0 +1,199 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import partitions
+from db import ConnectionManager, DeviceIds, MIGRATIONS, migrate, reshard, shard_file, shard_index, write_readings
+
+class ConnectionManagerTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = {
+            'TESTING': True,
+            'TEST_DATABASE': os.path.join(self.directory.name, 'test.db'),
+            'SQLITE_SYNCHRONOUS': 'normal',
+        }
+        self.connections = ConnectionManager(self.config)
+
+    def tearDown(self):
+        self.connections.close_all()
+        self.directory.cleanup()
+
+    def test_connections_are_reused(self):
+        # Given a connection manager
+        # When we ask for the connections of the same thread twice
+        # Then we should get the same connections back
+        self.assertIs(self.connections.writer(), self.connections.writer())
+        self.assertIs(self.connections.reader(), self.connections.reader())
+
+    def test_connections_are_per_thread(self):
+        # Given the connection of the current thread
+        conn = self.connections.writer()
+
+        # When another thread asks for a connection
+        other = []
+        thread = threading.Thread(target=lambda: other.append(self.connections.writer()))
+        thread.start()
+        thread.join()
+
+        # Then it should get its own
+        self.assertIsNot(conn, other[0])
+
+    def test_writer_pragmas(self):
+        # Given the writer connection
+        conn = self.connections.writer()
+
+        # Then it should be in WAL mode with the configured synchronous level
+        self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(conn.execute('PRAGMA synchronous').fetchone()[0], 1)
+
+    def test_reader_is_read_only(self):
+        # Given a database with a table
+        with self.connections.writer() as conn:
+            conn.execute('CREATE TABLE things (value INTEGER)')
+
+        # When we try to write with the reader connection
+        # Then it should be refused
+        with self.assertRaises(sqlite3.OperationalError):
+            self.connections.reader().execute('INSERT INTO things VALUES (1)')
+
+    def test_testing_selects_the_test_database(self):
+        # Given the manager is not in testing mode
+        self.config['TESTING'] = False
+
+        # Then the production database should be used
+        self.assertEqual(self.connections.path(), 'database.db')
+
+    def test_invalid_synchronous_level(self):
+        # Given an unsupported synchronous level
+        self.config['SQLITE_SYNCHRONOUS'] = 'sometimes'
+
+        # Then opening a writer should fail
+        with self.assertRaises(ValueError):
+            self.connections.writer()
+
+class ShardingTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = {'TESTING': True, 'TEST_DATABASE': os.path.join(self.directory.name, 'test.db')}
+        self.connections = ConnectionManager(self.config)
+
+    def tearDown(self):
+        self.connections.close_all()
+        self.directory.cleanup()
+
+    def test_shard_files(self):
+        # Given a single shard
+        # Then it should be the database file itself
+        self.assertEqual(shard_file('database.db', 0, 1), 'database.db')
+
+        # And several shards should each get their own file
+        self.assertEqual(shard_file('database.db', 2, 8), 'database.2-of-8.db')
+
+    def test_shard_index_is_stable(self):
+        # Given a device uuid
+        # Then it should always be found in the same shard
+        self.assertEqual(shard_index('test_device', 8), shard_index('test_device', 8))
+        self.assertEqual(shard_index('test_device', 8), 0)
+
+    def test_reshard(self):
+        # Given readings of many devices in a single shard
+        readings = [('device-{}'.format(i), 'temperature', i % 100, i) for i in range(200)]
+        ids = DeviceIds(self.connections).assign(self.connections.shard_path('device-0'), set(reading[0] for reading in readings))
+        with self.connections.writer() as conn:
+            write_readings(conn, readings, ids)
+
+        # When we reshard them into four shards
+        paths = reshard(self.connections, 4)
+
+        # Then every reading should be copied to the shard of its device, with its rollups
+        copied = []
+        for index, path in enumerate(paths):
+            conn = self.connections.reader(path)
+            rows = conn.execute('select d.device_uuid, type_name(r.type_code), r.value, r.date_created from {} r join devices d on d.id = r.device_id'.format(
+                partitions.source(partitions.overlapping(conn)))).fetchall()
+            self.assertTrue(all(shard_index(row[0], 4) == index for row in rows))
+            copied.extend(tuple(row) for row in rows)
+            rollups = self.connections.reader(path).execute('select count(*) from rollups').fetchone()[0]
+            self.assertEqual(rollups, len(set(row[0] for row in rows)))
+        self.assertEqual(sorted(copied), sorted(readings))
+
+        # And resharding into files that already exist should be refused
+        self.config['SHARDS'] = 2
+        with self.assertRaises(ValueError):
+            reshard(self.connections, 4)
+
+class MigrationTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'legacy.db')
+
+        # Setup a database with the schema that predates migrations
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                         [('device_{}'.format(i % 10), 'temperature', i % 101, i) for i in range(1000)])
+        conn.commit()
+        self.conn = conn
+
+    def tearDown(self):
+        self.conn.close()
+        self.directory.cleanup()
+
+    def test_migrate_existing_database(self):
+        # Given a database without a schema version
+        # When we migrate it
+        version = migrate(self.conn)
+
+        # Then it should be at the latest version
+        self.assertEqual(version, len(MIGRATIONS))
+        self.assertEqual(self.conn.execute('PRAGMA user_version').fetchone()[0], len(MIGRATIONS))
+
+        # And the data should be intact, in a single daily partition
+        self.assertEqual(partitions.overlapping(self.conn), ['readings_19700101'])
+        self.assertEqual(self.conn.execute('select count(*), sum(value) from readings_19700101').fetchone(), (1000, sum(i % 101 for i in range(1000))))
+
+        # And the rollups should be built from the existing readings
+        self.assertEqual(self.conn.execute('select count(*), sum(count), sum(total) from rollups').fetchone(), (10, 1000, sum(i % 101 for i in range(1000))))
+
+        self.assertEqual(self.conn.execute('select resolution, sum(count) from rollup_buckets group by resolution').fetchall(),
+                         [(60, 1000), (3600, 1000), (86400, 1000)])
+
+        # And the readings should be stored against device ids and type codes
+        self.assertEqual(self.conn.execute('select count(*) from devices').fetchone()[0], 10)
+        self.assertEqual(self.conn.execute('select distinct type_code from readings_19700101').fetchall(), [(1,)])
+
+        # And the range queries of a device should be served from the primary key
+        plan = ' '.join(row[3] for row in self.conn.execute(
+            'EXPLAIN QUERY PLAN select value from readings_19700101 where device_id=? and type_code=? and date_created between ? and ?',
+            (1, 1, 0, 500)))
+        self.assertIn('USING PRIMARY KEY', plan)
+
+    def test_migrate_several_days_through_the_writer(self):
+        # Given a database holding readings of several days
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                              [('device_0', 'temperature', 50, 86400 * day + 10) for day in [3, 1, 2]])
+        self.conn.commit()
+
+        # When it is migrated by the writer connection of the app, whose rows are sqlite3.Row
+        connections = ConnectionManager({'DATABASE': self.path})
+        self.addCleanup(connections.close_all)
+        conn = connections.writer()
+
+        # Then it should be at the latest version with a partition per day
+        self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0], len(MIGRATIONS))
+        self.assertEqual(partitions.overlapping(conn), ['readings_19700101', 'readings_19700102', 'readings_19700103', 'readings_19700104'])
+        self.assertEqual(conn.execute('select sum(count) from rollups').fetchone()[0], 1003)
+
+    def test_migrate_is_idempotent(self):
+        # Given a migrated database
+        migrate(self.conn)
+
+        # When we migrate it again
+        # Then nothing should change
+        self.assertEqual(migrate(self.conn), len(MIGRATIONS))
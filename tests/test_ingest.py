@@ -0,0 +1,140 @@
+import json
+import threading
+import time
+import unittest
+
+from app import app, device_ids, metric_cache, write_behind
+from ingest import BufferFull, WriteBehindBuffer
+from tests import reset_database
+
+class WriteBehindBufferTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {'INGEST_QUEUE_SIZE': 100, 'INGEST_BATCH_SIZE': 10, 'INGEST_FLUSH_INTERVAL': 10}
+        self.batches = []
+        self.buffer = WriteBehindBuffer(self.config, self.batches.append)
+
+    def tearDown(self):
+        self.buffer.close()
+
+    def test_group_commit(self):
+        # Given readings submitted one at a time
+        for i in range(25):
+            self.buffer.submit([('device', 'temperature', i, i)])
+
+        # When the buffer is closed
+        self.buffer.close()
+
+        # Then every reading should have been flushed in order, at most a batch at a time
+        self.assertEqual([reading[2] for batch in self.batches for reading in batch], list(range(25)))
+        self.assertTrue(all(len(batch) <= 10 for batch in self.batches))
+        self.assertEqual(self.buffer.stats()['flushed'], 25)
+        self.assertEqual(self.buffer.stats()['queue_depth'], 0)
+
+    def test_readings_after_a_flush(self):
+        # Given readings that were already flushed
+        self.buffer.submit([('device', 'temperature', 1, 1)])
+        self.assertTrue(self.wait_for_flushed(1))
+
+        # When fewer readings than a batch are submitted afterwards
+        self.buffer.submit([('device', 'temperature', 2, 2)])
+
+        # Then they should be flushed after the flush interval without closing the buffer
+        self.assertTrue(self.wait_for_flushed(2))
+        self.assertEqual(self.batches, [[('device', 'temperature', 1, 1)], [('device', 'temperature', 2, 2)]])
+
+    def wait_for_flushed(self, count, timeout=2):
+        deadline = time.monotonic() + timeout
+        while self.buffer.stats()['flushed'] < count:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def test_backpressure(self):
+        # Given a database that does not keep up
+        release = threading.Event()
+        self.buffer.flush = lambda batch: release.wait()
+
+        # When more readings are submitted than the queue holds
+        self.buffer.submit([('device', 'temperature', 1, 1)] * 100)
+
+        # Then they should be refused
+        with self.assertRaises(BufferFull):
+            self.buffer.submit([('device', 'temperature', 1, 1)] * 100)
+        self.assertEqual(self.buffer.stats()['rejected'], 100)
+        release.set()
+
+    def test_failed_flush_is_retried(self):
+        # Given a database failing once
+        failures = [Exception('database is locked')]
+        def flush(batch):
+            if failures:
+                raise failures.pop()
+            self.batches.append(batch)
+        self.buffer.flush = flush
+
+        # When readings are submitted and the buffer closed
+        self.buffer.submit([('device', 'temperature', 1, 1)])
+        self.buffer.close()
+
+        # Then the readings should be flushed on the second attempt
+        self.assertEqual(self.batches, [[('device', 'temperature', 1, 1)]])
+        self.assertEqual(self.buffer.stats()['failures'], 1)
+
+    def test_failing_reading_is_dropped(self):
+        # Given a reading that can never be stored among good readings
+        self.config['INGEST_MAX_ATTEMPTS'] = 2
+        def flush(batch):
+            if ('device', 'temperature', 1, 1e30) in batch:
+                raise OverflowError('timestamp out of range')
+            self.batches.append(batch)
+        self.buffer.flush = flush
+
+        # When they are submitted together
+        self.buffer.submit([('device', 'temperature', i, i) for i in range(3)] + [('device', 'temperature', 1, 1e30)])
+        self.assertTrue(self.wait_for_flushed(3))
+
+        # Then only the failing reading should be dropped and the readings after it still flushed
+        self.buffer.submit([('device', 'temperature', 5, 5)])
+        self.assertTrue(self.wait_for_flushed(4))
+        self.assertEqual(sorted(reading[2] for batch in self.batches for reading in batch), [0, 1, 2, 5])
+        self.assertEqual(self.buffer.stats()['dropped'], 1)
+        self.assertEqual(self.buffer.stats()['queue_depth'], 0)
+
+class WriteBehindRoutesTestCases(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['INGEST_WRITE_BEHIND'] = True
+        reset_database('test_database.db')
+        metric_cache.clear()
+        device_ids.clear()
+        self.client = app.test_client
+
+    def tearDown(self):
+        app.config['INGEST_WRITE_BEHIND'] = False
+
+    def test_device_readings_post_write_behind(self):
+        # Given the write-behind mode
+        # When we post a reading
+        request = self.client().post('/devices/test_device/readings/', data=json.dumps({'type': 'temperature', 'value': 42}))
+
+        # Then it should be accepted
+        self.assertEqual(request.status_code, 202)
+
+        # And it should be inserted shortly after
+        deadline = time.time() + 5
+        while write_behind.stats()['queue_depth'] or write_behind.stats()['in_flight']:
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.01)
+        request = self.client().get('/devices/test_device/readings/')
+        self.assertTrue([reading['value'] for reading in json.loads(request.data)] == [42])
+
+    def test_ingest_stats(self):
+        # When we request the counters of the write-behind buffer
+        request = self.client().get('/ingest/stats/')
+
+        # Then we should receive the queue depth
+        self.assertEqual(request.status_code, 200)
+        self.assertTrue('queue_depth' in json.loads(request.data))
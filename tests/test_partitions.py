@@ -0,0 +1,197 @@
+import json
+import sqlite3
+import threading
+import unittest
+
+import partitions
+import rollups
+from app import app, connections, device_ids, insert_readings, metric_cache
+from db import expire, migrate, write_readings
+from tests import reset_database
+
+DAY = partitions.DAY
+
+class PartitionsTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        migrate(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_route(self):
+        # Given readings created over three days
+        readings = [('device', 'temperature', 10, DAY * day + 60) for day in [2, 0, 2, 1]]
+
+        # When we route them
+        with self.conn:
+            routed = partitions.route(self.conn, readings)
+
+        # Then every day should get its own partition
+        self.assertEqual(routed, {
+            'readings_19700101': [readings[1]],
+            'readings_19700102': [readings[3]],
+            'readings_19700103': [readings[0], readings[2]],
+        })
+
+        # And only the partitions overlapping a range should be read
+        self.assertEqual(partitions.overlapping(self.conn, (DAY - 1, DAY + 10)), ['readings_19700101', 'readings_19700102'])
+        self.assertEqual(partitions.overlapping(self.conn, (DAY * 3, DAY * 4)), [])
+        self.assertEqual(partitions.source([]), partitions.EMPTY)
+        self.assertEqual(partitions.source(['readings_19700101']), '"readings_19700101"')
+
+    def test_route_wider_partitions(self):
+        # Given a daily partition
+        with self.conn:
+            partitions.route(self.conn, [('device', 'temperature', 10, DAY * 8)])
+
+        # When the readings around it are routed to weekly partitions
+        with self.conn:
+            routed = partitions.route(self.conn, [('device', 'temperature', 10, DAY * 7), ('device', 'temperature', 10, DAY * 12)], days=7)
+
+        # Then the new partitions should be cut short around the existing one
+        self.assertEqual(sorted(routed), ['readings_19700108', 'readings_19700110'])
+        self.assertEqual(self.conn.execute('select start, stop from partitions order by start').fetchall(),
+                         [(DAY * 7, DAY * 8), (DAY * 8, DAY * 9), (DAY * 9, DAY * 14)])
+
+    def test_source_of_many_partitions(self):
+        # Given more partitions than fit in a single compound select
+        with self.conn:
+            write_readings(self.conn, [('device', 'temperature', 10, DAY * day) for day in range(600)], {'device': 1})
+
+        # When we select from all of them
+        names = partitions.overlapping(self.conn)
+        count = self.conn.execute('select count(*) from {}'.format(partitions.source(names))).fetchone()[0]
+
+        # Then every partition should be read
+        self.assertEqual(len(names), 600)
+        self.assertEqual(count, 600)
+
+class RetentionTestCases(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        reset_database('test_database.db')
+        metric_cache.clear()
+        device_ids.clear()
+
+        self.device_uuid = 'test_device'
+        self.client = app.test_client
+
+        # Setup readings over three days, the min on the first day and the max on the second
+        insert_readings([
+            (self.device_uuid, 'temperature', 1, 100),
+            (self.device_uuid, 'temperature', 50, 200),
+            (self.device_uuid, 'temperature', 99, DAY + 100),
+            (self.device_uuid, 'temperature', 40, DAY + 200),
+            (self.device_uuid, 'temperature', 20, DAY * 2 + 100),
+            (self.device_uuid, 'temperature', 60, DAY * 2 + 200),
+            ('other_uuid', 'temperature', 10, 300),
+        ])
+
+    def test_expire(self):
+        # Given a retention period of a day
+        # When we expire the readings two days later
+        etag = self.client().get('/devices/other_uuid/readings/').headers['ETag']
+        dropped = expire(connections, 1, now=DAY * 3)
+        metric_cache.clear()
+
+        # Then the partitions of the first two days should be dropped
+        self.assertEqual(dropped, ['readings_19700101', 'readings_19700102'])
+        conn = sqlite3.connect('test_database.db')
+        tables = [row[0] for row in conn.execute("select name from sqlite_master where type='table' and name like 'readings_%'")]
+        self.assertEqual(tables, ['readings_19700103'])
+
+        # And the bucketed rollups of the expired days should be deleted
+        self.assertEqual(conn.execute('select count(*) from rollup_buckets where bucket < ?', (DAY * 2,)).fetchone()[0], 0)
+
+        # And the all time metrics should only count the readings left
+        request = self.client().get('/devices/{}/readings/stats/?type=temperature'.format(self.device_uuid))
+        data = json.loads(request.data)
+        self.assertEqual(data['min'], {'device_uuid': self.device_uuid, 'type': 'temperature', 'value': 20, 'date_created': DAY * 2 + 100})
+        self.assertEqual(data['max'], {'device_uuid': self.device_uuid, 'type': 'temperature', 'value': 60, 'date_created': DAY * 2 + 200})
+        self.assertEqual(data['mean'], {'value': 40})
+        self.assertEqual(data['median']['value'], 20)
+
+        # And the devices of the dropped readings should not match their previous ETag
+        request = self.client().get('/devices/other_uuid/readings/', headers={'If-None-Match': etag})
+        self.assertEqual(request.status_code, 200)
+
+        # And devices without readings left should have no rollups
+        self.assertEqual(conn.execute('select count(*) from rollups where device_uuid = ?', ('other_uuid',)).fetchone()[0], 0)
+
+        # And they should match the rollups rebuilt from the readings left
+        expected = conn.execute('select * from rollups order by device_uuid, type').fetchall()
+        rollups.rebuild(connections.writer())
+        self.assertEqual(conn.execute('select * from rollups order by device_uuid, type').fetchall(), expected)
+
+        # And ranges over the expired days should not find any reading
+        request = self.client().get('/devices/{}/readings/stats/?type=temperature&start=0&end={}'.format(self.device_uuid, DAY * 2 - 1))
+        self.assertEqual(json.loads(request.data)['min'], None)
+        request = self.client().get('/devices/{}/readings/?start=0&end={}'.format(self.device_uuid, DAY * 3))
+        self.assertEqual([reading['value'] for reading in json.loads(request.data)], [20, 60])
+
+    def test_expired_readings_are_not_inserted(self):
+        # Given expired partitions
+        expire(connections, 1, now=DAY * 3)
+
+        # When readings created before the retention period are inserted
+        insert_readings([(self.device_uuid, 'temperature', 0, DAY + 300)])
+
+        # Then they should be left out
+        request = self.client().get('/devices/{}/readings/min/?type=temperature'.format(self.device_uuid))
+        self.assertEqual(json.loads(request.data)['value'], 20)
+
+    def test_post_reading_older_than_retention(self):
+        # Given a retention period
+        app.config['RETENTION_DAYS'] = 30
+        self.addCleanup(app.config.__setitem__, 'RETENTION_DAYS', 0)
+
+        # When we post a reading older than the retention period
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=json.dumps({
+            'type': 'temperature', 'value': 10, 'date_created': 1000}))
+
+        # Then we should receive a 400
+        self.assertEqual(request.status_code, 400)
+
+    def test_expire_command(self):
+        # Given no retention period
+        # When we expire the readings
+        result = app.test_cli_runner().invoke(args=['expire-readings'])
+
+        # Then it should be refused
+        self.assertNotEqual(result.exit_code, 0)
+
+class ConcurrentPartitionsTestCases(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        reset_database('test_database.db')
+        metric_cache.clear()
+        device_ids.clear()
+
+    def test_concurrent_writers_create_a_partition_once(self):
+        for day in range(5):
+            # Given several threads writing the first readings of a new day at once
+            barrier = threading.Barrier(8)
+            errors = []
+            def write(thread):
+                barrier.wait()
+                try:
+                    insert_readings([('device_{}'.format(thread), 'temperature', thread, DAY * day + thread)])
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=write, args=(thread,)) for thread in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            # Then the partition should be created once and every reading inserted
+            self.assertEqual(errors, [])
+            conn = sqlite3.connect('test_database.db')
+            name = partitions.partition_name(DAY * day)
+            self.assertEqual(conn.execute('select count(*) from partitions where name = ?', (name,)).fetchone()[0], 1)
+            self.assertEqual(conn.execute('select count(*) from "{}"'.format(name)).fetchone()[0], 8)
+            conn.close()
@@ -0,0 +1,112 @@
+import json
+import random
+import sqlite3
+import unittest
+
+from app import app, device_ids, insert_readings, metric_cache
+from db import register_functions
+from rollups import RESOLUTIONS, plan, rebuild
+from stats import find_median
+from tests import reset_database
+
+class PlanTestCases(unittest.TestCase):
+
+    def test_plan_covers_range(self):
+        rand = random.Random(7)
+        for i in range(500):
+            # Given a random range
+            start = rand.randint(0, 3 * 86400)
+            end = start + rand.choice([0, 59, 61, 3599, 3601, 86400, 2 * 86400 + 3661])
+
+            # When we plan it
+            buckets, edges = plan(start, end)
+
+            # Then buckets and edges should cover the range exactly once
+            seconds = []
+            for resolution, first, last in buckets:
+                self.assertTrue(first % resolution == 0 and last % resolution == 0)
+                seconds.extend(range(first, last + resolution))
+            for edge_start, edge_end in edges:
+                # And edges should only be what is left over from the smallest buckets
+                self.assertTrue(edge_end - edge_start + 1 < 2 * RESOLUTIONS[-1])
+                seconds.extend(range(edge_start, edge_end + 1))
+            self.assertEqual(sorted(seconds), list(range(start, end + 1)))
+
+    def test_plan_uses_largest_buckets(self):
+        # Given a range of two days, an hour and a minute on both sides
+        start = 86400 - 3600 - 60
+        end = 3 * 86400 + 3600 + 60 - 1
+
+        # Then it should be planned as days, hours and minutes without any edges
+        buckets, edges = plan(start, end)
+        self.assertEqual(buckets, [(60, start, start), (3600, 82800, 82800), (86400, 86400, 2 * 86400),
+                                   (3600, 3 * 86400, 3 * 86400), (60, 3 * 86400 + 3600, 3 * 86400 + 3600)])
+        self.assertEqual(edges, [])
+
+class RangeMetricsTestCases(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        reset_database('test_database.db')
+        metric_cache.clear()
+        device_ids.clear()
+
+        self.device_uuid = 'test_device'
+        self.client = app.test_client
+
+        # Setup three days of random readings
+        rand = random.Random(3)
+        self.readings = [(self.device_uuid, 'temperature', rand.randint(0, 100), rand.randint(0, 3 * 86400)) for i in range(2000)]
+        insert_readings(self.readings[:1000])
+        insert_readings(self.readings[1000:])
+
+    def test_range_metrics_match_raw_scan(self):
+        rand = random.Random(11)
+        for i in range(25):
+            # Given a random range
+            start = rand.randint(0, 2 * 86400)
+            end = start + rand.randint(0, 86400 + 7200)
+            readings = sorted((value, date_created) for device_uuid, sensor_type, value, date_created in self.readings if start <= date_created <= end)
+            values = [value for value, date_created in readings]
+            if len(values) < 2:
+                continue
+            url = '/devices/{}/readings/{{}}/?type=temperature&start={}&end={}'.format(self.device_uuid, start, end)
+
+            # When we request the metrics over that range
+            # Then they should match the metrics found by scanning the readings
+            minimum = json.loads(self.client().get(url.format('min')).data)
+            self.assertEqual((minimum['value'], minimum['date_created']), readings[0])
+
+            maximum = json.loads(self.client().get(url.format('max')).data)
+            self.assertEqual(maximum['value'], values[-1])
+            self.assertEqual(maximum['date_created'], min(date_created for value, date_created in readings if value == values[-1]))
+
+            mean = json.loads(self.client().get(url.format('mean')).data)
+            self.assertEqual(mean['value'], round(sum(values) / len(values), 4))
+
+            median = json.loads(self.client().get(url.format('median')).data)
+            self.assertEqual(median['value'], find_median(values, absolute=False))
+
+            n = len(values)
+            quartiles = json.loads(self.client().get(url.format('quartiles')).data)
+            self.assertEqual(quartiles, {'quartile_1': find_median(values[:n // 2]), 'quartile_3': find_median(values[n - n // 2:])})
+
+            counts = {value: values.count(value) for value in values}
+            modes = sorted(value for value, count in counts.items() if count == max(counts.values()))
+            mode = json.loads(self.client().get(url.format('mode')).data)
+            self.assertEqual(mode['value'], modes[0] if len(modes) == 1 else modes)
+
+    def test_rebuild_matches_incremental_rollups(self):
+        # Given the rollups maintained while inserting
+        conn = sqlite3.connect('test_database.db')
+        register_functions(conn)
+        query = 'select * from rollups order by 1, 2'
+        buckets_query = 'select * from rollup_buckets order by 1, 2, 3, 4'
+        incremental = (conn.execute(query).fetchall(), conn.execute(buckets_query).fetchall())
+
+        # When we rebuild them from the readings
+        rebuild(conn)
+
+        # Then they should be identical
+        self.assertEqual((conn.execute(query).fetchall(), conn.execute(buckets_query).fetchall()), incremental)
+        conn.close()
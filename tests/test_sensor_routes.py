@@ -1,37 +1,37 @@
 import json
+import os
 import pytest
 import sqlite3
 import time
 import unittest
 
-from app import app
+from werkzeug.http import http_date
+
+import partitions
+import rollups
+from app import app, connections, device_ids, insert_readings, metric_cache
+from db import register_functions, write_readings
+from tests import reset_database
 
 class SensorRoutesTestCases(unittest.TestCase):
 
     def setUp(self):
+        app.config['TESTING'] = True
+
         # Setup the SQLite DB
-        conn = sqlite3.connect('test_database.db')
-        conn.execute('DROP TABLE IF EXISTS readings')
-        conn.execute('CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        reset_database('test_database.db')
+        metric_cache.clear()
+        device_ids.clear()
 
         self.device_uuid = 'test_device'
 
         # Setup some sensor data
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    (self.device_uuid, 'temperature', 22, int(time.time()) - 100))
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    (self.device_uuid, 'temperature', 50, int(time.time()) - 50))
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    (self.device_uuid, 'temperature', 100, int(time.time())))
-
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    ('other_uuid', 'temperature', 22, int(time.time())))
-        conn.commit()
-
-        app.config['TESTING'] = True
+        insert_readings([
+            (self.device_uuid, 'temperature', 22, int(time.time()) - 100),
+            (self.device_uuid, 'temperature', 50, int(time.time()) - 50),
+            (self.device_uuid, 'temperature', 100, int(time.time())),
+            ('other_uuid', 'temperature', 22, int(time.time())),
+        ])
 
         self.client = app.test_client
 
@@ -62,7 +62,8 @@ class SensorRoutesTestCases(unittest.TestCase):
         conn = sqlite3.connect('test_database.db')
         conn.row_factory = sqlite3.Row
         cur = conn.cursor()
-        cur.execute('select * from readings where device_uuid="{}"'.format(self.device_uuid))
+        cur.execute('select r.* from {} r join devices d on d.id = r.device_id where d.device_uuid=?'.format(partitions.source(partitions.overlapping(conn))),
+                    (self.device_uuid,))
         rows = cur.fetchall()
 
         # We should have four
@@ -205,3 +206,556 @@ class SensorRoutesTestCases(unittest.TestCase):
         # And the response data should have a value of 22 for quartile_1 and 100 for quartile_3
         self.assertTrue(json.loads(request.data)["quartile_1"] == 22)
         self.assertTrue(json.loads(request.data)["quartile_3"] == 100)
+
+    def test_device_readings_percentiles(self):
+        # Given readings of 22, 50 and 100
+        # When we request several percentiles
+        request = self.client().get('/devices/{}/readings/percentiles/?type=temperature&p=0,50,75,99'.format(self.device_uuid))
+
+        # Then we should receive a 200 and the percentiles interpolated between the readings
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(json.loads(request.data), {'p0': 22, 'p50': 50, 'p75': 75, 'p99': 99})
+
+        # And the lower interpolation should return the lower reading
+        request = self.client().get('/devices/{}/readings/percentiles/?type=temperature&p=75,99&interpolation=lower&start={}&end={}'.format(
+            self.device_uuid, time.time() - 200, time.time()))
+        self.assertEqual(json.loads(request.data), {'p75': 50, 'p99': 50})
+
+        # And the default percentiles should be returned without p
+        request = self.client().get('/devices/{}/readings/percentiles/?type=temperature'.format(self.device_uuid))
+        self.assertEqual(sorted(json.loads(request.data)), ['p50', 'p90', 'p95', 'p99'])
+
+    def test_device_readings_percentiles_invalid(self):
+        for args in ['p=101', 'p=50,abc', 'p=-1', 'interpolation=nearest']:
+            # When we request percentiles that are not supported
+            request = self.client().get('/devices/{}/readings/percentiles/?type=temperature&{}'.format(self.device_uuid, args))
+
+            # Then we should receive a 400
+            self.assertEqual(request.status_code, 400)
+
+        # And percentiles of a device without readings should not be found
+        request = self.client().get('/devices/unknown/readings/percentiles/?type=temperature')
+        self.assertEqual(request.status_code, 404)
+
+    def test_device_readings_batch_post(self):
+        # Given a device UUID
+        # When we make a request with the given UUID to create a batch of readings
+        request = self.client().post('/devices/{}/readings/batch/'.format(self.device_uuid), data=
+            json.dumps([
+                {'type': 'temperature', 'value': 10},
+                {'type': 'humidity', 'value': 101},
+                {'type': 'humidity', 'value': 40, 'date_created': int(time.time())}
+            ]))
+
+        # Then we should receive a 201
+        self.assertEqual(request.status_code, 201)
+
+        # And only the invalid reading should be reported back
+        data = json.loads(request.data)
+        self.assertTrue(data['inserted'] == 2)
+        self.assertTrue(data['errors'] == [{'index': 1, 'error': 'value 101 not supported'}])
+
+        # And when we check for readings in the db we should have five
+        conn = sqlite3.connect('test_database.db')
+        cur = conn.cursor()
+        cur.execute('select r.* from {} r join devices d on d.id = r.device_id where d.device_uuid=?'.format(partitions.source(partitions.overlapping(conn))),
+                    (self.device_uuid,))
+        self.assertTrue(len(cur.fetchall()) == 5)
+
+    def test_device_readings_batch_post_date_out_of_range(self):
+        # Given readings dated outside of the supported range
+        # When we post them in a batch with a valid reading
+        request = self.client().post('/devices/{}/readings/batch/'.format(self.device_uuid), data=
+            json.dumps([
+                {'type': 'temperature', 'value': 10, 'date_created': 1e30},
+                {'type': 'temperature', 'value': 10, 'date_created': 2 ** 63},
+                {'type': 'temperature', 'value': 10, 'date_created': -1},
+                {'type': 'temperature', 'value': 10, 'date_created': float('inf')},
+                {'type': 'temperature', 'value': 10, 'date_created': 253402300799},
+            ]))
+
+        # Then each of them should be reported back and the valid reading inserted
+        self.assertEqual(request.status_code, 201)
+        data = json.loads(request.data)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual([error['index'] for error in data['errors']], [0, 1, 2, 3])
+
+        # And a single reading out of range should be refused
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=json.dumps({
+            'type': 'temperature', 'value': 10, 'date_created': 1e30}))
+        self.assertEqual(request.status_code, 400)
+
+    def test_readings_batch_post_ndjson(self):
+        # Given an NDJSON stream of readings for several devices
+        lines = [
+            json.dumps({'device_uuid': self.device_uuid, 'type': 'temperature', 'value': 10}),
+            'not json',
+            json.dumps({'device_uuid': 'other_uuid', 'type': 'pressure', 'value': 10}),
+            json.dumps({'device_uuid': 'other_uuid', 'type': 'humidity', 'value': 10}),
+        ]
+
+        # When we post the stream
+        request = self.client().post('/readings/batch/', data='\n'.join(lines), content_type='application/x-ndjson')
+
+        # Then we should receive a 201
+        self.assertEqual(request.status_code, 201)
+
+        # And the two invalid lines should be reported back
+        data = json.loads(request.data)
+        self.assertTrue(data['inserted'] == 2)
+        self.assertTrue([error['index'] for error in data['errors']] == [1, 2])
+
+        # And each device should have received its reading
+        request = self.client().get('/devices/other_uuid/readings/')
+        self.assertTrue(len(json.loads(request.data)) == 2)
+
+    def test_device_readings_min_not_found(self):
+        # Given a device UUID without humidity readings
+        # When we request the min humidity reading
+        request = self.client().get('/devices/{}/readings/min/?type=humidity'.format(self.device_uuid))
+
+        # Then we should receive a 404
+        self.assertEqual(request.status_code, 404)
+
+    def test_device_readings_mean_not_found(self):
+        # Given a date range without readings
+        # When we request the mean over that range
+        request = self.client().get('/devices/{}/readings/mean/?type=temperature&start={}&end={}'.format(self.device_uuid, 0, 1))
+
+        # Then we should receive a 404 instead of dividing by zero
+        self.assertEqual(request.status_code, 404)
+
+    def test_device_readings_invalid_range(self):
+        # Given a start date that is not a number
+        # When we request the mean over that range
+        request = self.client().get('/devices/{}/readings/mean/?type=temperature&start={}&end={}'.format(self.device_uuid, 'yesterday', 1))
+
+        # Then we should receive a 400
+        self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_median_even(self):
+        """
+        The median of an even number of readings should be the lower of the two medians.
+        """
+        # Given a fourth temperature reading
+        self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=json.dumps({'type': 'temperature', 'value': 60}))
+
+        # When we request the median reading
+        request = self.client().get('/devices/{}/readings/median/?type=temperature'.format(self.device_uuid))
+
+        # Then we should receive the reading holding the lower median
+        self.assertEqual(request.status_code, 200)
+        self.assertTrue(json.loads(request.data)["value"] == 50)
+        self.assertTrue(json.loads(request.data)["device_uuid"] == self.device_uuid)
+
+    def test_device_readings_quartiles_not_found(self):
+        # Given a date range with a single reading
+        # When we request the quartiles over that range
+        request = self.client().get('/devices/{}/readings/quartiles/?type=temperature&start={}&end={}'.format(self.device_uuid, time.time() - 20, time.time()))
+
+        # Then we should receive a 404
+        self.assertEqual(request.status_code, 404)
+
+    def test_device_readings_rollups(self):
+        # Given readings posted in a batch
+        self.client().post('/devices/{}/readings/batch/'.format(self.device_uuid), data=json.dumps([
+            {'type': 'temperature', 'value': 5, 'date_created': 10},
+            {'type': 'temperature', 'value': 5, 'date_created': 5},
+        ]))
+
+        # When we request the all time metrics
+        # Then they should be answered from the rollups with the new readings
+        request = self.client().get('/devices/{}/readings/min/?type=temperature'.format(self.device_uuid))
+        self.assertTrue(json.loads(request.data) == {'device_uuid': self.device_uuid, 'type': 'temperature', 'value': 5, 'date_created': 5})
+
+        request = self.client().get('/devices/{}/readings/mean/?type=temperature'.format(self.device_uuid))
+        self.assertTrue(json.loads(request.data)["value"] == 36.4)
+
+        request = self.client().get('/devices/{}/readings/mode/?type=temperature'.format(self.device_uuid))
+        self.assertTrue(json.loads(request.data)["value"] == 5)
+
+    def test_rebuild_rollups(self):
+        # Given a reading inserted behind the back of the rollups
+        conn = sqlite3.connect('test_database.db')
+        now = int(time.time())
+        conn.execute('insert into "{}" (device_id,type_code,date_created,seq,value) select id, 1, ?, 1, 1 from devices where device_uuid=?'.format(
+            partitions.overlapping(conn, (now - 100, now))[-1]), (now, self.device_uuid))
+        conn.commit()
+
+        # When we rebuild the rollups
+        result = app.test_cli_runner().invoke(args=['rebuild-rollups'])
+        self.assertEqual(result.exit_code, 0)
+
+        # Then the all time metrics should include it
+        request = self.client().get('/devices/{}/readings/min/?type=temperature'.format(self.device_uuid))
+        self.assertTrue(json.loads(request.data)["value"] == 1)
+
+        request = self.client().get('/devices/{}/readings/max/?type=temperature'.format(self.device_uuid))
+        self.assertTrue(json.loads(request.data)["value"] == 100)
+
+    def test_device_readings_get_paginated(self):
+        # Given a device UUID with three readings
+        # When we request the first page of two readings
+        request = self.client().get('/devices/{}/readings/?limit=2'.format(self.device_uuid))
+
+        # Then we should receive the two oldest readings and a cursor for the next page
+        self.assertEqual(request.status_code, 200)
+        self.assertTrue([reading['value'] for reading in json.loads(request.data)] == [22, 50])
+        self.assertTrue('X-Next-Cursor' in request.headers)
+
+        # And when we request the next page
+        request = self.client().get('/devices/{}/readings/?limit=2&after={}'.format(self.device_uuid, request.headers['X-Next-Cursor']))
+
+        # Then we should receive the last reading without a cursor
+        self.assertEqual(request.status_code, 200)
+        self.assertTrue([reading['value'] for reading in json.loads(request.data)] == [100])
+        self.assertFalse('X-Next-Cursor' in request.headers)
+
+    def test_device_readings_get_paginated_same_second(self):
+        # Given readings of a device created the same second
+        insert_readings([(self.device_uuid, sensor_type, value, 1000) for sensor_type in ['humidity', 'temperature'] for value in [1, 2, 3]])
+
+        # When we page through them one reading at a time
+        values = []
+        cursor = ''
+        for i in range(6):
+            request = self.client().get('/devices/{}/readings/?limit=1&end=1000{}'.format(self.device_uuid, cursor))
+            values.extend((reading['type'], reading['value']) for reading in json.loads(request.data))
+            cursor = '&after={}'.format(request.headers.get('X-Next-Cursor'))
+
+        # Then every reading should be returned once, temperatures first
+        self.assertEqual(values, [('temperature', 1), ('temperature', 2), ('temperature', 3), ('humidity', 1), ('humidity', 2), ('humidity', 3)])
+
+    def test_device_readings_conditional_get(self):
+        # Given readings last changed a few seconds ago
+        conn = sqlite3.connect('test_database.db')
+        with conn:
+            conn.execute('update devices set modified = modified - 5000')
+        conn.close()
+
+        for path in ['', 'min/?type=temperature', 'stats/?type=temperature', 'percentiles/?type=temperature']:
+            url = '/devices/{}/readings/{}'.format(self.device_uuid, path)
+
+            # Given a response with validators
+            request = self.client().get(url)
+            self.assertEqual(request.status_code, 200)
+            etag = request.headers['ETag']
+            last_modified = request.headers['Last-Modified']
+
+            # When we request it again with its ETag or date
+            # Then we should receive a 304 without a body
+            request = self.client().get(url, headers={'If-None-Match': etag})
+            self.assertEqual(request.status_code, 304)
+            self.assertEqual(request.data, b'')
+            self.assertEqual(request.headers['ETag'], etag)
+            request = self.client().get(url, headers={'If-Modified-Since': last_modified})
+            self.assertEqual(request.status_code, 304)
+
+        # And once a reading of the device is inserted the ETag or date should not match anymore
+        insert_readings([(self.device_uuid, 'temperature', 10, int(time.time()))])
+        request = self.client().get('/devices/{}/readings/'.format(self.device_uuid), headers={'If-Modified-Since': last_modified})
+        self.assertEqual(request.status_code, 200)
+        insert_readings([(self.device_uuid, 'temperature', 10, int(time.time()))])
+        request = self.client().get('/devices/{}/readings/percentiles/?type=temperature'.format(self.device_uuid), headers={'If-None-Match': etag})
+        self.assertEqual(request.status_code, 200)
+        self.assertNotEqual(request.headers['ETag'], etag)
+
+        # And neither once another process inserted readings of the device
+        etag = request.headers['ETag']
+        conn = sqlite3.connect('test_database.db')
+        with conn:
+            device_id = conn.execute('select id from devices where device_uuid = ?', (self.device_uuid,)).fetchone()[0]
+            write_readings(conn, [(self.device_uuid, 'temperature', 20, int(time.time()))], {self.device_uuid: device_id})
+        conn.close()
+        request = self.client().get('/devices/{}/readings/percentiles/?type=temperature'.format(self.device_uuid), headers={'If-None-Match': etag})
+        self.assertEqual(request.status_code, 200)
+
+    def test_device_readings_conditional_get_same_second(self):
+        # Given readings changed within the current second
+        # When we request them
+        request = self.client().get('/devices/{}/readings/'.format(self.device_uuid))
+
+        # Then only the ETag should be returned since another change could happen within the same second
+        self.assertIn('ETag', request.headers)
+        self.assertNotIn('Last-Modified', request.headers)
+
+        # And a date within the current second should not be trusted
+        request = self.client().get('/devices/{}/readings/'.format(self.device_uuid), headers={'If-Modified-Since': http_date(time.time())})
+        self.assertEqual(request.status_code, 200)
+
+    def test_device_readings_conditional_get_disabled(self):
+        # Given conditional requests are disabled
+        app.config['CONDITIONAL_GETS'] = False
+        self.addCleanup(app.config.__setitem__, 'CONDITIONAL_GETS', True)
+
+        # When we request the readings
+        request = self.client().get('/devices/{}/readings/'.format(self.device_uuid), headers={'If-None-Match': '*'})
+
+        # Then they should be returned without validators
+        self.assertEqual(request.status_code, 200)
+        self.assertNotIn('ETag', request.headers)
+
+    def test_device_readings_get_columnar(self):
+        # Given a device with three readings
+        # When we request them as columns
+        request = self.client().get('/devices/{}/readings/?type=temperature&format=columnar&limit=10'.format(self.device_uuid))
+
+        # Then their keys should not be repeated
+        self.assertEqual(request.status_code, 200)
+        data = json.loads(request.data)
+        self.assertEqual(sorted(data), ['date_created', 'value'])
+        self.assertEqual(data['value'], [22, 50, 100])
+        self.assertEqual(data['date_created'], sorted(data['date_created']))
+
+        # And the type should be added when the readings are not filtered by type
+        request = self.client().get('/devices/{}/readings/?format=columnar&limit=2'.format(self.device_uuid))
+        self.assertEqual(json.loads(request.data)['type'], ['temperature', 'temperature'])
+        self.assertIn('X-Next-Cursor', request.headers)
+
+        # And columns should only be returned a page at a time
+        request = self.client().get('/devices/{}/readings/?format=columnar'.format(self.device_uuid))
+        self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_get_invalid_cursor(self):
+        # Given a cursor that was not returned by the API
+        # When we request the page after it
+        request = self.client().get('/devices/{}/readings/?limit=2&after=nope'.format(self.device_uuid))
+
+        # Then we should receive a 400
+        self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_get_streamed(self):
+        # Given more readings than fit in a single chunk
+        app.config['READINGS_CHUNK_SIZE'] = 2
+        self.addCleanup(app.config.__setitem__, 'READINGS_CHUNK_SIZE', 1000)
+
+        # When we request every reading as a JSON array and as NDJSON
+        request = self.client().get('/devices/{}/readings/'.format(self.device_uuid))
+        ndjson_request = self.client().get('/devices/{}/readings/?format=ndjson'.format(self.device_uuid))
+
+        # Then every reading should be streamed back in order
+        self.assertEqual(request.status_code, 200)
+        self.assertTrue([reading['value'] for reading in json.loads(request.data)] == [22, 50, 100])
+        self.assertEqual(ndjson_request.mimetype, 'application/x-ndjson')
+        self.assertTrue([json.loads(line)['value'] for line in ndjson_request.data.splitlines()] == [22, 50, 100])
+
+    def test_device_readings_stats(self):
+        # Given a device UUID with three temperature readings
+        # When we request every metric at once
+        request = self.client().get('/devices/{}/readings/stats/?type=temperature'.format(self.device_uuid))
+
+        # Then each metric should match its own endpoint
+        self.assertEqual(request.status_code, 200)
+        data = json.loads(request.data)
+        for metric in ['min', 'max', 'median', 'mean', 'mode', 'quartiles']:
+            own = self.client().get('/devices/{}/readings/{}/?type=temperature&start={}&end={}'.format(self.device_uuid, metric, 0, time.time() + 10))
+            self.assertEqual(data[metric], json.loads(own.data))
+
+    def test_device_readings_stats_metrics(self):
+        # Given a date range without readings
+        # When we request a subset of the metrics over that range
+        request = self.client().get('/devices/{}/readings/stats/?type=temperature&metrics=min,mean&start={}&end={}'.format(self.device_uuid, 0, 1))
+
+        # Then only those metrics should be returned, as null
+        self.assertEqual(request.status_code, 200)
+        self.assertTrue(json.loads(request.data) == {'min': None, 'mean': None})
+
+        # And an unknown metric should be rejected
+        request = self.client().get('/devices/{}/readings/stats/?type=temperature&metrics=min,p99'.format(self.device_uuid))
+        self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_series(self):
+        # Given readings every ten seconds for two minutes
+        insert_readings([('series_device', 'temperature', i % 7 * 10, 1000 + i * 10) for i in range(12)])
+
+        # When we request their series by minute
+        request = self.client().get('/devices/series_device/readings/series/?type=temperature&start=1000&end=1119&bucket=60')
+
+        # Then every bucket should be aligned on the minute and summarize its readings
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(json.loads(request.data), {'bucket': 60, 'series': [
+            {'date_created': 960, 'count': 2, 'min': 0, 'max': 10, 'mean': 5.0},
+            {'date_created': 1020, 'count': 6, 'min': 0, 'max': 60, 'mean': 33.3333},
+            {'date_created': 1080, 'count': 4, 'min': 10, 'max': 40, 'mean': 25.0},
+        ]})
+
+        # And asking for points should split the range evenly from its start
+        request = self.client().get('/devices/series_device/readings/series/?type=temperature&start=1000&end=1119&points=4')
+        data = json.loads(request.data)
+        self.assertEqual(data['bucket'], 30)
+        self.assertEqual([point['date_created'] for point in data['series']], [1000, 1030, 1060, 1090])
+        self.assertEqual(sum(point['count'] for point in data['series']), 12)
+
+    def test_device_readings_series_lttb(self):
+        # Given a flat series with a single spike
+        insert_readings([('series_device', 'temperature', 90 if i == 25 else 10, 1000 + i) for i in range(100)])
+
+        # When we downsample it to five points
+        request = self.client().get('/devices/series_device/readings/series/?type=temperature&start=1000&end=1099&points=5&mode=lttb')
+
+        # Then the first and last readings and the spike should be kept
+        self.assertEqual(request.status_code, 200)
+        data = json.loads(request.data)['series']
+        self.assertEqual(len(data), 5)
+        self.assertEqual(data[0], {'date_created': 1000, 'value': 10})
+        self.assertEqual(data[-1], {'date_created': 1099, 'value': 10})
+        self.assertIn({'date_created': 1025, 'value': 90}, data)
+
+    def test_device_readings_series_invalid(self):
+        for args in ['start=0&end=100', 'start=0&end=100&bucket=60&points=10', 'start=0&end=100&bucket=0', 'start=0&end=100&points=2&mode=lttb',
+                     'start=0&end=100000&bucket=1', 'start=0&end=100&points=10&mode=sample']:
+            # When we request a series without exactly one valid granularity
+            request = self.client().get('/devices/{}/readings/series/?type=temperature&{}'.format(self.device_uuid, args))
+
+            # Then we should receive a 400
+            self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_cache_invalidated(self):
+        # Given a cached max reading
+        request = self.client().get('/devices/{}/readings/max/?type=temperature&start={}&end={}'.format(self.device_uuid, 0, 10))
+        self.assertEqual(request.status_code, 404)
+        hits = metric_cache.stats()['hits']
+        request = self.client().get('/devices/{}/readings/max/?type=temperature&start={}&end={}'.format(self.device_uuid, 0, 10))
+        self.assertTrue(metric_cache.stats()['hits'] == hits + 1)
+
+        # When a reading is posted within the range
+        self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=json.dumps({'type': 'temperature', 'value': 7, 'date_created': 5}))
+
+        # Then the new reading should be returned instead of the cached result
+        request = self.client().get('/devices/{}/readings/max/?type=temperature&start={}&end={}'.format(self.device_uuid, 0, 10))
+        self.assertEqual(request.status_code, 200)
+        self.assertTrue(json.loads(request.data)["value"] == 7)
+
+    def test_device_readings_cache_invalidated_by_another_process(self):
+        # Given a cached max reading
+        url = '/devices/{}/readings/max/?type=temperature&start={}&end={}'.format(self.device_uuid, 0, 10)
+        self.assertEqual(self.client().get(url).status_code, 404)
+
+        # When another process inserts a reading within the range
+        conn = sqlite3.connect('test_database.db')
+        register_functions(conn)
+        with conn:
+            device_id = conn.execute('select id from devices where device_uuid = ?', (self.device_uuid,)).fetchone()[0]
+            rollups.update(conn, write_readings(conn, [(self.device_uuid, 'temperature', 7, 5)], {self.device_uuid: device_id}))
+        conn.close()
+
+        # Then the new reading should be returned instead of the cached result
+        request = self.client().get(url)
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(json.loads(request.data)['value'], 7)
+
+    def test_fleet_readings_metrics(self):
+        # Given a second device with temperature readings
+        insert_readings([('other_uuid', 'temperature', 60, 1), ('other_uuid', 'temperature', 22, 2)])
+
+        for args in ['', '&start=0&end={}'.format(time.time() + 10), '&start=0&end=1']:
+            # When we request every metric for both devices
+            request = self.client().get('/readings/stats/?type=temperature&device_uuid={}&device_uuid=other_uuid{}'.format(self.device_uuid, args))
+            self.assertEqual(request.status_code, 200)
+            data = json.loads(request.data)
+
+            for metric in ['min', 'max', 'median', 'mean', 'mode', 'quartiles']:
+                # Then each device should match its own endpoint
+                for device_uuid in [self.device_uuid, 'other_uuid']:
+                    own = self.client().get('/devices/{}/readings/stats/?type=temperature&metrics={}{}'.format(device_uuid, metric, args))
+                    self.assertEqual(data[metric]['devices'][device_uuid], json.loads(own.data)[metric])
+
+        # And the overall metrics should be computed over the readings of both devices
+        request = self.client().get('/readings/min/?type=temperature')
+        self.assertTrue(json.loads(request.data)['overall'] == {'device_uuid': 'other_uuid', 'type': 'temperature', 'value': 22, 'date_created': 2})
+
+        request = self.client().get('/readings/median/?type=temperature')
+        self.assertTrue(json.loads(request.data)['overall']['value'] == 22)
+
+        request = self.client().get('/readings/mode/?type=temperature')
+        self.assertTrue(json.loads(request.data)['overall'] == {'value': 22})
+
+    def test_fleet_readings_unknown_metric(self):
+        # Given a metric that is not supported
+        # When we request it for every device
+        request = self.client().get('/readings/p99/?type=temperature')
+
+        # Then we should receive a 404
+        self.assertEqual(request.status_code, 404)
+
+    def test_metrics(self):
+        # Given a metric request
+        self.client().get('/devices/{}/readings/min/?type=temperature'.format(self.device_uuid))
+
+        # When we request the telemetry
+        request = self.client().get('/metrics')
+
+        # Then it should hold the latency of the route and its SQL time
+        self.assertEqual(request.status_code, 200)
+        text = request.data.decode()
+        self.assertIn('http_request_duration_seconds_count{method="GET",route="/devices/<string:device_uuid>/readings/min/",status="200"}', text)
+        self.assertIn('sqlite_query_duration_seconds_count{route="/devices/<string:device_uuid>/readings/min/"}', text)
+        self.assertIn('ingest_readings_inserted_total', text)
+        self.assertIn('metric_cache_hits', text)
+
+class ShardedRoutesTestCases(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SHARDS'] = 4
+        for path in connections.shard_paths():
+            reset_database(path)
+        metric_cache.clear()
+        device_ids.clear()
+        self.client = app.test_client
+
+        self.device_uuids = ['device-{}'.format(i) for i in range(12)]
+        insert_readings([(device_uuid, 'temperature', (i * 7 + j * 13) % 101, 1000 + j * 30)
+                         for i, device_uuid in enumerate(self.device_uuids) for j in range(9)])
+
+    def tearDown(self):
+        paths = connections.shard_paths()
+        app.config['SHARDS'] = 1
+        connections.close_all()
+        for path in paths:
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    def test_readings_are_sharded(self):
+        # Given readings of twelve devices
+        # Then every shard should only hold the readings of its devices
+        counts = []
+        for path in connections.shard_paths():
+            conn = sqlite3.connect(path)
+            counts.append(conn.execute('select count(distinct device_id) from {}'.format(partitions.source(partitions.overlapping(conn)))).fetchone()[0])
+        self.assertEqual(sum(counts), 12)
+        self.assertTrue(all(count < 12 for count in counts))
+
+    def test_fleet_metrics_fan_out(self):
+        for args in ['', '&start=1000&end=1200']:
+            # When we request every metric for every device
+            request = self.client().get('/readings/stats/?type=temperature{}'.format(args))
+            self.assertEqual(request.status_code, 200)
+            data = json.loads(request.data)
+
+            for metric in ['min', 'max', 'median', 'mean', 'mode', 'quartiles']:
+                # Then each device should match its own endpoint
+                self.assertEqual(sorted(data[metric]['devices']), sorted(self.device_uuids))
+                for device_uuid in self.device_uuids:
+                    own = self.client().get('/devices/{}/readings/stats/?type=temperature&metrics={}{}'.format(device_uuid, metric, args))
+                    self.assertEqual(data[metric]['devices'][device_uuid], json.loads(own.data)[metric])
+
+            # And the overall median should be merged from every shard
+            readings = sorted((reading for device_uuid in self.device_uuids
+                               for reading in json.loads(self.client().get('/devices/{}/readings/?type=temperature{}'.format(device_uuid, args)).data)),
+                              key=lambda reading: (reading['value'], reading['date_created'], reading['device_uuid']))
+            self.assertEqual(data['median']['overall'], readings[(len(readings) - 1) // 2])
+
+    def test_fleet_median_deep_offset(self):
+        # Given many readings holding the median value, more than a chunk read from each shard
+        insert_readings([(device_uuid, 'humidity', 50, 5000 + j * 12 + i)
+                         for i, device_uuid in enumerate(self.device_uuids) for j in range(1000)])
+
+        # When we request the median over every device
+        request = self.client().get('/readings/median/?type=humidity')
+
+        # Then it should be the reading at the median rank, merged from every shard
+        readings = sorted((5000 + j * 12 + i, device_uuid) for i, device_uuid in enumerate(self.device_uuids) for j in range(1000))
+        date_created, device_uuid = readings[(len(readings) - 1) // 2]
+        self.assertEqual(json.loads(request.data)['overall'], {'device_uuid': device_uuid, 'type': 'humidity', 'value': 50, 'date_created': date_created})
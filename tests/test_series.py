@@ -0,0 +1,45 @@
+import random
+import unittest
+
+import series
+
+class SeriesTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(42)
+
+    def test_bucket_width(self):
+        # Given a range of a day
+        time_range = (0, 86399)
+
+        # Then splitting it into points should never give more buckets than points
+        for points in [1, 7, 24, 1000, 100000]:
+            width = series.bucket_width(time_range, points)
+            self.assertLessEqual(series.bucket_count(time_range, width, time_range[0]), points)
+        self.assertEqual(series.bucket_width(time_range, 24), 3600)
+
+    def test_largest_triangles(self):
+        # Given random readings split into ten buckets
+        readings = sorted((self.random.randint(0, 999), self.random.randint(0, 100)) for i in range(500))
+        buckets = {}
+        for date_created, value in readings:
+            buckets.setdefault(date_created // 100, []).append((date_created, value))
+        averages = {bucket: (sum(p[0] for p in points) / len(points), sum(p[1] for p in points) / len(points)) for bucket, points in buckets.items()}
+
+        # When we downsample them
+        kept = series.largest_triangles(((date_created // 100, date_created, value) for date_created, value in readings), averages)
+
+        # Then the first and last readings should be kept with one reading per bucket in between
+        self.assertEqual(kept[0], readings[0])
+        self.assertEqual(kept[-1], readings[-1])
+        self.assertEqual(len(kept), len(buckets) + 2)
+        self.assertEqual([point[0] // 100 for point in kept[1:-1]], sorted(buckets))
+        self.assertEqual(kept, sorted(kept))
+
+    def test_largest_triangles_few_readings(self):
+        # Given fewer readings than buckets
+        readings = [(0, 0, 10), (5, 500, 20)]
+
+        # Then every reading should be kept
+        self.assertEqual(series.largest_triangles(iter(readings), {0: (0, 10), 5: (500, 20)}), [(0, 10), (500, 20)])
+        self.assertEqual(series.largest_triangles(iter([]), {}), [])
@@ -0,0 +1,96 @@
+import random
+import unittest
+
+from stats import Histogram, find_median
+
+class HistogramTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(42)
+
+    def test_find_median(self):
+        # Given sorted lists with an odd and even number of items
+        # Then the median should be the middle item or the (absolute or lower) median
+        self.assertEqual(find_median([1, 2, 3]), 2)
+        self.assertEqual(find_median([1, 2, 3, 4]), 2.5)
+        self.assertEqual(find_median([1, 2, 3, 4], absolute=False), 2)
+
+    def test_statistics_match_sorting(self):
+        for n in list(range(1, 12)) + [100, 1001]:
+            # Given some random readings
+            values = [self.random.randint(0, 100) for i in range(n)]
+            readings = sorted(values)
+
+            # When we count them in a histogram
+            histogram = Histogram()
+            for value in values:
+                histogram.add(value)
+
+            # Then the statistics should match the ones found by sorting the readings
+            self.assertEqual(histogram.count, n)
+            self.assertEqual(histogram.total, sum(values))
+            self.assertEqual(histogram.value_at(histogram.median_rank()), find_median(readings, absolute=False))
+            self.assertEqual(histogram.median(absolute=False), find_median(readings, absolute=False))
+            self.assertEqual(histogram.median(absolute=True), find_median(readings, absolute=True))
+            if n > 1:
+                self.assertEqual(histogram.quartiles(), (
+                    find_median(readings[:n // 2], absolute=True),
+                    find_median(readings[n - n // 2:], absolute=True)))
+
+    def test_mode(self):
+        # Given readings with two values seen twice
+        histogram = Histogram.from_rows([(50, 2), (22, 2), (100, 1)])
+
+        # Then both should be modes, in ascending order
+        self.assertEqual(histogram.mode(), [22, 50])
+
+    def test_empty(self):
+        # Given no readings
+        histogram = Histogram()
+
+        # Then there should not be any statistics
+        self.assertEqual(histogram.median(), None)
+        self.assertEqual(histogram.mode(), [])
+        self.assertEqual(histogram.quartiles(), None)
+
+    def test_merge(self):
+        # Given two histograms
+        first = Histogram.from_rows([(1, 1), (2, 2)])
+        second = Histogram.from_rows([(2, 1), (3, 4)])
+
+        # When we merge them
+        first.merge(second)
+
+        # Then the counts should be added up
+        self.assertEqual(first.values(), [(1, 1), (2, 3), (3, 4)])
+
+    def test_value_out_of_range(self):
+        # Given a value outside of 0 to 100
+        # Then it should not be counted
+        with self.assertRaises(ValueError):
+            Histogram().add(101)
+
+    def test_percentiles_match_sorting(self):
+        for n in [1, 2, 3, 10, 101, 1000]:
+            # Given some random readings
+            values = sorted(self.random.randint(0, 100) for i in range(n))
+            histogram = Histogram.from_rows((value, 1) for value in values)
+
+            # When we select several percentiles at once
+            percents = [0, 1, 25, 50, 90, 95, 99, 99.9, 100]
+            interpolated = histogram.percentiles(percents, absolute=True)
+            lower = histogram.percentiles(percents, absolute=False)
+
+            # Then they should match the ones found by sorting the readings
+            for percent in percents:
+                position = percent / 100 * (n - 1)
+                below, above = values[int(position)], values[min(int(position) + 1, n - 1)]
+                self.assertAlmostEqual(interpolated[percent], below + (above - below) * (position - int(position)))
+                self.assertEqual(lower[percent], below)
+
+            # And the 50th percentile should be the absolute or lower median
+            self.assertEqual(interpolated[50], find_median(values, absolute=True))
+            self.assertEqual(lower[50], find_median(values, absolute=False))
+
+        # And there should not be any percentile without readings
+        self.assertEqual(Histogram().percentiles([50]), None)
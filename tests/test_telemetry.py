@@ -0,0 +1,46 @@
+import sqlite3
+import unittest
+
+from telemetry import Telemetry
+
+class TelemetryTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {'SLOW_QUERY_THRESHOLD': 100}
+        self.telemetry = Telemetry(self.config)
+
+    def test_render(self):
+        # Given a counter and a histogram
+        self.telemetry.describe('rows_total', 'Rows')
+        self.telemetry.inc('rows_total', {'route': '/a'}, 3)
+        self.telemetry.observe('latency_seconds', 0.003, {'route': '/a'})
+        self.telemetry.observe('latency_seconds', 20, {'route': '/a'})
+
+        # When we render them
+        text = self.telemetry.render({'queue_depth': ('Queue depth', 2)})
+
+        # Then they should be in the Prometheus text format
+        self.assertIn('# HELP rows_total Rows\n# TYPE rows_total counter\nrows_total{route="/a"} 3\n', text)
+        self.assertIn('# TYPE latency_seconds histogram\n', text)
+        self.assertIn('latency_seconds_bucket{route="/a",le="0.0025"} 0\n', text)
+        self.assertIn('latency_seconds_bucket{route="/a",le="0.005"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{route="/a",le="10"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{route="/a",le="+Inf"} 2\n', text)
+        self.assertIn('latency_seconds_count{route="/a"} 2\n', text)
+        self.assertIn('# TYPE queue_depth gauge\nqueue_depth 2\n', text)
+
+    def test_slow_query(self):
+        # Given a query slower than the threshold
+        conn = sqlite3.connect(':memory:')
+        conn.execute('create table readings (device_uuid TEXT, value INTEGER)')
+
+        # When it is recorded
+        with self.assertLogs('telemetry', 'WARNING') as logs:
+            self.assertTrue(self.telemetry.slow_query(conn, 'select * from readings where device_uuid=?', ['a'], 0.2))
+
+        # Then it should be logged with its parameters and query plan
+        self.assertIn("['a']", logs.output[0])
+        self.assertIn('SCAN readings', logs.output[0])
+
+        # And faster queries should not be logged
+        self.assertFalse(self.telemetry.slow_query(conn, 'select * from readings', [], 0.05))